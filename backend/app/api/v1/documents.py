@@ -2,25 +2,31 @@
 文档处理 API
 提供 PDF 文件上传和处理接口
 """
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, List, Dict
+from pathlib import Path
+import asyncio
 import os
 
 from app.services.document_processor import DocumentProcessor
 from app.services.pipeline import PipelinePaths
+from app.utils.hash_utils import calculate_file_sha1_cached
+from app.utils.fs_utils import create_partial_file, scan_files
 
 router = APIRouter(prefix="/api/v1", tags=["documents"])
 
-# 使用单例
-_processor = None
+# 上传文件分块写盘的块大小（1MB）
+UPLOAD_CHUNK_SIZE = 1 << 20
 
-def get_processor():
-    """获取文档处理服务实例"""
-    global _processor
-    if _processor is None:
-        _processor = DocumentProcessor()
-    return _processor
+def get_processor(request: Request) -> DocumentProcessor:
+    """获取在应用启动时创建的文档处理服务实例（未经 lifespan 启动时按需创建）"""
+    processor = getattr(request.app.state, "processor", None)
+    if processor is None:
+        processor = DocumentProcessor()
+        request.app.state.processor = processor
+    return processor
 
 
 class ProcessResponse(BaseModel):
@@ -44,6 +50,41 @@ class ProcessStatusResponse(BaseModel):
     result: Optional[ProcessResponse] = None
 
 
+async def _save_upload_file(file: UploadFile, dest: Path) -> int:
+    """
+    将上传文件分块写入磁盘
+    
+    内存占用恒定为一个分块，且每个分块之间都会让出事件循环，大文件上传不会阻塞其他请求
+    
+    Args:
+        file: 上传的文件
+        dest: 目标路径
+        
+    Returns:
+        写入的字节数（为 0 时不会改动目标文件）
+    """
+    written = 0
+    # 写入同目录下的临时文件，完成后原子重命名，列表接口不会看到写了一半的 PDF
+    tmp = await run_in_threadpool(create_partial_file, dest)
+    try:
+        with tmp:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await run_in_threadpool(tmp.write, chunk)
+                written += len(chunk)
+        if written == 0:
+            # 空上传不能覆盖已有的同名文档
+            Path(tmp.name).unlink(missing_ok=True)
+        else:
+            os.replace(tmp.name, dest)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+    return written
+
+
 @router.post("/documents/upload", response_model=ProcessResponse)
 async def upload_and_process_document(
     file: UploadFile = File(..., description="PDF 文件"),
@@ -71,25 +112,26 @@ async def upload_and_process_document(
             detail="只支持 PDF 文件格式"
         )
     
-    # 读取文件内容
+    # 将上传内容分块写入 documents 目录
+    pdf_path = processor.paths.documents_dir / Path(file.filename).name
     try:
-        file_content = await file.read()
+        written = await _save_upload_file(file, pdf_path)
     except Exception as e:
+        # 上传内容只写入临时文件（失败时已删除），已有的同名文档保持不变
         raise HTTPException(
             status_code=400,
             detail=f"读取文件失败: {str(e)}"
         )
     
-    if len(file_content) == 0:
+    if written == 0:
         raise HTTPException(
             status_code=400,
             detail="文件内容为空"
         )
     
     # 处理文件
-    result = await processor.process_uploaded_file(
-        file_content=file_content,
-        file_name=file.filename,
+    result = await processor.process_pdf_file(
+        pdf_file_path=str(pdf_path),
         company_name=company_name,
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap
@@ -152,6 +194,25 @@ async def list_documents(
     列出所有已处理的文档
     
     返回已处理的文档列表，包括文件名、SHA1、处理状态等信息。
+    目录扫描与 SHA1 计算在线程中执行，避免阻塞事件循环。
+    """
+    documents = await asyncio.to_thread(_scan_documents, processor)
+    
+    return {
+        "total": len(documents),
+        "documents": documents
+    }
+
+
+def _scan_documents(processor: DocumentProcessor) -> List[Dict]:
+    """
+    扫描 documents 目录，汇总每个 PDF 的处理状态
+    
+    Args:
+        processor: 文档处理服务实例
+        
+    Returns:
+        文档信息列表
     """
     documents_dir = processor.paths.documents_dir
     chunked_reports_dir = processor.paths.chunked_reports_dir
@@ -160,31 +221,31 @@ async def list_documents(
     documents = []
     
     # 遍历 documents 目录
-    for pdf_file in documents_dir.glob("*.pdf"):
+    for entry in scan_files(documents_dir, ".pdf"):
+        try:
+            st = entry.stat()
+        except OSError:
+            continue
+        
+        # SHA1 由 .sha1 旁路文件缓存，文件未变化时无需重新计算
         pdf_sha1 = None
         try:
-            from app.utils.hash_utils import calculate_file_sha1
-            pdf_sha1 = calculate_file_sha1(pdf_file)
-        except:
+            pdf_sha1 = calculate_file_sha1_cached(entry.path)
+        except Exception:
             pass
         
         # 检查是否已处理
-        chunk_json = chunked_reports_dir / f"{pdf_file.stem}.json"
-        faiss_file = vector_dbs_dir / f"{pdf_sha1}.faiss" if pdf_sha1 else None
-        
-        processed = chunk_json.exists() and (faiss_file.exists() if faiss_file else False)
+        chunk_json_exists = (chunked_reports_dir / f"{Path(entry.name).stem}.json").exists()
+        faiss_exists = (vector_dbs_dir / f"{pdf_sha1}.faiss").exists() if pdf_sha1 else False
         
         documents.append({
-            "file_name": pdf_file.name,
-            "file_path": str(pdf_file.relative_to(documents_dir)),
-            "file_size": pdf_file.stat().st_size,
+            "file_name": entry.name,
+            "file_path": entry.name,
+            "file_size": st.st_size,
             "sha1": pdf_sha1,
-            "processed": processed,
-            "chunk_json_exists": chunk_json.exists(),
-            "faiss_exists": faiss_file.exists() if faiss_file else False
+            "processed": chunk_json_exists and faiss_exists,
+            "chunk_json_exists": chunk_json_exists,
+            "faiss_exists": faiss_exists
         })
     
-    return {
-        "total": len(documents),
-        "documents": documents
-    }
+    return documents
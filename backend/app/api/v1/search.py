@@ -3,7 +3,7 @@
 """
 import logging
 import time
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 from app.services.pipeline import RAGPipeline
@@ -12,14 +12,13 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1", tags=["search"])
 
-# 使用单例或依赖注入
-_pipeline = None
-
-def get_pipeline():
-    global _pipeline
-    if _pipeline is None:
-        _pipeline = RAGPipeline()
-    return _pipeline
+def get_pipeline(request: Request) -> RAGPipeline:
+    """获取在应用启动时创建的 RAGPipeline 实例（未经 lifespan 启动时按需创建）"""
+    pipeline = getattr(request.app.state, "pipeline", None)
+    if pipeline is None:
+        pipeline = RAGPipeline()
+        request.app.state.pipeline = pipeline
+    return pipeline
 
 class SearchRequest(BaseModel):
     query: str
@@ -76,14 +75,20 @@ async def chat(request: ChatRequest, pipeline: RAGPipeline = Depends(get_pipelin
     - product_name: 可选的产品名称，用于过滤相关文档
     """
     start_time = time.time()
+    # 日志参数的拼接（切片、条件表达式）只在 INFO 级别启用时执行
+    log_info = logger.isEnabledFor(logging.INFO)
     
-    logger.info("=" * 80)
-    logger.info("收到 Chat 请求")
-    logger.info(f"查询内容: {request.query[:100]}..." if len(request.query) > 100 else f"查询内容: {request.query}")
-    logger.info(f"搜索模式: {request.search_mode} ({'纯向量搜索' if request.search_mode == 1 else '混合检索+rerank'})")
-    logger.info(f"大模型: {request.llm_model} ({'qwen-max' if request.llm_model == 1 else 'qwen-plus' if request.llm_model == 2 else 'qwen-turbo'})")
-    logger.info(f"产品名称: {request.product_name or '未指定'}")
-    logger.info(f"历史记录数: {len(request.history) if request.history else 0}")
+    if log_info:
+        logger.info("=" * 80)
+        logger.info("收到 Chat 请求")
+        if len(request.query) > 100:
+            logger.info("查询内容: %s...", request.query[:100])
+        else:
+            logger.info("查询内容: %s", request.query)
+        logger.info("搜索模式: %s (%s)", request.search_mode, '纯向量搜索' if request.search_mode == 1 else '混合检索+rerank')
+        logger.info("大模型: %s (%s)", request.llm_model, 'qwen-max' if request.llm_model == 1 else 'qwen-plus' if request.llm_model == 2 else 'qwen-turbo')
+        logger.info("产品名称: %s", request.product_name or '未指定')
+        logger.info("历史记录数: %d", len(request.history) if request.history else 0)
     
     try:
         result = await pipeline.answer(
@@ -94,12 +99,12 @@ async def chat(request: ChatRequest, pipeline: RAGPipeline = Depends(get_pipelin
             product_name=request.product_name
         )
         
-        elapsed_time = time.time() - start_time
-        logger.info(f"请求处理完成，耗时: {elapsed_time:.2f}秒")
-        logger.info(f"返回答案长度: {len(result.get('answer', ''))} 字符")
-        logger.info(f"引用页码数: {len(result.get('citations', []))}")
-        logger.info(f"来源文档数: {len(result.get('sources', []))}")
-        logger.info("=" * 80)
+        if log_info:
+            logger.info("请求处理完成，耗时: %.2f秒", time.time() - start_time)
+            logger.info("返回答案长度: %d 字符", len(result.get('answer', '')))
+            logger.info("引用页码数: %d", len(result.get('citations', [])))
+            logger.info("来源文档数: %d", len(result.get('sources', [])))
+            logger.info("=" * 80)
         
         return ChatResponse(
             answer=result["answer"],
@@ -108,9 +113,8 @@ async def chat(request: ChatRequest, pipeline: RAGPipeline = Depends(get_pipelin
             sources=result["sources"]
         )
     except Exception as e:
-        elapsed_time = time.time() - start_time
-        logger.error(f"处理请求时发生错误，耗时: {elapsed_time:.2f}秒")
-        logger.error(f"错误信息: {str(e)}", exc_info=True)
+        logger.error("处理请求时发生错误，耗时: %.2f秒", time.time() - start_time)
+        logger.error("错误信息: %s", e, exc_info=True)
         logger.info("=" * 80)
         raise
 
@@ -1,11 +1,15 @@
 """
 FastAPI 应用入口
 """
+import asyncio
 import logging
 import sys
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.v1 import search, documents
+from app.services.document_processor import DocumentProcessor
+from app.services.pipeline import RAGPipeline
 
 # 配置日志
 logging.basicConfig(
@@ -21,10 +25,40 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logging.getLogger("httpcore").setLevel(logging.WARNING)
 
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期：启动时预先构建服务实例
+    
+    DocumentProcessor / RAGPipeline 的初始化会加载 tiktoken 编码、索引和各类客户端，
+    放在启动阶段完成，避免第一个请求承担数秒的初始化开销。
+    """
+    logger.info("[Main] 初始化 DocumentProcessor 与 RAGPipeline...")
+    app.state.processor = DocumentProcessor()
+    app.state.pipeline = RAGPipeline()
+    # BM25 索引（分词 / 读取缓存）在后台线程中预热，不阻塞服务启动；预热完成前的混合检索会等待其完成
+    app.state.bm25_warmup = asyncio.create_task(
+        asyncio.to_thread(app.state.pipeline.retrieval_service.ensure_bm25)
+    )
+    logger.info("[Main] 服务初始化完成")
+    yield
+    # 等待预热线程结束后再关闭服务；线程无法被取消，不等待的话它会在关闭后继续使用检索服务
+    try:
+        await app.state.bm25_warmup
+    except Exception as e:
+        logger.warning(f"[Main] BM25 索引预热失败: {e}")
+    app.state.processor.shutdown()
+    await app.state.pipeline.aclose()
+
+
 app = FastAPI(
     title="RAG Search API",
     version="1.0.0",
-    description="基于 RAG 的需求文档检索服务"
+    description="基于 RAG 的需求文档检索服务",
+    lifespan=lifespan
 )
 
 # 配置 CORS（跨域资源共享）
@@ -5,9 +5,9 @@
 参考 RAG-cy/src/text_splitter.py 的实现方式。
 """
 
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Iterator
+import os
 import uuid
-import json
 from pathlib import Path
 import tiktoken
 
@@ -16,6 +16,7 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from app.models.document import Document
 from app.models.chunk import Chunk
 from app.utils.hash_utils import calculate_text_sha1
+from app.utils.json_utils import write_json
 
 
 class DocumentChunker:
@@ -28,16 +29,44 @@ class DocumentChunker:
             chunk_overlap: chunk 之间重叠的 token 数，默认 50（参考 RAG-cy）
             model_name: 用于 tokenizer 的模型名称，默认 "gpt-4o"（参考 RAG-cy）
         """
-        # 使用 RecursiveCharacterTextSplitter.from_tiktoken_encoder 进行智能分割
-        # 优先按段落（\n\n）、换行（\n）、空格（ ）分割，尽量保持语义完整性
-        self.splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name=model_name,
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap
-        )
         self.model_name = model_name
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
+        # 重叠区域的近似字符数（1 token ≈ 4 字符），用于限定 chunk 起点的搜索窗口
+        self._approx_overlap_chars = chunk_overlap * 4
+        
+        # 只解析一次 tokenizer 编码，避免每个 chunk 都做 registry 查找
+        self._encoding_name = self._resolve_encoding_name(model_name)
+        try:
+            self._encoding = tiktoken.get_encoding(self._encoding_name)
+        except Exception:
+            self._encoding = None
+        
+        # 使用 RecursiveCharacterTextSplitter 进行智能分割，长度函数复用上面缓存的编码
+        # 优先按段落（\n\n）、换行（\n）、空格（ ）分割，尽量保持语义完整性
+        self.splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            length_function=self._token_length,
+            separators=["\n\n", "\n", " ", ""]
+        )
+
+    def _token_length(self, text: str) -> int:
+        """splitter 使用的长度函数：token 数（编码不可用时按 1 token ≈ 4 字符估算）"""
+        if self._encoding is None:
+            return len(text) // 4
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    @staticmethod
+    def _resolve_encoding_name(model_name: str) -> str:
+        """
+        根据 model_name 选择对应的 tiktoken 编码：
+        - gpt-4o 使用 "o200k_base"
+        - gpt-3.5/gpt-4 使用 "cl100k_base"
+        """
+        if "gpt-4o" in model_name.lower():
+            return "o200k_base"
+        return "cl100k_base"
 
     def chunk_document(self, document: Document) -> List[Chunk]:
         """根据文档内容创建 chunk，优先保留分页信息"""
@@ -75,25 +104,28 @@ class DocumentChunker:
         if not split_texts:
             return []
 
+        split_texts = [chunk_text for chunk_text in split_texts if chunk_text.strip()]
+        # 一次批量计算所有 chunk 的 token 数量
+        token_counts = self.count_tokens_batch(split_texts)
+
+        # 一次性取出所有 chunk_id 所需的随机字节，避免每个 uuid4 都调用一次 os.urandom
+        random_bytes = os.urandom(16 * len(split_texts))
+
         result: List[Chunk] = []
         prev_end = 0
-        for chunk_text in split_texts:
-            if not chunk_text.strip():
-                continue
-
-            start = self._find_chunk_start(text, chunk_text, prev_end)
+        window = self._approx_overlap_chars * 2
+        for k, (chunk_text, length_tokens) in enumerate(zip(split_texts, token_counts)):
+            start = self._find_chunk_start(text, chunk_text, prev_end, window)
             end = start + len(chunk_text)
             prev_end = end
 
-            # 计算 token 数量
-            length_tokens = self.count_tokens(chunk_text)
-
+            # 字段均由本方法生成、类型已知，使用 model_construct 跳过逐个 chunk 的 Pydantic 校验
             result.append(
-                Chunk(
-                    chunk_id=str(uuid.uuid4()),
+                Chunk.model_construct(
+                    chunk_id=str(uuid.UUID(bytes=random_bytes[16 * k:16 * (k + 1)], version=4)),
                     document_name=document_name,
                     text=chunk_text,
-                    section_path=section_path,
+                    section_path=list(section_path),
                     position={"start": start, "end": end},
                     page_num=page_num,
                     metadata={
@@ -108,10 +140,18 @@ class DocumentChunker:
         return result
 
     @staticmethod
-    def _find_chunk_start(text: str, chunk_text: str, prev_end: int) -> int:
-        """尝试从上一个 chunk 位置上下浮动寻找 chunk 的真实起点"""
-        search_start = max(0, prev_end - len(chunk_text))
-        start = text.find(chunk_text, search_start)
+    def _find_chunk_start(text: str, chunk_text: str, prev_end: int, window: int) -> int:
+        """
+        尝试从上一个 chunk 位置上下浮动寻找 chunk 的真实起点
+        
+        切分结果是连续的（仅有重叠），真实起点应在 prev_end 附近，
+        因此先只在 [prev_end - window, prev_end + window] 窗口内查找；
+        未命中时（如重叠超出预估）再回退到原先的无界查找。
+        """
+        search_start = max(0, prev_end - window)
+        start = text.find(chunk_text, search_start, prev_end + window + len(chunk_text))
+        if start == -1:
+            start = text.find(chunk_text, max(0, prev_end - len(chunk_text)))
         if start == -1:
             start = prev_end
         return start
@@ -128,31 +168,67 @@ class DocumentChunker:
         Returns:
             chunks 列表，每个 chunk 包含 lines 和 text 字段
         """
+        return list(self.iter_markdown_chunks(md_path, chunk_size, chunk_overlap))
+    
+    def iter_markdown_chunks(
+        self,
+        md_path: str,
+        chunk_size: int = 30,
+        chunk_overlap: int = 5
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        逐个生成 Markdown 文件的 chunk（chunk_markdown_file 的生成器版本）
+        
+        下游可以在切分尚未结束时就开始处理已产生的 chunk。
+        
+        Args:
+            md_path: Markdown 文件路径
+            chunk_size: 每个分块的最大行数（默认 30）
+            chunk_overlap: 分块重叠行数（默认 5）
+            
+        Yields:
+            包含 lines 和 text 字段的 chunk
+        """
         md_path = Path(md_path)
         if not md_path.exists():
             raise FileNotFoundError(f"Markdown 文件不存在: {md_path}")
         
-        with open(md_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        # 一次性读入整个文件，按行起始偏移量切片，避免逐行创建字符串对象
+        data = md_path.read_text(encoding='utf-8')
+        line_starts = self._line_starts(data)
         
-        chunks = []
         i = 0
-        total_lines = len(lines)
+        total_lines = len(line_starts) - 1
         
         while i < total_lines:
             start_line = i + 1  # 行号从 1 开始
             end_line = min(i + chunk_size, total_lines)
-            chunk_text = ''.join(lines[i:end_line])
+            chunk_text = data[line_starts[i]:line_starts[end_line]]
             
             if chunk_text.strip():  # 跳过空 chunk
-                chunks.append({
+                yield {
                     'lines': [start_line, end_line],
                     'text': chunk_text
-                })
+                }
             
             i += chunk_size - chunk_overlap
+    
+    @staticmethod
+    def _line_starts(data: str) -> List[int]:
+        """
+        计算每一行的起始偏移量，末尾附加 len(data) 作为哨兵
         
-        return chunks
+        第 i 行（从 0 开始）对应 data[starts[i]:starts[i + 1]]，包含行尾换行符。
+        """
+        starts = [0]
+        find = data.find
+        pos = find('\n')
+        while pos != -1:
+            starts.append(pos + 1)
+            pos = find('\n', pos + 1)
+        if starts[-1] != len(data):
+            starts.append(len(data))
+        return starts
     
     def count_tokens(self, text: str, encoding_name: Optional[str] = None) -> int:
         """
@@ -170,20 +246,48 @@ class DocumentChunker:
         Returns:
             token 数量
         """
-        if encoding_name is None:
-            # 根据 model_name 选择编码
-            if "gpt-4o" in self.model_name.lower():
-                encoding_name = "o200k_base"
-            else:
-                encoding_name = "cl100k_base"
+        if encoding_name is None or encoding_name == self._encoding_name:
+            encoding = self._encoding
+        else:
+            try:
+                encoding = tiktoken.get_encoding(encoding_name)
+            except Exception:
+                encoding = None
         
+        if encoding is None:
+            # 如果编码不存在，使用简单估算（1 token ≈ 4 字符）
+            return len(text) // 4
         try:
-            encoding = tiktoken.get_encoding(encoding_name)
-            return len(encoding.encode(text))
+            return len(encoding.encode(text, disallowed_special=()))
         except Exception:
-            # 如果编码不存在，使用简单估算（1 token ≈ 4 字符）
             return len(text) // 4
     
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """
+        批量统计多段文本的 token 数量
+        
+        使用 encode_batch 在多个线程中编码（tiktoken 编码时会释放 GIL）。
+        
+        Args:
+            texts: 文本列表
+            
+        Returns:
+            与 texts 一一对应的 token 数量列表
+        """
+        if not texts:
+            return []
+        if self._encoding is None:
+            return [len(text) // 4 for text in texts]
+        try:
+            encoded = self._encoding.encode_batch(
+                texts,
+                num_threads=os.cpu_count() or 1,
+                disallowed_special=()
+            )
+            return [len(tokens) for tokens in encoded]
+        except Exception:
+            return [self.count_tokens(text) for text in texts]
+    
     def save_chunks_to_json(
         self,
         chunks: List[Dict[str, Any]],
@@ -208,6 +312,30 @@ class DocumentChunker:
         output_path = Path(output_path)
         output_path.parent.mkdir(parents=True, exist_ok=True)
         
+        # 保存 JSON 文件（orjson 直接生成 bytes 写入）
+        write_json(output_path, self.build_chunk_report(chunks, file_name, sha1, company_name))
+        
+        return str(output_path)
+    
+    @staticmethod
+    def build_chunk_report(
+        chunks: List[Dict[str, Any]],
+        file_name: str,
+        sha1: Optional[str] = None,
+        company_name: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        构建符合 RAG-cy 格式的 chunk 报告（即 chunk JSON 文件的内容）
+        
+        Args:
+            chunks: chunks 列表，每个包含 lines 和 text 字段
+            file_name: 原始文件名
+            sha1: SHA1 哈希值，如果为 None 则基于 chunks 内容计算
+            company_name: 公司名称（可选）
+            
+        Returns:
+            {"metainfo": {...}, "content": {"chunks": [...]}}
+        """
         # 如果没有提供 SHA1，基于所有 chunks 的文本内容计算
         if sha1 is None:
             all_text = ''.join(chunk['text'] for chunk in chunks)
@@ -222,18 +350,36 @@ class DocumentChunker:
             metainfo["company_name"] = company_name
         
         # 构建符合 RAG-cy 格式的 JSON
-        result = {
+        return {
             "metainfo": metainfo,
             "content": {
                 "chunks": chunks
             }
         }
+    
+    def chunk_markdown(
+        self,
+        md_path: str,
+        chunk_size: int = 30,
+        chunk_overlap: int = 5,
+        sha1: Optional[str] = None,
+        company_name: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        从 Markdown 文件切分，直接返回内存中的 chunk 报告（不写文件）
         
-        # 保存 JSON 文件
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(result, f, ensure_ascii=False, indent=2)
-        
-        return str(output_path)
+        Args:
+            md_path: Markdown 文件路径
+            chunk_size: 每个分块的最大行数
+            chunk_overlap: 分块重叠行数
+            sha1: SHA1 哈希值（可选）
+            company_name: 公司名称（可选）
+            
+        Returns:
+            与 chunk JSON 文件内容相同的报告字典
+        """
+        chunks = self.chunk_markdown_file(md_path, chunk_size, chunk_overlap)
+        return self.build_chunk_report(chunks, Path(md_path).name, sha1, company_name)
     
     def chunk_markdown_and_save(
         self,
@@ -243,7 +389,7 @@ class DocumentChunker:
         chunk_overlap: int = 5,
         sha1: Optional[str] = None,
         company_name: Optional[str] = None
-    ) -> str:
+    ) -> Tuple[str, int]:
         """
         从 Markdown 文件切分并保存为 JSON（便捷方法）
         
@@ -256,15 +402,10 @@ class DocumentChunker:
             company_name: 公司名称（可选）
             
         Returns:
-            保存的文件路径
+            (保存的文件路径, chunk 数量)
         """
-        chunks = self.chunk_markdown_file(md_path, chunk_size, chunk_overlap)
-        file_name = Path(md_path).name
-        
-        return self.save_chunks_to_json(
-            chunks=chunks,
-            output_path=output_path,
-            file_name=file_name,
-            sha1=sha1,
-            company_name=company_name
-        )
\ No newline at end of file
+        report = self.chunk_markdown(md_path, chunk_size, chunk_overlap, sha1, company_name)
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        write_json(output_path, report)
+        return str(output_path), len(report["content"]["chunks"])
\ No newline at end of file
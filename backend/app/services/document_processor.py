@@ -2,17 +2,20 @@
 文档处理服务
 处理单个 PDF 文件的完整流程：转换 → Chunk → Embedding → 存储向量数据库
 """
-from typing import Dict, Optional
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
 from pathlib import Path
-import json
-import tempfile
-import shutil
 
-from app.services.pdf_to_markdown import PDFToMarkdownService
-from app.services.chunking import DocumentChunker
+import numpy as np
+
 from app.services.vector_db import VectorDBService
-from app.services.embedding import EmbeddingService
-from app.utils.hash_utils import calculate_file_sha1
+from app.services.embedding import MAX_BATCH_SIZE
+from app.services.registry import get_chunker, get_embedding_service, get_pdf_to_markdown
+from app.services.embedding_batcher import EmbeddingBatcher
+from app.utils.hash_utils import calculate_file_sha1_cached
+from app.utils.fs_utils import write_file_atomic
 from app.services.pipeline import PipelinePaths
 
 
@@ -27,10 +30,130 @@ class DocumentProcessor:
             paths: 路径配置对象，如果为 None 则使用默认路径
         """
         self.paths = paths or PipelinePaths()
-        self.pdf_to_markdown = PDFToMarkdownService()
-        self.chunker = DocumentChunker()
-        self.embedding_service = EmbeddingService()
-        self.vector_db = VectorDBService(self.embedding_service)
+        self.pdf_to_markdown = get_pdf_to_markdown()
+        self.chunker = get_chunker()
+        self.embedding_service = get_embedding_service()
+        # 连续上传多个 PDF 时，通过批处理队列合并各文档的 embedding 请求
+        self.embedding_batcher = EmbeddingBatcher(self.embedding_service)
+        self.vector_db = VectorDBService(self.embedding_service, self.embedding_batcher)
+        
+        # PDF 解析是 CPU 密集型任务：PDF_PROCESS_WORKERS > 0 时使用进程池绕过 GIL 并行转换，
+        # 否则在线程中执行，至少不阻塞事件循环
+        pdf_workers = int(os.getenv("PDF_PROCESS_WORKERS", "0"))
+        self._pdf_pool = ProcessPoolExecutor(max_workers=pdf_workers) if pdf_workers > 0 else None
+    
+    def shutdown(self):
+        """释放进程池资源"""
+        if self._pdf_pool is not None:
+            self._pdf_pool.shutdown(wait=False, cancel_futures=True)
+            self._pdf_pool = None
+    
+    async def _convert_pdf_to_markdown(self, pdf_path: Path) -> str:
+        """
+        在事件循环之外执行 PDF → Markdown 转换
+        
+        Args:
+            pdf_path: PDF 文件路径
+            
+        Returns:
+            Markdown 文件路径
+        """
+        return await self.pdf_to_markdown.aconvert_pdf_to_markdown(
+            str(pdf_path),
+            str(self.paths.markdown_dir),
+            executor=self._pdf_pool
+        )
+    
+    async def _chunk_and_index(
+        self,
+        md_path: str,
+        chunk_json_path: Path,
+        sha1: str,
+        company_name: Optional[str],
+        chunk_size: int,
+        chunk_overlap: int
+    ) -> Tuple[int, str]:
+        """
+        流水线执行切分与向量化
+        
+        切分在工作线程中逐个产生 chunk 并放入队列；主协程每攒够一组
+        （MAX_BATCH_SIZE × embedding 并发数）就提交一个 embedding 任务，
+        使网络请求与切分同时进行。全部完成后保存 chunk JSON 与 FAISS 索引。
+        
+        Args:
+            md_path: Markdown 文件路径
+            chunk_json_path: chunk JSON 输出路径
+            sha1: 文档 SHA1
+            company_name: 公司名称（可选）
+            chunk_size: 每个 chunk 的最大行数
+            chunk_overlap: chunk 之间的重叠行数
+            
+        Returns:
+            (chunk 数量, FAISS 索引文件路径)
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        group_size = MAX_BATCH_SIZE * self.embedding_service.concurrency
+        
+        def produce():
+            try:
+                for chunk in self.chunker.iter_markdown_chunks(md_path, chunk_size, chunk_overlap):
+                    loop.call_soon_threadsafe(queue.put_nowait, chunk)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+        
+        producer = asyncio.ensure_future(asyncio.to_thread(produce))
+        chunks: List[Dict] = []
+        chunk_ids: List[str] = []
+        pending_texts: List[str] = []
+        embed_tasks: List[asyncio.Future] = []
+        
+        def submit(texts: List[str]):
+            embed_tasks.append(asyncio.ensure_future(self.vector_db.embed_texts(texts)))
+        
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None:
+                    break
+                texts, ids = self.vector_db.extract_texts([chunk], sha1, start_index=len(chunks))
+                chunks.append(chunk)
+                pending_texts.extend(texts)
+                chunk_ids.extend(ids)
+                if len(pending_texts) >= group_size:
+                    submit(pending_texts)
+                    pending_texts = []
+            
+            # 切分线程中的异常在此抛出
+            await producer
+            if pending_texts:
+                submit(pending_texts)
+            if not chunk_ids:
+                raise ValueError(f"chunk JSON 文件 {chunk_json_path} 中没有有效的文本块")
+            
+            await asyncio.to_thread(
+                self.chunker.save_chunks_to_json,
+                chunks=chunks,
+                output_path=str(chunk_json_path),
+                file_name=Path(md_path).name,
+                sha1=sha1,
+                company_name=company_name
+            )
+            
+            embeddings = np.concatenate(await asyncio.gather(*embed_tasks))
+        except BaseException:
+            for task in embed_tasks:
+                task.cancel()
+            raise
+        
+        faiss_path = await asyncio.to_thread(
+            self.vector_db.save_index,
+            embeddings,
+            chunk_ids,
+            sha1,
+            self.paths.vector_dbs_dir
+        )
+        return len(chunks), faiss_path
     
     async def process_pdf_file(
         self,
@@ -76,36 +199,23 @@ class DocumentProcessor:
         
         try:
             # 计算 PDF 的 SHA1
-            pdf_sha1 = calculate_file_sha1(pdf_path)
+            pdf_sha1 = await asyncio.to_thread(calculate_file_sha1_cached, pdf_path)
             
             # 步骤 1: PDF → Markdown
-            md_path = self.pdf_to_markdown.convert_pdf_to_markdown(
-                str(pdf_path),
-                str(self.paths.markdown_dir)
-            )
+            md_path = await self._convert_pdf_to_markdown(pdf_path)
             
-            # 步骤 2: Markdown → Chunks (保存为 JSON)
+            # 步骤 2 + 3: Markdown → Chunks (保存为 JSON) → Embeddings → FAISS
+            # 两个阶段流水线执行：切分过程中已产生的 chunk 会立即开始生成 embedding
             chunk_json_path = self.paths.chunked_reports_dir / f"{pdf_path.stem}.json"
-            self.chunker.chunk_markdown_and_save(
+            chunk_count, faiss_path = await self._chunk_and_index(
                 md_path=str(md_path),
-                output_path=str(chunk_json_path),
+                chunk_json_path=chunk_json_path,
                 sha1=pdf_sha1,
                 company_name=company_name,
                 chunk_size=chunk_size,
                 chunk_overlap=chunk_overlap
             )
             
-            # 读取 chunk 数量
-            with open(chunk_json_path, 'r', encoding='utf-8') as f:
-                chunk_data = json.load(f)
-            chunk_count = len(chunk_data['content']['chunks'])
-            
-            # 步骤 3: Chunks → Embeddings → FAISS
-            faiss_path = await self.vector_db.process_chunk_json(
-                chunk_json_path=str(chunk_json_path),
-                output_dir=str(self.paths.vector_dbs_dir)
-            )
-            
             return {
                 "success": True,
                 "message": "文档处理成功",
@@ -149,15 +259,11 @@ class DocumentProcessor:
         Returns:
             处理结果字典
         """
-        # 创建临时文件保存上传的内容
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-            tmp_file.write(file_content)
-            tmp_path = tmp_file.name
-        
         try:
-            # 将文件移动到 documents 目录
+            # 先写入 documents 目录下的临时文件，再通过 os.replace 原子重命名：
+            # 同一文件系统内不发生数据拷贝，且不会出现写了一半的 PDF
             pdf_path = self.paths.documents_dir / file_name
-            shutil.move(tmp_path, pdf_path)
+            await asyncio.to_thread(write_file_atomic, pdf_path, file_content)
             
             # 处理文件
             result = await self.process_pdf_file(
@@ -170,10 +276,6 @@ class DocumentProcessor:
             return result
             
         except Exception as e:
-            # 清理临时文件
-            if Path(tmp_path).exists():
-                Path(tmp_path).unlink()
-            
             import traceback
             error_traceback = traceback.format_exc()
             return {
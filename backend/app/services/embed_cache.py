@@ -0,0 +1,93 @@
+"""
+Embedding 持久化缓存
+以 sha256(模型名 + 文本) 为键，将文档向量以 float16 存入 SQLite，
+重复入库相同文档（或相同的页眉、模板段落）时无需再次调用 Embedding API
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# SQLite 单条语句的参数个数上限（旧版本为 999）
+_MAX_SQL_VARIABLES = 900
+
+
+class EmbedCache:
+    """基于 SQLite（WAL 模式）的 embedding 缓存"""
+
+    def __init__(self, path: Union[str, Path]):
+        """
+        打开（或创建）缓存数据库
+
+        Args:
+            path: SQLite 数据库文件路径
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # 连接在线程池中共享使用，由 _lock 串行化访问
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS emb (key BLOB PRIMARY KEY, vec BLOB NOT NULL) WITHOUT ROWID"
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> bytes:
+        """计算缓存键：sha256(模型名 + 文本)"""
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """
+        批量查询缓存
+
+        Args:
+            keys: 缓存键列表
+
+        Returns:
+            命中的 键 → float32 向量
+        """
+        found: Dict[bytes, np.ndarray] = {}
+        with self._lock:
+            for i in range(0, len(keys), _MAX_SQL_VARIABLES):
+                part = keys[i:i + _MAX_SQL_VARIABLES]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM emb WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, vec in rows:
+                    found[key] = np.frombuffer(vec, dtype=np.float16).astype(np.float32)
+        return found
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+        """
+        批量写入缓存（float16 存储，单个事务提交）
+
+        Args:
+            keys: 缓存键列表
+            vectors: 与 keys 对应的向量矩阵 (N, D)
+        """
+        if not keys:
+            return
+        vectors = np.asarray(vectors, dtype=np.float16)
+        rows = [(key, vectors[i].tobytes()) for i, key in enumerate(keys)]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO emb (key, vec) VALUES (?, ?)", rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
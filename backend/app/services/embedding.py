@@ -3,14 +3,33 @@ Embedding 服务
 使用 Qwen Embedding v3 生成向量
 """
 import os
+import time
+import random
 import asyncio
-from typing import List
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+import numpy as np
+import requests
 import dashscope
 from dashscope import TextEmbedding
 from dotenv import load_dotenv
 
+from app.services.embed_cache import EmbedCache
+from app.utils.cache_utils import LRUCache
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 10  # DashScope API 批量限制（实际限制为10）
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}  # 限流与服务端临时错误可重试
+
+
+class RetryableEmbeddingError(RuntimeError):
+    """可重试的 Embedding 调用错误（限流、服务端 5xx、空响应）"""
+
 class EmbeddingService:
     """Embedding 服务类，使用 DashScope API 调用通义千问 Embedding 模型（支持异步）"""
     
@@ -20,111 +39,277 @@ class EmbeddingService:
             raise ValueError("未找到 QWEN_API_KEY 或 DASHSCOPE_API_KEY 环境变量")
         dashscope.api_key = self.api_key
         self.model = os.getenv("EMBEDDING_MODEL", "text-embedding-v3")
+        # 批次并发数：embedding 调用是网络 I/O 密集型，N 个并发请求可将耗时降至约 T/N（受限于 API 限流）
+        self.concurrency = max(1, int(os.getenv("EMBEDDING_CONCURRENCY", "8")))
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency,
+            thread_name_prefix="embedding"
+        )
+        # 查询向量缓存：以少量内存（约 4KB/条）换取重复查询时省去一次 API 往返
+        self._query_cache = LRUCache(maxsize=int(os.getenv("EMBEDDING_QUERY_CACHE_SIZE", "4096")))
+        self._query_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        # 文档向量持久化缓存（SQLite），EMBEDDING_CACHE_PATH 为空时关闭
+        cache_path = os.getenv("EMBEDDING_CACHE_PATH", "./data/cache/embeddings.sqlite3")
+        self._doc_cache: Optional[EmbedCache] = EmbedCache(cache_path) if cache_path else None
+        # 单个批次的重试次数与退避时间范围（秒），退避为带随机抖动的指数退避
+        self.max_retries = max(0, int(os.getenv("EMBEDDING_MAX_RETRIES", "4")))
+        self.retry_min_wait = float(os.getenv("EMBEDDING_RETRY_MIN_WAIT", "0.5"))
+        self.retry_max_wait = float(os.getenv("EMBEDDING_RETRY_MAX_WAIT", "8"))
     
-    def _embed_sync(self, texts: List[str]) -> List[List[float]]:
+    @staticmethod
+    def _split_batches(texts: List[str]) -> List[List[str]]:
         """
-        同步调用 DashScope API 生成 embedding
+        过滤空文本并按 DashScope 批量限制切分
         
         Args:
             texts: 文本列表
             
         Returns:
-            embedding 向量列表
+            批次列表
         """
-        if not texts:
-            return []
-        
-        # 过滤空文本
         valid_texts = [t for t in texts if t and t.strip()]
-        if not valid_texts:
-            return []
+        return [valid_texts[i:i+MAX_BATCH_SIZE] for i in range(0, len(valid_texts), MAX_BATCH_SIZE)]
+    
+    def _call_one_batch(self, batch: List[str]) -> np.ndarray:
+        """
+        调用 DashScope API 处理单个批次，遇到限流/5xx/网络错误时按指数退避重试
         
-        embeddings = []
-        MAX_BATCH_SIZE = 10  # DashScope API 批量限制（实际限制为10）
+        Args:
+            batch: 单个批次的文本列表（不超过 MAX_BATCH_SIZE）
+            
+        Returns:
+            该批次的 embedding 矩阵，形状为 (len(batch), D)，dtype=float32
+        """
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    return self._request_batch(batch)
+                except (RetryableEmbeddingError, requests.RequestException) as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    delay = self._backoff_delay(attempt)
+                    logger.warning(f"[Embedding] 批次调用失败，{delay:.2f}s 后重试 ({attempt + 1}/{self.max_retries}): {e}")
+                    time.sleep(delay)
+        except Exception as e:
+            raise Exception(f"生成 Embedding 失败: {str(e)}")
+    
+    def _backoff_delay(self, attempt: int) -> float:
+        """
+        计算第 attempt 次重试前的等待时间（full jitter 指数退避）
         
-        # 分批处理
-        for i in range(0, len(valid_texts), MAX_BATCH_SIZE):
-            batch = valid_texts[i:i+MAX_BATCH_SIZE]
+        Args:
+            attempt: 已失败的次数（从 0 开始）
             
-            try:
-                resp = TextEmbedding.call(
-                    model=TextEmbedding.Models.text_embedding_v3,
-                    input=batch
-                )
-                
-                # 检查响应是否成功
-                if resp is None:
-                    raise RuntimeError("DashScope API返回None")
-                
-                # 检查状态码
-                if hasattr(resp, 'status_code') and resp.status_code != 200:
-                    error_msg = getattr(resp, 'message', 'Unknown error')
-                    raise RuntimeError(f"DashScope API调用失败: status_code={resp.status_code}, message={error_msg}")
-                
-                # 处理响应
-                if 'output' in resp and resp['output'] and 'embeddings' in resp['output']:
-                    for emb in resp['output']['embeddings']:
-                        if emb.get('embedding') and len(emb['embedding']) > 0:
-                            embeddings.append(emb['embedding'])
-                        else:
-                            raise RuntimeError(f"DashScope返回的embedding为空，text_index={emb.get('text_index', None)}")
-                elif 'output' in resp and resp['output'] and 'embedding' in resp['output']:
-                    # 单条输入的情况
-                    if resp['output']['embedding'] and len(resp['output']['embedding']) > 0:
-                        embeddings.append(resp['output']['embedding'])
-                    else:
-                        raise RuntimeError("DashScope返回的embedding为空")
+        Returns:
+            等待秒数，位于 [retry_min_wait, retry_max_wait] 区间
+        """
+        upper = min(self.retry_max_wait, self.retry_min_wait * (2 ** attempt))
+        return max(self.retry_min_wait, random.uniform(0, upper))
+    
+    def _request_batch(self, batch: List[str]) -> np.ndarray:
+        """
+        发送单次 DashScope 请求并解析结果
+        
+        Args:
+            batch: 单个批次的文本列表
+            
+        Returns:
+            该批次的 embedding 矩阵，dtype=float32
+        """
+        embeddings = []
+        resp = TextEmbedding.call(
+            model=TextEmbedding.Models.text_embedding_v3,
+            input=batch
+        )
+        
+        # 检查响应是否成功
+        if resp is None:
+            raise RetryableEmbeddingError("DashScope API返回None")
+        
+        # 检查状态码
+        if hasattr(resp, 'status_code') and resp.status_code != 200:
+            error_msg = getattr(resp, 'message', 'Unknown error')
+            error_cls = RetryableEmbeddingError if resp.status_code in RETRYABLE_STATUS_CODES else RuntimeError
+            raise error_cls(f"DashScope API调用失败: status_code={resp.status_code}, message={error_msg}")
+        
+        # 处理响应
+        if 'output' in resp and resp['output'] and 'embeddings' in resp['output']:
+            for emb in resp['output']['embeddings']:
+                if emb.get('embedding') and len(emb['embedding']) > 0:
+                    embeddings.append(emb['embedding'])
                 else:
-                    raise RuntimeError(f"DashScope embedding API返回格式异常: {resp}")
-                    
-            except Exception as e:
-                raise Exception(f"生成 Embedding 失败: {str(e)}")
+                    raise RuntimeError(f"DashScope返回的embedding为空，text_index={emb.get('text_index', None)}")
+        elif 'output' in resp and resp['output'] and 'embedding' in resp['output']:
+            # 单条输入的情况
+            if resp['output']['embedding'] and len(resp['output']['embedding']) > 0:
+                embeddings.append(resp['output']['embedding'])
+            else:
+                raise RuntimeError("DashScope返回的embedding为空")
+        else:
+            raise RuntimeError(f"DashScope embedding API返回格式异常: {resp}")
         
-        return embeddings
+        # 直接解析为连续的 float32 矩阵，避免下游再从 Python float 列表重新打包
+        return np.asarray(embeddings, dtype=np.float32)
     
-    async def embed_query(self, query: str) -> List[float]:
+    @staticmethod
+    def _stack_batches(batch_results, total: int, rows: Optional[np.ndarray] = None) -> np.ndarray:
         """
-        对查询文本生成 embedding (异步)
+        将各批次结果写入预分配的 float32 矩阵
         
         Args:
-            query: 查询文本
+            batch_results: 按批次顺序排列的 embedding 矩阵（可迭代）
+            total: 总行数
+            rows: 可选，拼接顺序中第 i 行在输出矩阵中的行号；
+                提供时各批次直接写到目标位置，无需先拼接再整体重排（省去一个 (N, D) 的中间矩阵）
             
         Returns:
-            embedding 向量
+            形状为 (total, D) 的 float32 矩阵
         """
-        # 使用线程池执行同步调用
-        loop = asyncio.get_event_loop()
-        embeddings = await loop.run_in_executor(
-            None, 
-            self._embed_sync, 
-            [query]
+        out = None
+        offset = 0
+        for batch_embeddings in batch_results:
+            if out is None:
+                out = np.empty((total, batch_embeddings.shape[1]), dtype=np.float32)
+            if rows is None:
+                out[offset:offset + len(batch_embeddings)] = batch_embeddings
+            else:
+                out[rows[offset:offset + len(batch_embeddings)]] = batch_embeddings
+            offset += len(batch_embeddings)
+        
+        if out is None:
+            return np.empty((0, 0), dtype=np.float32)
+        if rows is not None and offset != total:
+            raise ValueError(f"embedding 返回行数({offset})与文本数({total})不一致")
+        return out[:offset]
+    
+    def _embed_sync(self, texts: List[str]) -> np.ndarray:
+        """
+        同步调用 DashScope API 生成 embedding，各批次在线程池中并发请求
+        
+        Args:
+            texts: 文本列表
+            
+        Returns:
+            embedding 矩阵 (N, D)，float32，与过滤空文本后的输入顺序一致
+        """
+        batches = self._split_batches(texts) if texts else []
+        
+        # executor.map 按提交顺序返回结果，保证与输入顺序一致
+        return self._stack_batches(
+            self._executor.map(self._call_one_batch, batches),
+            sum(len(batch) for batch in batches)
         )
+    
+    async def embed_query(self, query: str) -> np.ndarray:
+        """
+        对查询文本生成 embedding (异步)
         
-        if not embeddings:
-            raise Exception("生成 Query Embedding 失败：返回结果为空")
+        结果按 (model, sha1(query)) 缓存在 LRU 中，重复查询直接命中缓存
         
-        return embeddings[0]
+        Args:
+            query: 查询文本
+            
+        Returns:
+            embedding 向量 (D,)，float32，只读（与缓存共享）
+        """
+        key = (self.model, hashlib.sha1(query.encode('utf-8')).hexdigest())
+        cached = self._query_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        # 同一查询并发到达时只请求一次，其余等待锁后直接读缓存
+        lock = self._query_locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                cached = self._query_cache.get(key)
+                if cached is not None:
+                    return cached
+                
+                # 使用线程池执行同步调用
+                loop = asyncio.get_event_loop()
+                embeddings = await loop.run_in_executor(
+                    None, 
+                    self._embed_sync, 
+                    [query]
+                )
+                
+                if len(embeddings) == 0:
+                    raise Exception("生成 Query Embedding 失败：返回结果为空")
+                
+                embedding = embeddings[0]
+                embedding.setflags(write=False)
+                self._query_cache.set(key, embedding)
+                return embedding
+        finally:
+            if not lock.locked():
+                self._query_locks.pop(key, None)
     
-    async def embed_documents(self, texts: List[str]) -> List[List[float]]:
+    async def embed_documents(self, texts: List[str]) -> np.ndarray:
         """
         批量对文档生成 embedding (异步)
         
+        各批次直接提交到线程池并发请求，结果按批次顺序拼接。
+        完全相同的文本（页眉、页脚、目录等模板内容）只请求一次，再按原顺序展开。
+        文本按长度排序后分批，结果再还原为输入顺序。
+        启用持久化缓存时，已缓存的文本直接读取，只为未命中的文本调用 API。
+        
         Args:
             texts: 文本列表
             
         Returns:
-            embedding 向量列表
+            embedding 矩阵 (N, D)，float32
         """
-        # 使用线程池执行同步调用
+        valid_texts = [t for t in texts if t and t.strip()] if texts else []
+        
+        # 文本 → 去重后的行号；inverse[i] 为第 i 条文本对应的行号
+        unique_rows: Dict[str, int] = {}
+        inverse = [unique_rows.setdefault(t, len(unique_rows)) for t in valid_texts]
+        unique_texts = list(unique_rows)
+        
+        cached: Dict[bytes, np.ndarray] = {}
+        if self._doc_cache is not None and unique_texts:
+            keys = [EmbedCache.make_key(self.model, t) for t in unique_texts]
+            cached = await asyncio.to_thread(self._doc_cache.get_many, keys)
+        miss_rows = [i for i, key in enumerate(keys) if key not in cached] if cached else range(len(unique_texts))
+        miss_texts = [unique_texts[i] for i in miss_rows]
+        # 按长度降序排列后再分批，使同一批次内的文本长度接近，减少服务端按最长文本填充的浪费
+        order = sorted(range(len(miss_texts)), key=lambda i: -len(miss_texts[i]))
+        batches = self._split_batches([miss_texts[i] for i in order])
+        
         loop = asyncio.get_event_loop()
-        embeddings = await loop.run_in_executor(
-            None,
-            self._embed_sync,
-            texts
+        batch_results = await asyncio.gather(*[
+            loop.run_in_executor(self._executor, self._call_one_batch, batch)
+            for batch in batches
+        ])
+        # 各批次按长度排序前的行号直接写回，得到 miss_texts 顺序的矩阵
+        embeddings = self._stack_batches(
+            batch_results,
+            sum(len(batch) for batch in batches),
+            rows=np.asarray(order, dtype=np.intp)
         )
         
-        if not embeddings:
+        if self._doc_cache is not None and len(embeddings):
+            miss_keys = [EmbedCache.make_key(self.model, t) for t in miss_texts]
+            try:
+                await asyncio.to_thread(self._doc_cache.put_many, miss_keys, embeddings)
+            except Exception as e:
+                logger.warning(f"[Embedding] 写入持久化缓存失败: {e}")
+        
+        if cached:
+            logger.info(f"[Embedding] 持久化缓存命中 {len(cached)}/{len(unique_texts)} 条文本")
+            merged = np.empty((len(unique_texts), next(iter(cached.values())).shape[0]), dtype=np.float32)
+            for i, key in enumerate(keys):
+                vector = cached.get(key)
+                if vector is not None:
+                    merged[i] = vector
+            if len(embeddings):
+                merged[np.asarray(miss_rows, dtype=np.intp)] = embeddings
+            embeddings = merged
+        
+        if len(embeddings) == 0:
             raise Exception("生成 Document Embedding 失败：返回结果为空")
         
+        if len(unique_rows) < len(valid_texts):
+            embeddings = embeddings[np.asarray(inverse, dtype=np.intp)]
+        
         return embeddings
-
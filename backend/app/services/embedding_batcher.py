@@ -0,0 +1,136 @@
+"""
+Embedding 批处理服务
+在短时间窗口内合并多个文档的 chunk，统一调用 Embedding API，
+使多个 PDF 连续上传时能共享 DashScope 的批量请求
+"""
+import os
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, List, Optional, Set, Tuple
+
+import numpy as np
+
+from app.services.embedding import EmbeddingService
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    动态批处理的 Embedding 队列
+
+    调用方通过 add() 提交文本并获得一个 Future；队列中累计的文本数达到 max_batch，
+    或距首次提交超过 flush_interval 毫秒时，合并为一次 embed_documents 调用，
+    再按提交顺序将结果切片返回给各调用方。
+    """
+
+    def __init__(
+        self,
+        embedding_service: EmbeddingService,
+        max_batch: Optional[int] = None,
+        flush_interval_ms: Optional[float] = None
+    ):
+        """
+        初始化批处理队列
+
+        Args:
+            embedding_service: Embedding 服务实例
+            max_batch: 触发立即提交的累计文本数，默认读取 EMBEDDING_BATCHER_MAX_BATCH（256）
+            flush_interval_ms: 最长等待时间（毫秒），默认读取 EMBEDDING_BATCHER_FLUSH_MS（50）
+        """
+        self.embedding_service = embedding_service
+        if max_batch is None:
+            max_batch = int(os.getenv("EMBEDDING_BATCHER_MAX_BATCH", "256"))
+        if flush_interval_ms is None:
+            flush_interval_ms = float(os.getenv("EMBEDDING_BATCHER_FLUSH_MS", "50"))
+        self.max_batch = max(1, max_batch)
+        self.flush_interval = max(0.0, flush_interval_ms) / 1000
+
+        self._pending: Deque[Tuple[List[str], asyncio.Future]] = deque()
+        self._pending_count = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    def add(self, texts: List[str]) -> "asyncio.Future[np.ndarray]":
+        """
+        提交一组文本，返回其 embedding 矩阵的 Future
+
+        Args:
+            texts: 文本列表
+
+        Returns:
+            Future，结果为形状 (len(texts), D) 的 float32 矩阵
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not texts:
+            future.set_result(np.empty((0, 0), dtype=np.float32))
+            return future
+
+        self._pending.append((list(texts), future))
+        self._pending_count += len(texts)
+
+        if self._pending_count >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._flush)
+
+        return future
+
+    def _flush(self):
+        """取出当前队列中的所有请求，提交一次合并的 embedding 任务"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        requests = list(self._pending)
+        self._pending.clear()
+        self._pending_count = 0
+
+        task = asyncio.get_running_loop().create_task(self._run_batch(requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, requests: List[Tuple[List[str], asyncio.Future]]):
+        """
+        执行合并后的 embedding 调用，并把结果分发给各调用方
+
+        Args:
+            requests: (文本列表, Future) 列表
+        """
+        all_texts = [text for texts, _ in requests for text in texts]
+        logger.info(f"[EmbeddingBatcher] 合并 {len(requests)} 个请求，共 {len(all_texts)} 条文本")
+
+        try:
+            embeddings = await self.embedding_service.embed_documents(all_texts)
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if len(embeddings) != len(all_texts):
+            # 空白文本会被 EmbeddingService 过滤，无法按位置切片，逐个请求单独处理
+            logger.warning(f"[EmbeddingBatcher] 返回向量数({len(embeddings)})与文本数({len(all_texts)})不一致，改为逐个请求处理")
+            await asyncio.gather(*(self._run_single(texts, future) for texts, future in requests))
+            return
+
+        offset = 0
+        for texts, future in requests:
+            if not future.done():
+                future.set_result(embeddings[offset:offset + len(texts)])
+            offset += len(texts)
+
+    async def _run_single(self, texts: List[str], future: asyncio.Future):
+        """单独为一个请求生成 embedding"""
+        try:
+            result = await self.embedding_service.embed_documents(texts)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result(result)
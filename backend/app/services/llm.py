@@ -2,14 +2,20 @@
 LLM 服务
 使用 Qwen API 进行文本生成，支持多模型选择
 """
+import asyncio
+import functools
 import logging
+import random
 import time
 import os
-from typing import Optional, List, Dict
+from typing import Any, AsyncIterator, Optional, List, Dict, Tuple, Union
 import dashscope
-from dashscope import AioGeneration
+import httpx
 from dotenv import load_dotenv
 
+from app.services.llm_cache import LLMResponseCache
+from app.utils.json_utils import loads as json_loads
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -21,64 +27,187 @@ MODEL_MAP = {
     3: "qwen-turbo"
 }
 
+
+@functools.lru_cache(maxsize=8)
+def get_model_name(model_id: int) -> str:
+    """
+    根据模型ID获取模型名称
+    
+    Args:
+        model_id: 模型ID (1, 2, 或 3)
+        
+    Returns:
+        模型名称字符串
+        
+    Raises:
+        ValueError: 如果model_id无效
+    """
+    if model_id not in MODEL_MAP:
+        raise ValueError(f"无效的模型ID: {model_id}，支持的值: 1=qwen-max, 2=qwen-plus, 3=qwen-turbo")
+    return MODEL_MAP[model_id]
+
+
+def _resolve_env_model() -> str:
+    """读取 QWEN_MODEL 环境变量，支持模型名或模型ID（数字字符串）"""
+    env_model = os.getenv("QWEN_MODEL", "qwen-plus")
+    if env_model.isdigit():
+        return get_model_name(int(env_model))
+    return env_model
+
+
+# 默认模型，导入时解析一次
+DEFAULT_MODEL = _resolve_env_model()
+
+# 提示词常量
+# DashScope 对 qwen-max/plus/turbo 自动启用前缀缓存（上下文缓存）：请求开头的 token 与近期请求
+# 完全一致时，这部分按缓存命中计费且首 token 延迟更低。为保证前缀字节稳定：
+# - 系统提示词与固定说明使用模块级常量，不做任何插值（不含时间戳、UUID、请求参数等）
+# - 变化的内容（查询、检索上下文）一律放在用户消息的末尾
+SYSTEM_PROMPT_DEFAULT = "你是一个专业的需求分析助手，请根据提供的上下文回答用户的问题。"
+SYSTEM_PROMPT_REWRITE = "你是一个搜索优化专家。"
+SYSTEM_PROMPT_SEARCH = """你是一个专业的需求分析助手。请基于提供的参考内容回答用户问题。
+要求：
+1. 必须严格基于参考内容回答，不要编造。
+2. 给出推理过程（thoughts）。
+3. 列出引用的页码（citations）。
+4. 输出必须是 JSON 格式，包含字段：answer, thoughts, citations。
+"""
+# 文本生成接口路径（拼接在 dashscope.base_http_api_url 之后）
+GENERATION_PATH = "/services/aigc/text-generation/generation"
+# 生成接口的固定参数，所有请求共用同一个对象（不要修改）
+GENERATION_PARAMETERS = {"result_format": "message"}
+# 流式生成：每个 SSE 事件只返回新增的文本片段
+STREAM_GENERATION_PARAMETERS = {"result_format": "message", "incremental_output": True}
+STREAM_HEADERS = {"X-DashScope-SSE": "enable", "Accept": "text/event-stream"}
+# 预热前缀缓存：只需要服务端处理输入，输出 1 个 token 即可
+WARM_GENERATION_PARAMETERS = {"result_format": "message", "max_tokens": 1}
+
+# 限流与服务端临时错误可重试
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+REWRITE_PREAMBLE = "请将以下用户查询改写为更适合语义搜索的关键词或描述性语句，只需返回改写后的内容：\n\n查询："
+
+class RetryableLLMError(RuntimeError):
+    """可重试的 LLM 调用错误（限流、服务端临时错误）"""
+
+
+class RetriesExhausted(Exception):
+    """LLM 调用在重试次数用尽后仍然失败，__cause__ 为最后一次的错误"""
+
+
 class LLMService:
     """LLM 服务类，使用 DashScope API 调用通义千问模型（支持异步和多模型选择）"""
     
-    def __init__(self, model_id: Optional[int] = None):
+    def __init__(self, model_id: Optional[int] = None, embedding_service=None):
         """
         初始化LLM服务
         
         Args:
             model_id: 模型ID (1=qwen-max, 2=qwen-plus, 3=qwen-turbo)，如果为None则从环境变量读取
+            embedding_service: Embedding 服务实例（可选），启用语义缓存时用于计算提示词向量
         """
         self.api_key = os.getenv("QWEN_API_KEY")
         if not self.api_key:
             raise ValueError("未找到 QWEN_API_KEY 环境变量")
         dashscope.api_key = self.api_key
         
-        if model_id is not None:
-            self.model = self._get_model_name(model_id)
-        else:
-            env_model = os.getenv("QWEN_MODEL", "qwen-plus")
-            # 如果环境变量是模型ID（数字字符串），转换为模型名
-            if env_model.isdigit():
-                self.model = self._get_model_name(int(env_model))
-            else:
-                self.model = env_model
+        self.model = get_model_name(model_id) if model_id is not None else DEFAULT_MODEL
+        
+        # 批量生成时的最大并发请求数（受 DashScope QPM 限制）
+        self.concurrency = max(1, int(os.getenv("QWEN_CONCURRENCY", "20")))
+        self._sem: Optional[asyncio.Semaphore] = None
+        # 响应缓存：相同（或语义相近）的请求直接返回已缓存的结果
+        self._cache = LLMResponseCache(embedding_service)
+        
+        # 单次请求超时（秒）及限流/5xx/超时的重试次数与退避参数
+        self.timeout = float(os.getenv("LLM_TIMEOUT_S", "60"))
+        self.max_retries = max(0, int(os.getenv("LLM_MAX_RETRIES", "3")))
+        self.retry_base_wait = float(os.getenv("LLM_RETRY_BASE_WAIT", "0.5"))
+        self.retry_max_wait = float(os.getenv("LLM_RETRY_MAX_WAIT", "8"))
+        
+        # 前缀缓存命中统计（输入 token 总数 / 其中命中缓存的 token 数）
+        self.prefix_cache_stats = {"prompt_tokens": 0, "cached_tokens": 0}
+        
+        # 复用的 HTTP/2 客户端（连接池），按事件循环各建一个，首次调用时在当前事件循环中创建
+        self._http_clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
     
-    def _get_model_name(self, model_id: int) -> str:
+    def _get_http(self) -> httpx.AsyncClient:
         """
-        根据模型ID获取模型名称
+        获取复用的 httpx 客户端
+        
+        启用 HTTP/2 后，并发请求在同一条 TLS 连接上多路复用，省去重复的握手；
+        连接池与事件循环绑定，每个事件循环使用各自的客户端，由 aclose() 统一关闭。
+        """
+        loop = asyncio.get_running_loop()
+        client = self._http_clients.get(loop)
+        if client is None or client.is_closed:
+            # 所属事件循环已关闭的客户端无法再使用，也无法再 await 关闭，直接丢弃
+            for old_loop in [l for l in list(self._http_clients) if l.is_closed()]:
+                self._http_clients.pop(old_loop, None)
+            client = httpx.AsyncClient(
+                http2=True,
+                base_url=dashscope.base_http_api_url.rstrip("/"),
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=60)
+            )
+            self._http_clients[loop] = client
+        return client
+    
+    async def aclose(self):
+        """
+        关闭 HTTP 客户端，释放连接池
+        
+        其他线程中仍在运行的事件循环上的客户端提交到其所属循环中关闭。
+        """
+        loop = asyncio.get_running_loop()
+        clients, self._http_clients = self._http_clients, {}
+        for client_loop, client in clients.items():
+            if client.is_closed or client_loop.is_closed():
+                continue
+            if client_loop is loop:
+                await client.aclose()
+            elif client_loop.is_running():
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(client.aclose(), client_loop))
+    
+    async def _post_generation(self, payload: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        """
+        直接调用 DashScope 文本生成 HTTP 接口
         
         Args:
-            model_id: 模型ID (1, 2, 或 3)
+            payload: 请求体
             
         Returns:
-            模型名称字符串
-            
-        Raises:
-            ValueError: 如果model_id无效
+            (HTTP 状态码, 响应 JSON)
         """
-        if model_id not in MODEL_MAP:
-            raise ValueError(f"无效的模型ID: {model_id}，支持的值: 1=qwen-max, 2=qwen-plus, 3=qwen-turbo")
-        return MODEL_MAP[model_id]
+        resp = await self._get_http().post(GENERATION_PATH, json=payload)
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {"code": str(resp.status_code), "message": resp.text}
+        return resp.status_code, data or {}
+    
+    _get_model_name = staticmethod(get_model_name)
     
     def set_model(self, model_id: int):
         """
         设置当前使用的模型
         
+        该实例为全局共享时会影响所有并发请求，按请求选择模型应通过 generate 的 model 参数传入。
+        
         Args:
             model_id: 模型ID (1=qwen-max, 2=qwen-plus, 3=qwen-turbo)
         """
         old_model = self.model
         self.model = self._get_model_name(model_id)
-        logger.info(f"[LLM] 模型切换: {old_model} -> {self.model}")
+        logger.info("[LLM] 模型切换: %s -> %s", old_model, self.model)
     
     async def generate(
         self, 
         prompt: str, 
-        system_prompt: Optional[str] = "你是一个专业的需求分析助手，请根据提供的上下文回答用户的问题。",
-        model: Optional[str] = None
+        system_prompt: Optional[str] = SYSTEM_PROMPT_DEFAULT,
+        model: Optional[str] = None,
+        use_cache: bool = True
     ) -> str:
         """
         生成文本 (异步)
@@ -87,58 +216,342 @@ class LLMService:
             prompt: 用户提示词
             system_prompt: 系统提示词
             model: 指定使用的模型名称，如果为None则使用实例的model属性
+            use_cache: 是否使用响应缓存（需要每次重新采样时传 False）
         """
-        generate_start = time.time()
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": prompt}
-        ]
+        if not use_cache or not self._cache.enabled:
+            return await self._call_once(prompt, system_prompt, model)
         
-        # 使用指定的模型或实例的模型
         model_to_use = model or self.model
-        prompt_length = len(prompt)
-        system_length = len(system_prompt) if system_prompt else 0
+        cached, vector = await self._cache.lookup(model_to_use, system_prompt, prompt)
+        if cached is not None:
+            logger.info("[LLM] 命中响应缓存 (模型: %s, prompt长度: %d)", model_to_use, len(prompt))
+            return cached
         
-        logger.info(f"[LLM] 调用生成接口 (模型: {model_to_use}, prompt长度: {prompt_length}, system长度: {system_length})")
+        content = await self._call_once(prompt, system_prompt, model_to_use)
+        await self._cache.store(model_to_use, system_prompt, prompt, content, vector)
+        return content
+    
+    async def generate_stream(
+        self,
+        prompt: str,
+        system_prompt: Optional[str] = SYSTEM_PROMPT_DEFAULT,
+        model: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        流式生成文本 (异步)，模型每产生一段文本就立即返回
         
-        try:
-            response = await AioGeneration.call(
-                model=model_to_use,
-                messages=messages,
-                result_format='message'
-            )
+        调用方可以边生成边消费（如 SSE 推送），感知延迟接近首 token 时间。
+        流式结果不经过响应缓存；收到首个片段之前的限流/5xx/网络错误会按退避重试，
+        之后中断则直接抛出。
+        
+        Args:
+            prompt: 用户提示词
+            system_prompt: 系统提示词
+            model: 指定使用的模型名称，如果为None则使用实例的model属性
             
-            elapsed_time = time.time() - generate_start
+        Yields:
+            增量文本片段
+        """
+        model_to_use = model or self.model
+        payload = {
+            "model": model_to_use,
+            "input": {"messages": (
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            )},
+            "parameters": STREAM_GENERATION_PARAMETERS
+        }
+        
+        for attempt in range(self.max_retries + 1):
+            started = False
+            try:
+                async with self._get_http().stream(
+                    "POST", GENERATION_PATH, json=payload, headers=STREAM_HEADERS
+                ) as resp:
+                    if resp.status_code != 200:
+                        await resp.aread()
+                        try:
+                            data = resp.json() or {}
+                        except ValueError:
+                            data = {"message": resp.text}
+                        error_cls = RetryableLLMError if resp.status_code in RETRYABLE_STATUS_CODES else Exception
+                        raise error_cls(f"调用 LLM 失败: {data.get('code', resp.status_code)} - {data.get('message', '')}")
+                    
+                    async for line in resp.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = json_loads(line[5:])
+                        if "output" not in data:
+                            raise Exception(f"调用 LLM 失败: {data.get('code')} - {data.get('message', '')}")
+                        content = data["output"]["choices"][0]["message"]["content"]
+                        if content:
+                            started = True
+                            yield content
+                return
+            except (RetryableLLMError, httpx.TransportError) as e:
+                if started:
+                    raise
+                if attempt >= self.max_retries:
+                    raise RetriesExhausted(f"调用 LLM 失败，已重试 {self.max_retries} 次: {e!r}") from e
+                delay = self._backoff_delay(attempt)
+                logger.warning("[LLM] 流式调用失败，%.2fs 后重试 (%d/%d): %r", delay, attempt + 1, self.max_retries, e)
+                await asyncio.sleep(delay)
+    
+    async def generate_batch(
+        self,
+        prompts: List[str],
+        system_prompt: Optional[str] = SYSTEM_PROMPT_DEFAULT,
+        model: Optional[str] = None,
+        concurrency: Optional[int] = None
+    ) -> List[Union[str, Exception]]:
+        """
+        并发生成多个提示词的结果 (异步)
+        
+        所有请求同时发出，由信号量限制同一时刻的在途请求数，
+        总耗时接近单次调用的最大值而非各次之和。
+        
+        Args:
+            prompts: 用户提示词列表
+            system_prompt: 系统提示词（所有请求共用）
+            model: 指定使用的模型名称，如果为None则使用实例的model属性
+            concurrency: 最大并发数，如果为None则使用 QWEN_CONCURRENCY（默认 20）
             
-            if response.status_code == 200:
-                content = response.output.choices[0].message.content
-                logger.info(f"[LLM] 生成成功 (耗时: {elapsed_time:.2f}秒, 输出长度: {len(content)} 字符)")
-                logger.debug(f"[LLM] 输出预览: {content[:200]}...")
-                return content
+        Returns:
+            与 prompts 顺序一致的结果列表，失败的请求对应位置为异常对象
+        """
+        if concurrency is not None:
+            sem = asyncio.Semaphore(max(1, concurrency))
+        else:
+            if self._sem is None:
+                self._sem = asyncio.Semaphore(self.concurrency)
+            sem = self._sem
+        
+        async def run(prompt: str) -> str:
+            async with sem:
+                return await self.generate(prompt, system_prompt=system_prompt, model=model)
+        
+        return await asyncio.gather(*(run(prompt) for prompt in prompts), return_exceptions=True)
+    
+    async def _call_once(
+        self,
+        prompt: str,
+        system_prompt: Optional[str],
+        model: Optional[str]
+    ) -> str:
+        """
+        调用 DashScope 生成接口，遇到限流/5xx/网络错误/超时时按指数退避重试
+        
+        Args:
+            prompt: 用户提示词
+            system_prompt: 系统提示词
+            model: 模型名称，如果为None则使用实例的model属性
+            
+        Raises:
+            RetriesExhausted: 可重试的错误在重试次数用尽后仍然出现
+        """
+        generate_start = time.perf_counter()
+        # 使用指定的模型或实例的模型
+        model_to_use = model or self.model
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "[LLM] 调用生成接口 (模型: %s, prompt长度: %d, system长度: %d)",
+                model_to_use, len(prompt), len(system_prompt) if system_prompt else 0
+            )
+        
+        payload = {
+            "model": model_to_use,
+            "input": {"messages": (
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            )},
+            "parameters": GENERATION_PARAMETERS
+        }
+        
+        for attempt in range(self.max_retries + 1):
+            try:
+                content = await self._request_generation(payload)
+            except (RetryableLLMError, httpx.TransportError, asyncio.TimeoutError) as e:
+                elapsed_time = time.perf_counter() - generate_start
+                if attempt >= self.max_retries:
+                    logger.error("[LLM] 重试 %d 次后仍失败: %r (耗时: %.2f秒)", self.max_retries, e, elapsed_time)
+                    raise RetriesExhausted(f"调用 LLM 失败，已重试 {self.max_retries} 次: {e!r}") from e
+                delay = self._backoff_delay(attempt)
+                logger.warning("[LLM] 调用失败，%.2fs 后重试 (%d/%d): %r", delay, attempt + 1, self.max_retries, e)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                elapsed_time = time.perf_counter() - generate_start
+                logger.error("[LLM] 生成异常: %s (耗时: %.2f秒)", e, elapsed_time, exc_info=True)
+                raise
             else:
-                logger.error(f"[LLM] 调用失败: {response.code} - {response.message} (耗时: {elapsed_time:.2f}秒)")
-                raise Exception(f"调用 LLM 失败: {response.code} - {response.message}")
+                if logger.isEnabledFor(logging.INFO):
+                    elapsed_time = time.perf_counter() - generate_start
+                    logger.info("[LLM] 生成成功 (耗时: %.2f秒, 输出长度: %d 字符)", elapsed_time, len(content))
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[LLM] 输出预览: %s...", content[:200])
+                return content
+    
+    async def _request_generation(self, payload: Dict[str, Any]) -> str:
+        """
+        发送一次生成请求并解析结果，超过 timeout 秒未完成则取消
+        
+        Args:
+            payload: 请求体
+            
+        Returns:
+            生成的文本
+            
+        Raises:
+            RetryableLLMError: 限流或服务端临时错误
+            asyncio.TimeoutError: 单次请求超时
+        """
+        status_code, data = await asyncio.wait_for(self._post_generation(payload), timeout=self.timeout)
+        if status_code == 200:
+            self._record_cache_usage(data.get("usage"))
+            return data["output"]["choices"][0]["message"]["content"]
+        
+        code = data.get("code", status_code)
+        message = data.get("message", "")
+        error_cls = RetryableLLMError if status_code in RETRYABLE_STATUS_CODES else Exception
+        raise error_cls(f"调用 LLM 失败: {code} - {message}")
+    
+    def _record_cache_usage(self, usage: Optional[Dict[str, Any]]):
+        """
+        累计响应 usage 中的前缀缓存命中情况（usage.prompt_tokens_details.cached_tokens）
+        
+        Args:
+            usage: 响应中的 usage 字段
+        """
+        if not usage:
+            return
+        prompt_tokens = usage.get("input_tokens") or usage.get("prompt_tokens") or 0
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        self.prefix_cache_stats["prompt_tokens"] += prompt_tokens
+        self.prefix_cache_stats["cached_tokens"] += cached_tokens
+        if cached_tokens and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[LLM] 前缀缓存命中 %d/%d 个输入 token", cached_tokens, prompt_tokens)
+    
+    async def warm_prefix(
+        self,
+        system_prompt: Optional[str],
+        prefix: str,
+        model: Optional[str] = None
+    ) -> int:
+        """
+        预热 DashScope 前缀缓存
+        
+        以 (system_prompt, prefix) 发送一次只输出 1 个 token 的请求，使服务端缓存这段输入。
+        之后用户消息以完全相同的 prefix 开头（变化的内容拼在末尾）的请求即可命中缓存，
+        适用于同一段检索上下文上的多轮追问或批量提问：先预热一次，再并发发出各请求。
+        预热失败不影响后续请求，仅记录日志。
+        
+        Args:
+            system_prompt: 系统提示词（须与后续请求一致）
+            prefix: 后续用户消息的公共开头（如检索到的参考内容）
+            model: 模型名称（须与后续请求一致），如果为None则使用实例的model属性
+            
+        Returns:
+            本次请求中已命中缓存的 token 数（0 表示首次写入或未命中）
+        """
+        payload = {
+            "model": model or self.model,
+            "input": {"messages": (
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prefix}
+            )},
+            "parameters": WARM_GENERATION_PARAMETERS
+        }
+        try:
+            status_code, data = await asyncio.wait_for(self._post_generation(payload), timeout=self.timeout)
         except Exception as e:
-            elapsed_time = time.time() - generate_start
-            logger.error(f"[LLM] 生成异常: {str(e)} (耗时: {elapsed_time:.2f}秒)", exc_info=True)
-            raise
+            logger.warning("[LLM] 前缀缓存预热失败: %r", e)
+            return 0
+        if status_code != 200:
+            logger.warning("[LLM] 前缀缓存预热失败: %s - %s", data.get("code", status_code), data.get("message", ""))
+            return 0
+        
+        usage = data.get("usage") or {}
+        self._record_cache_usage(usage)
+        return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
     
-    async def rewrite_query(self, query: str, model: Optional[str] = None) -> str:
+    def _backoff_delay(self, attempt: int) -> float:
+        """
+        计算第 attempt 次重试前的等待时间（带抖动的指数退避）
+        
+        Args:
+            attempt: 已失败的次数（从 0 开始）
+            
+        Returns:
+            等待秒数
+        """
+        return min(self.retry_max_wait, self.retry_base_wait * (2 ** attempt)) * random.uniform(0.5, 1.5)
+    
+    async def rewrite_query(
+        self,
+        query: Union[str, List[str]],
+        model: Optional[str] = None
+    ) -> Union[str, List[str]]:
         """
         查询改写 (异步)
         
         Args:
-            query: 原始查询
+            query: 原始查询；传入列表时并发改写，改写失败的查询保留原文
             model: 指定使用的模型，如果为None则使用实例的model属性
+            
+        Returns:
+            改写后的查询（与输入类型一致）
         """
-        rewrite_start = time.time()
-        logger.debug(f"[LLM] 开始查询改写 (原始查询: {query[:100]}...)")
+        if not isinstance(query, str):
+            queries = list(query)
+            rewrite_start = time.perf_counter()
+            results = await self.generate_batch(
+                [self._build_rewrite_prompt(q) for q in queries],
+                system_prompt=SYSTEM_PROMPT_REWRITE,
+                model=model
+            )
+            rewritten = []
+            for original, result in zip(queries, results):
+                if isinstance(result, Exception):
+                    logger.warning("[LLM] 查询改写失败，使用原始查询: %s", result)
+                    rewritten.append(original)
+                else:
+                    rewritten.append(result)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("[LLM] 批量查询改写完成 (数量: %d, 耗时: %.2f秒)", len(queries), time.perf_counter() - rewrite_start)
+            return rewritten
+        
+        log_debug = logger.isEnabledFor(logging.DEBUG)
+        rewrite_start = time.perf_counter()
+        if log_debug:
+            logger.debug("[LLM] 开始查询改写 (原始查询: %s...)", query[:100])
         
-        rewrite_prompt = f"请将以下用户查询改写为更适合语义搜索的关键词或描述性语句，只需返回改写后的内容：\n\n查询：{query}"
-        result = await self.generate(rewrite_prompt, system_prompt="你是一个搜索优化专家。", model=model)
+        rewrite_prompt = self._build_rewrite_prompt(query)
+        result = await self.generate(rewrite_prompt, system_prompt=SYSTEM_PROMPT_REWRITE, model=model)
         
-        elapsed_time = time.time() - rewrite_start
-        logger.debug(f"[LLM] 查询改写完成 (耗时: {elapsed_time:.2f}秒, 改写后: {result[:100]}...)")
+        if log_debug:
+            elapsed_time = time.perf_counter() - rewrite_start
+            logger.debug("[LLM] 查询改写完成 (耗时: %.2f秒, 改写后: %s...)", elapsed_time, result[:100])
         
         return result
+    
+    @staticmethod
+    def _build_rewrite_prompt(query: str) -> str:
+        """构造查询改写的用户提示词"""
+        return REWRITE_PREAMBLE + query
+
 
+@functools.lru_cache(maxsize=None)
+def get_llm(model_id: Optional[int] = None, embedding_service=None) -> LLMService:
+    """
+    获取共享的 LLMService 实例
+    
+    相同参数返回同一个实例，使各请求共用连接池、并发信号量与响应缓存。
+    
+    Args:
+        model_id: 默认模型ID，如果为None则从环境变量读取
+        embedding_service: Embedding 服务实例（可选，语义缓存使用）
+        
+    Returns:
+        LLMService 实例
+    """
+    return LLMService(model_id=model_id, embedding_service=embedding_service)
@@ -0,0 +1,220 @@
+"""
+LLM 响应缓存
+两级缓存：
+1. 精确匹配：sha256(model|system_prompt|prompt) → 响应，进程内 TTL LRU；
+   配置 REDIS_URL 且安装了 redis 时同时写入 Redis，多个 worker 共享
+2. 语义匹配（可选，LLM_SEMANTIC_CACHE=1）：提示词向量与已缓存提示词的余弦相似度
+   不低于阈值时直接复用其响应
+"""
+import os
+import hashlib
+import logging
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from app.utils.cache_utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """基于向量余弦相似度的近似匹配缓存（固定容量的环形缓冲区）"""
+
+    def __init__(self, maxsize: int = 512, threshold: float = 0.97, ttl: float = 1800):
+        """
+        初始化语义缓存
+
+        Args:
+            maxsize: 最大条目数，写满后覆盖最旧的条目
+            threshold: 命中所需的最小余弦相似度
+            ttl: 条目存活时间（秒）
+        """
+        self.maxsize = max(1, maxsize)
+        self.threshold = threshold
+        self.ttl = ttl
+        self._vectors: Optional[np.ndarray] = None
+        self._entries: List[Optional[Tuple[str, str, float]]] = [None] * self.maxsize
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> Optional[np.ndarray]:
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+
+    def lookup(self, scope: str, vector: np.ndarray) -> Optional[str]:
+        """
+        查找与 vector 最相似且属于同一 scope 的响应
+
+        Args:
+            scope: 作用域（模型 + 系统提示词），不同作用域的条目互不命中
+            vector: 提示词向量
+
+        Returns:
+            命中的响应，未命中返回 None
+        """
+        query = self._normalize(vector)
+        if query is None:
+            return None
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != query.shape[0]:
+                return None
+            sims = self._vectors @ query
+            now = time.monotonic()
+            for idx in np.argsort(-sims):
+                if sims[idx] < self.threshold:
+                    break
+                entry = self._entries[idx]
+                if entry is not None and entry[0] == scope and entry[2] > now:
+                    return entry[1]
+        return None
+
+    def add(self, scope: str, vector: np.ndarray, response: str):
+        """
+        写入一条缓存
+
+        Args:
+            scope: 作用域
+            vector: 提示词向量
+            response: 响应文本
+        """
+        vector = self._normalize(vector)
+        if vector is None:
+            return
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                # 初始化（或向量维度变化时重置），空槽位为零向量，相似度恒为 0
+                self._vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+                self._entries = [None] * self.maxsize
+                self._next = 0
+            self._vectors[self._next] = vector
+            self._entries[self._next] = (scope, response, time.monotonic() + self.ttl)
+            self._next = (self._next + 1) % self.maxsize
+
+
+class LLMResponseCache:
+    """LLM 响应的两级缓存"""
+
+    def __init__(self, embedding_service=None):
+        """
+        初始化缓存
+
+        Args:
+            embedding_service: Embedding 服务实例（语义缓存需要），为 None 时不启用语义缓存
+        """
+        self.ttl = int(os.getenv("LLM_CACHE_TTL", "1800"))
+        maxsize = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+        self.enabled = maxsize > 0 and self.ttl > 0
+        self._local = LRUCache(maxsize=maxsize, ttl=self.ttl)
+        self._redis = self._connect_redis(os.getenv("REDIS_URL")) if self.enabled else None
+
+        self.embedding_service = embedding_service
+        self._semantic: Optional[SemanticCache] = None
+        if self.enabled and embedding_service is not None and os.getenv("LLM_SEMANTIC_CACHE", "0") == "1":
+            self._semantic = SemanticCache(
+                maxsize=int(os.getenv("LLM_SEMANTIC_CACHE_SIZE", "512")),
+                threshold=float(os.getenv("LLM_SEMANTIC_CACHE_THRESHOLD", "0.97")),
+                ttl=self.ttl
+            )
+
+    @staticmethod
+    def _connect_redis(url: Optional[str]):
+        """创建 Redis 客户端（可选依赖，未配置或未安装时返回 None）"""
+        if not url:
+            return None
+        try:
+            import redis.asyncio as redis_asyncio
+        except ImportError:
+            logger.warning("[LLMCache] 已配置 REDIS_URL 但未安装 redis，仅使用进程内缓存")
+            return None
+        return redis_asyncio.Redis.from_url(url)
+
+    @staticmethod
+    def make_key(model: str, system_prompt: Optional[str], prompt: str) -> str:
+        """计算精确匹配缓存键"""
+        return hashlib.sha256(f"{model}|{system_prompt or ''}|{prompt}".encode("utf-8")).hexdigest()
+
+    async def lookup(
+        self,
+        model: str,
+        system_prompt: Optional[str],
+        prompt: str
+    ) -> Tuple[Optional[str], Optional[np.ndarray]]:
+        """
+        依次查询精确缓存与语义缓存
+
+        Args:
+            model: 模型名称
+            system_prompt: 系统提示词
+            prompt: 用户提示词
+
+        Returns:
+            (命中的响应或 None, 语义缓存计算出的提示词向量或 None，供 store 复用)
+        """
+        key = self.make_key(model, system_prompt, prompt)
+        cached = self._local.get(key)
+        if cached is not None:
+            return cached, None
+
+        if self._redis is not None:
+            try:
+                value = await self._redis.get(f"llm:{key}")
+                if value is not None:
+                    cached = value.decode("utf-8") if isinstance(value, bytes) else value
+                    self._local.set(key, cached)
+                    return cached, None
+            except Exception as e:
+                logger.warning("[LLMCache] Redis 读取失败: %s", e)
+
+        vector = None
+        if self._semantic is not None:
+            try:
+                vector = await self.embedding_service.embed_query(prompt)
+                cached = self._semantic.lookup(self._scope(model, system_prompt), vector)
+                if cached is not None:
+                    logger.info("[LLMCache] 语义缓存命中")
+                    return cached, vector
+            except Exception as e:
+                logger.warning("[LLMCache] 语义缓存查询失败: %s", e)
+        return None, vector
+
+    async def store(
+        self,
+        model: str,
+        system_prompt: Optional[str],
+        prompt: str,
+        response: str,
+        vector: Optional[np.ndarray] = None
+    ):
+        """
+        写入缓存
+
+        Args:
+            model: 模型名称
+            system_prompt: 系统提示词
+            prompt: 用户提示词
+            response: 响应文本
+            vector: lookup 返回的提示词向量（语义缓存使用）
+        """
+        key = self.make_key(model, system_prompt, prompt)
+        self._local.set(key, response)
+
+        if self._redis is not None:
+            try:
+                await self._redis.setex(f"llm:{key}", self.ttl, response)
+            except Exception as e:
+                logger.warning("[LLMCache] Redis 写入失败: %s", e)
+
+        if self._semantic is not None and vector is not None:
+            self._semantic.add(self._scope(model, system_prompt), vector, response)
+
+    @staticmethod
+    def _scope(model: str, system_prompt: Optional[str]) -> str:
+        """语义缓存的作用域：模型与系统提示词都相同时才允许近似命中"""
+        return f"{model}|{hashlib.sha256((system_prompt or '').encode('utf-8')).hexdigest()}"
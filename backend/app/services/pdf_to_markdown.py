@@ -3,36 +3,94 @@ PDF 转 Markdown 服务
 将 PDF 文件转换为 Markdown 格式，保留页面结构
 """
 import os
+import sys
+import asyncio
+import functools
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, TextIO, Tuple
 import pdfplumber
+from tqdm import tqdm
+
+from app.utils.fs_utils import copy_file_atomic, create_partial_file, scan_files
+from app.utils.hash_utils import calculate_file_sha1_cached
+
+logger = logging.getLogger(__name__)
+
+# convert_directory 中 PDF 总大小低于该值（字节）时不启用进程池
+PARALLEL_MIN_TOTAL_BYTES = int(os.getenv("PDF_PARALLEL_MIN_BYTES", str(4 * 1024 * 1024)))
+
+# 转换结果缓存目录（位于输出目录下），文件名为 <PDF SHA1>.<提取器>.v<版本>.md
+MARKDOWN_CACHE_DIR = ".cache"
+# 转换结果的版本号：提取选项（如 PyMuPDF 的 TEXT_DEHYPHENATE）或输出格式变化时递增，旧缓存随之失效
+MARKDOWN_CACHE_VERSION = 2
+
+# 单个 PDF 页数超过该值时，PyMuPDF 按页码区间分片到多个进程并行提取（0 关闭）
+PAGE_SHARD_MIN_PAGES = int(os.getenv("PDF_PAGE_SHARD_MIN_PAGES", "200"))
+
+# 按页分片提取使用的进程池，进程内共享，首次需要时创建。
+# 子进程以 spawn 方式启动：API 服务进程是多线程的（uvicorn、FAISS/OpenMP、httpx、sqlite），fork 可能使子进程死锁
+_shard_pool: Optional[ProcessPoolExecutor] = None
+_shard_pool_lock = threading.Lock()
+
+
+def _get_shard_pool() -> ProcessPoolExecutor:
+    """获取按页分片提取使用的共享进程池"""
+    global _shard_pool
+    with _shard_pool_lock:
+        if _shard_pool is None:
+            _shard_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _shard_pool
+
+
+def _reset_shard_pool(pool: ProcessPoolExecutor) -> None:
+    """子进程异常退出导致进程池不可用时丢弃它，下次分片提取时重新创建"""
+    global _shard_pool
+    with _shard_pool_lock:
+        if _shard_pool is pool:
+            _shard_pool = None
+    pool.shutdown(wait=False)
 
 
 class PDFToMarkdownService:
     """PDF 转 Markdown 服务类"""
     
-    def __init__(self, output_dir: Optional[str] = None):
+    def __init__(self, output_dir: Optional[str] = None, shard_pages: bool = True):
         """
         初始化服务
         
         Args:
             output_dir: Markdown 文件输出目录，默认为 None（需要调用时指定）
+            shard_pages: 是否允许大 PDF 按页分片多进程提取（已在进程池中运行时应关闭）
         """
         self.output_dir = output_dir
+        self.shard_pages = shard_pages
     
     def convert_pdf_to_markdown(
         self, 
         pdf_path: str, 
         output_dir: Optional[str] = None,
-        use_pymupdf: bool = False
+        use_pymupdf: bool = True,
+        invalidate: bool = False
     ) -> str:
         """
         将 PDF 文件转换为 Markdown 格式
         
+        转换结果按 PDF 内容 SHA1、提取器与转换版本缓存在 <output_dir>/.cache 下，
+        内容未变化的 PDF 再次转换时直接复制缓存。设置 PDF_MARKDOWN_CACHE=0 关闭缓存。
+        
         Args:
             pdf_path: PDF 文件路径
             output_dir: 输出目录，如果为 None 则使用 self.output_dir
-            use_pymupdf: 是否使用 PyMuPDF（fitz），False 则使用 pdfplumber
+            use_pymupdf: 是否使用 PyMuPDF（fitz，默认），False 则使用 pdfplumber
+            invalidate: 为 True 时忽略已有缓存，重新转换并覆盖缓存
             
         Returns:
             Markdown 文件路径
@@ -51,72 +109,165 @@ class PDFToMarkdownService:
         md_filename = pdf_path.stem + ".md"
         md_path = output_dir / md_filename
         
-        if use_pymupdf:
-            markdown_content = self._convert_with_pymupdf(pdf_path)
-        else:
-            markdown_content = self._convert_with_pdfplumber(pdf_path)
+        cache_path = None
+        if os.getenv("PDF_MARKDOWN_CACHE", "1") == "1":
+            extractor = "pymupdf" if use_pymupdf else "pdfplumber"
+            pdf_sha1 = calculate_file_sha1_cached(pdf_path)
+            cache_path = output_dir / MARKDOWN_CACHE_DIR / f"{pdf_sha1}.{extractor}.v{MARKDOWN_CACHE_VERSION}.md"
+            if not invalidate and cache_path.exists():
+                copy_file_atomic(cache_path, md_path)
+                return str(md_path)
         
-        # 保存 Markdown 文件
-        with open(md_path, 'w', encoding='utf-8') as f:
-            f.write(markdown_content)
+        # 逐页写入同目录临时文件（峰值内存只与单页文本大小相关），完成后原子替换
+        tmp = create_partial_file(md_path)
+        tmp.close()
+        try:
+            with open(tmp.name, 'w', encoding='utf-8', buffering=1 << 20) as fout:
+                if use_pymupdf:
+                    self._convert_with_pymupdf(pdf_path, fout)
+                else:
+                    self._convert_with_pdfplumber(pdf_path, fout)
+            
+            if cache_path is not None:
+                cache_path.parent.mkdir(exist_ok=True)
+                copy_file_atomic(tmp.name, cache_path)
+            os.replace(tmp.name, md_path)
+        except BaseException:
+            Path(tmp.name).unlink(missing_ok=True)
+            raise
         
         return str(md_path)
     
-    def _convert_with_pdfplumber(self, pdf_path: Path) -> str:
+    async def aconvert_pdf_to_markdown(
+        self,
+        pdf_path: str,
+        output_dir: Optional[str] = None,
+        use_pymupdf: bool = True,
+        invalidate: bool = False,
+        executor: Optional[Executor] = None
+    ) -> str:
         """
-        使用 pdfplumber 转换 PDF 为 Markdown
+        将 PDF 文件转换为 Markdown 格式 (异步)
+        
+        解析与写文件都在事件循环之外执行：传入进程池时在子进程中转换（绕过 GIL），
+        否则在线程中转换。
         
         Args:
             pdf_path: PDF 文件路径
+            output_dir: 输出目录，如果为 None 则使用 self.output_dir
+            use_pymupdf: 是否使用 PyMuPDF（fitz，默认），False 则使用 pdfplumber
+            invalidate: 为 True 时忽略已有缓存，重新转换并覆盖缓存
+            executor: 执行转换的进程池（可选）
             
         Returns:
-            Markdown 内容
+            Markdown 文件路径
+        """
+        output_dir = output_dir or self.output_dir
+        if executor is not None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                executor,
+                _convert_in_worker,
+                str(pdf_path),
+                str(output_dir) if output_dir else None,
+                use_pymupdf,
+                invalidate
+            )
+        return await asyncio.to_thread(
+            self.convert_pdf_to_markdown,
+            pdf_path,
+            output_dir,
+            use_pymupdf=use_pymupdf,
+            invalidate=invalidate
+        )
+    
+    def _convert_with_pdfplumber(self, pdf_path: Path, fout: TextIO) -> None:
         """
-        markdown_parts = []
+        使用 pdfplumber 转换 PDF 为 Markdown，逐页写入 fout
         
+        Args:
+            pdf_path: PDF 文件路径
+            fout: 已打开的 Markdown 输出文件
+        """
         with pdfplumber.open(pdf_path) as pdf:
             for i, page in enumerate(pdf.pages, start=1):
-                text = page.extract_text()
-                if text:
-                    # 添加页面分隔符
-                    markdown_parts.append(f"# 第 {i} 页\n\n")
-                    markdown_parts.append(text)
-                    markdown_parts.append("\n\n")
-        
-        return "".join(markdown_parts)
+                try:
+                    text = page.extract_text()
+                    if text:
+                        # 添加页面分隔符
+                        fout.write(f"# 第 {i} 页\n\n")
+                        fout.write(text)
+                        fout.write("\n\n")
+                finally:
+                    # pdf.pages 会一直持有所有 Page 对象，处理完立即释放其布局对象
+                    # 与 textmap 缓存，使峰值内存只与单页相关
+                    page.close()
     
-    def _convert_with_pymupdf(self, pdf_path: Path) -> str:
+    def _convert_with_pymupdf(self, pdf_path: Path, fout: TextIO) -> None:
         """
-        使用 PyMuPDF (fitz) 转换 PDF 为 Markdown
+        使用 PyMuPDF (fitz) 转换 PDF 为 Markdown，逐页写入 fout
         
         Args:
             pdf_path: PDF 文件路径
-            
-        Returns:
-            Markdown 内容
+            fout: 已打开的 Markdown 输出文件
         """
         import fitz  # PyMuPDF
         
-        markdown_parts = []
-        doc = fitz.open(pdf_path)
+        # 在默认文本提取选项的基础上合并行尾连字符断开的单词
+        flags = fitz.TEXTFLAGS_TEXT | fitz.TEXT_DEHYPHENATE
         
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            text = page.get_text()
-            if text:
-                # 添加页面分隔符
-                markdown_parts.append(f"# 第 {page_num + 1} 页\n\n")
-                markdown_parts.append(text)
-                markdown_parts.append("\n\n")
+        with fitz.open(pdf_path, filetype="pdf") as doc:
+            page_count = doc.page_count
+            workers = min(os.cpu_count() or 1, page_count)
+            if not (self.shard_pages and 0 < PAGE_SHARD_MIN_PAGES < page_count and workers > 1):
+                for page_num, page in enumerate(doc, start=1):
+                    _write_page(fout, page_num, page.get_text("text", flags=flags))
+                return
         
-        doc.close()
-        return "".join(markdown_parts)
+        # 页数较多：各子进程独立打开文档，按页码区间并行提取
+        self._convert_with_pymupdf_parallel(pdf_path, page_count, workers, fout)
+    
+    def _convert_with_pymupdf_parallel(
+        self,
+        pdf_path: Path,
+        page_count: int,
+        n_shards: int,
+        fout: TextIO
+    ) -> None:
+        """
+        将页码均分为 n_shards 个区间，由共享进程池中的子进程各自打开 PDF 并行提取，按页序写入 fout
+        
+        Args:
+            pdf_path: PDF 文件路径
+            page_count: 总页数
+            n_shards: 分片（进程）数
+            fout: 已打开的 Markdown 输出文件
+        """
+        shard_size, remainder = divmod(page_count, n_shards)
+        starts, ends = [], []
+        start = 0
+        for shard in range(n_shards):
+            end = start + shard_size + (1 if shard < remainder else 0)
+            starts.append(start)
+            ends.append(end)
+            start = end
+        
+        executor = _get_shard_pool()
+        try:
+            # map 按提交顺序返回结果，逐个分片写出即可保持页序
+            results = executor.map(_extract_page_range, [str(pdf_path)] * n_shards, starts, ends)
+            for start, texts in zip(starts, results):
+                for page_num, text in enumerate(texts, start=start + 1):
+                    _write_page(fout, page_num, text)
+        except BrokenProcessPool:
+            _reset_shard_pool(executor)
+            raise
     
     def convert_directory(
         self, 
         pdf_dir: str, 
         output_dir: str,
-        use_pymupdf: bool = False
+        use_pymupdf: bool = True
     ) -> list[str]:
         """
         批量转换目录下的所有 PDF 文件
@@ -124,7 +275,7 @@ class PDFToMarkdownService:
         Args:
             pdf_dir: PDF 文件目录
             output_dir: 输出目录
-            use_pymupdf: 是否使用 PyMuPDF
+            use_pymupdf: 是否使用 PyMuPDF（默认），False 则使用 pdfplumber
             
         Returns:
             Markdown 文件路径列表
@@ -133,19 +284,107 @@ class PDFToMarkdownService:
         output_dir = Path(output_dir)
         output_dir.mkdir(parents=True, exist_ok=True)
         
+        entries = scan_files(pdf_dir, ".pdf")
+        pdf_files = [entry.path for entry in entries]
+        convert = functools.partial(
+            _convert_one,
+            output_dir=str(output_dir),
+            use_pymupdf=use_pymupdf
+        )
+        
         md_files = []
-        pdf_files = list(pdf_dir.glob("*.pdf"))
-        
-        for pdf_file in pdf_files:
-            try:
-                md_path = self.convert_pdf_to_markdown(
-                    str(pdf_file), 
-                    str(output_dir),
-                    use_pymupdf=use_pymupdf
-                )
-                md_files.append(md_path)
-                print(f"已转换: {pdf_file.name} -> {Path(md_path).name}")
-            except Exception as e:
-                print(f"转换失败 {pdf_file.name}: {e}")
+        
+        def collect(results):
+            # 仅在终端中显示进度条
+            progress = tqdm(results, total=len(pdf_files), desc="转换 PDF", disable=not sys.stderr.isatty())
+            for pdf_file, (md_path, error) in zip(pdf_files, progress):
+                name = os.path.basename(pdf_file)
+                if md_path is not None:
+                    md_files.append(md_path)
+                    logger.info("已转换: %s -> %s", name, os.path.basename(md_path))
+                else:
+                    logger.error("转换失败 %s: %s", name, error)
+        
+        # PDF 解析是 CPU 密集型任务，多个文件时用进程池并行转换；
+        # 文件少且小时进程启动开销大于收益，直接在当前进程中转换
+        total_size = sum(entry.stat().st_size for entry in entries)
+        workers = min(len(pdf_files), os.cpu_count() or 1)
+        if workers > 1 and total_size >= PARALLEL_MIN_TOTAL_BYTES:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                collect(executor.map(convert, pdf_files))
+        else:
+            collect(map(convert, pdf_files))
         
         return md_files
+
+
+def _write_page(fout: TextIO, page_num: int, text: str) -> None:
+    """写入一页文本（带页面分隔符），空页跳过"""
+    if text:
+        # 添加页面分隔符
+        fout.write(f"# 第 {page_num} 页\n\n")
+        fout.write(text)
+        fout.write("\n\n")
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int) -> List[str]:
+    """
+    在子进程中用 PyMuPDF 提取 [start, end) 页的文本（模块级函数，供进程池 pickle 调用）
+    
+    Args:
+        pdf_path: PDF 文件路径
+        start: 起始页索引（从 0 开始，包含）
+        end: 结束页索引（不包含）
+        
+    Returns:
+        各页文本列表，按页序排列
+    """
+    import fitz  # PyMuPDF
+    
+    flags = fitz.TEXTFLAGS_TEXT | fitz.TEXT_DEHYPHENATE
+    with fitz.open(pdf_path, filetype="pdf") as doc:
+        return [doc[i].get_text("text", flags=flags) for i in range(start, end)]
+
+
+def _convert_one(
+    pdf_path: str,
+    output_dir: str,
+    use_pymupdf: bool = True
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    转换单个 PDF（模块级函数，供进程池 pickle 调用）
+    
+    Args:
+        pdf_path: PDF 文件路径
+        output_dir: 输出目录
+        use_pymupdf: 是否使用 PyMuPDF（默认），False 则使用 pdfplumber
+        
+    Returns:
+        (Markdown 文件路径, None)；失败时为 (None, 错误信息)
+    """
+    try:
+        return _convert_in_worker(pdf_path, output_dir, use_pymupdf), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _convert_in_worker(
+    pdf_path: str,
+    output_dir: Optional[str],
+    use_pymupdf: bool = True,
+    invalidate: bool = False
+) -> str:
+    """
+    在进程池子进程中转换单个 PDF（模块级函数，供 pickle 调用）
+    
+    已在进程池中运行，因此不再按页分片启动嵌套进程池。
+    
+    Returns:
+        Markdown 文件路径
+    """
+    return PDFToMarkdownService(shard_pages=False).convert_pdf_to_markdown(
+        pdf_path,
+        output_dir,
+        use_pymupdf=use_pymupdf,
+        invalidate=invalidate
+    )
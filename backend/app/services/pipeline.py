@@ -2,27 +2,66 @@
 总控 Pipeline 服务
 串联解析、分块、向量化、检索和生成流程
 """
+import asyncio
+import difflib
 import logging
+import multiprocessing
+import re
 import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property, lru_cache
 from typing import List, Dict, Optional
 from pydantic import BaseModel, Field
 from pathlib import Path
 import os
 from tqdm import tqdm
 
-from app.services.retrieval import RetrievalService
-from app.services.llm import LLMService
-from app.services.embedding import EmbeddingService
-from app.services.pdf_to_markdown import PDFToMarkdownService
-from app.services.chunking import DocumentChunker
+from app.services.llm import get_model_name, SYSTEM_PROMPT_SEARCH
+from app.services.embedding_batcher import EmbeddingBatcher
 from app.services.vector_db import VectorDBService
-from app.utils.parser import DocumentParser
+from app.services.registry import (
+    aclose_services,
+    get_chunker,
+    get_document_parser,
+    get_embedding_service,
+    get_llm_service,
+    get_pdf_to_markdown,
+    get_retrieval_service,
+)
 from app.storage.metadata import MetadataStorage
-from app.utils.hash_utils import calculate_file_sha1
-import json
+from app.utils.hash_utils import calculate_file_sha1_cached
+from app.utils.fs_utils import scan_files, walk_files
+from app.utils.json_utils import loads as json_loads, write_json
+
+try:
+    import ahocorasick
+except ImportError:  # 可选依赖，未安装时退回逐个文档的子串匹配
+    ahocorasick = None
 
 logger = logging.getLogger(__name__)
 
+# LLM 输出中的 ```json ... ``` 代码块（允许代码块前后带有其他文字）
+_JSON_FENCE_RE = re.compile(r"```(?i:json)?\s*(.*?)\s*```", re.S)
+# ingest_directory 处理的文件类型
+INGEST_EXTENSIONS = frozenset({".pdf", ".docx", ".txt", ".md"})
+# 改写后的查询与原始查询的相似度（difflib quick_ratio）不低于该值时，直接使用以原始查询先行检索的结果
+SPECULATIVE_SEARCH_MIN_SIMILARITY = float(os.getenv("SPECULATIVE_SEARCH_MIN_SIMILARITY", "0.8"))
+
+_probe = time.perf_counter
+
+
+@contextmanager
+def _step(name: str, timings: Dict[str, float]):
+    """记录一个步骤的耗时（秒）到 timings[name]"""
+    start = _probe()
+    try:
+        yield
+    finally:
+        timings[name] = _probe() - start
+
+
 class StructuredAnswer(BaseModel):
     """结构化回答模型"""
     answer: str = Field(description="问题的最终答案")
@@ -51,16 +90,33 @@ class PipelinePaths:
             vector_dbs_dir: FAISS 索引文件目录（相对于 base_dir）
         """
         self.base_dir = Path(base_dir)
-        self.documents_dir = self.base_dir / documents_dir
-        self.markdown_dir = self.base_dir / markdown_dir
-        self.chunked_reports_dir = self.base_dir / chunked_reports_dir
-        self.vector_dbs_dir = self.base_dir / vector_dbs_dir
-        
-        # 确保所有目录存在
-        self.documents_dir.mkdir(parents=True, exist_ok=True)
-        self.markdown_dir.mkdir(parents=True, exist_ok=True)
-        self.chunked_reports_dir.mkdir(parents=True, exist_ok=True)
-        self.vector_dbs_dir.mkdir(parents=True, exist_ok=True)
+        self._documents_dir = documents_dir
+        self._markdown_dir = markdown_dir
+        self._chunked_reports_dir = chunked_reports_dir
+        self._vector_dbs_dir = vector_dbs_dir
+    
+    def _ensure_dir(self, relative: str) -> Path:
+        """拼接 base_dir 下的目录并确保其存在"""
+        path = self.base_dir / relative
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+    
+    # 各目录在首次访问时才创建（且只创建一次），仅构造路径配置不会产生文件系统操作
+    @cached_property
+    def documents_dir(self) -> Path:
+        return self._ensure_dir(self._documents_dir)
+    
+    @cached_property
+    def markdown_dir(self) -> Path:
+        return self._ensure_dir(self._markdown_dir)
+    
+    @cached_property
+    def chunked_reports_dir(self) -> Path:
+        return self._ensure_dir(self._chunked_reports_dir)
+    
+    @cached_property
+    def vector_dbs_dir(self) -> Path:
+        return self._ensure_dir(self._vector_dbs_dir)
 
 
 class RAGPipeline:
@@ -77,13 +133,25 @@ class RAGPipeline:
         self.metadata_storage = MetadataStorage(
             chunked_reports_dir=str(self.paths.chunked_reports_dir)
         )
-        self.retrieval_service = RetrievalService()
-        self.llm_service = LLMService()
-        self.embedding_service = EmbeddingService()
-        self.parser = DocumentParser()
-        self.chunker = DocumentChunker()
-        self.pdf_to_markdown = PDFToMarkdownService()
-        self.vector_db = VectorDBService(self.embedding_service)
+        # 各服务在进程内共享，多个 Pipeline 实例不会重复加载索引、tokenizer 与连接池
+        self.retrieval_service = get_retrieval_service()
+        self.embedding_service = get_embedding_service()
+        self.llm_service = get_llm_service()
+        self.parser = get_document_parser()
+        self.chunker = get_chunker()
+        self.pdf_to_markdown = get_pdf_to_markdown()
+        # process_documents 并发处理多个文档时，各文档的 chunk 经批处理队列合并为大批次调用 API
+        self.embedding_batcher = EmbeddingBatcher(self.embedding_service)
+        self.vector_db = VectorDBService(self.embedding_service, self.embedding_batcher)
+        
+        # process_documents 同时处理的文档数，及 PDF 解析进程池（按需创建）
+        self.ingest_concurrency = max(1, int(os.getenv("INGEST_CONCURRENCY", "4")))
+        self._pdf_executor: Optional[ProcessPoolExecutor] = None
+        
+        # 查询中产品名称的匹配器，文档集合变化时重建
+        self._doc_names: List[str] = []
+        self._name_automaton = None
+        self._name_matcher_signature: Optional[int] = None
     
     async def answer(
         self, 
@@ -103,122 +171,99 @@ class RAGPipeline:
             llm_model: 大模型选择，1=qwen-max, 2=qwen-plus, 3=qwen-turbo
             product_name: 可选的产品名称，用于过滤相关文档
         """
-        pipeline_start = time.time()
-        logger.info("[Pipeline] 开始处理 RAG 问答流程")
+        timings: Dict[str, float] = {}
+        pipeline_start = _probe()
         
-        # 0. 设置LLM模型
-        step_start = time.time()
-        self.llm_service.set_model(llm_model)
-        model_name = {1: "qwen-max", 2: "qwen-plus", 3: "qwen-turbo"}.get(llm_model, "qwen-plus")
-        logger.info(f"[Pipeline] 步骤0: 设置LLM模型 -> {model_name} (耗时: {time.time() - step_start:.2f}秒)")
+        # 0. 选择LLM模型（按请求传入，不修改共享的 LLMService 实例）
+        model_name = get_model_name(llm_model)
         
         # 1. 产品名称提取（如果未提供）
-        step_start = time.time()
-        final_product_name = product_name
-        if not final_product_name:
-            # 尝试从查询中提取产品名称（简单关键词匹配）
-            # 获取所有文档名称
-            all_doc_names = self.metadata_storage.get_all_document_names()
-            logger.debug(f"[Pipeline] 可用文档名称: {list(all_doc_names)[:5]}...")
-            for doc_name in all_doc_names:
-                # 如果查询中包含文档名称的关键词，使用该文档
-                if doc_name in query or any(keyword in query for keyword in doc_name.split() if len(keyword) > 2):
-                    final_product_name = doc_name
-                    logger.info(f"[Pipeline] 从查询中提取到产品名称: {final_product_name}")
-                    break
-        else:
-            logger.info(f"[Pipeline] 使用提供的产品名称: {final_product_name}")
-        logger.info(f"[Pipeline] 步骤1: 产品名称提取 -> {final_product_name or '未指定'} (耗时: {time.time() - step_start:.2f}秒)")
+        with _step("product_name", timings):
+            final_product_name = product_name
+            if not final_product_name:
+                # 尝试从查询中提取产品名称（文档名称或其关键词出现在查询中）
+                final_product_name = self._match_product_name(query)
         
         # 2. 获取文档SHA1（如果提供了产品名称）
-        step_start = time.time()
-        document_sha1 = None
-        if final_product_name:
-            document_sha1 = self.metadata_storage.get_document_sha1_by_name(final_product_name, fuzzy_match=True)
-            if document_sha1:
-                logger.info(f"[Pipeline] 找到文档SHA1: {document_sha1[:16]}...")
+        with _step("document_sha1", timings):
+            document_sha1 = None
+            if final_product_name:
+                document_sha1 = self.metadata_storage.get_document_sha1_by_name(final_product_name, fuzzy_match=True)
+                if not document_sha1:
+                    logger.warning("[Pipeline] 未找到产品名称 '%s' 对应的文档SHA1", final_product_name)
+        
+        # 3. 查询改写，同时以原始查询先行检索（两次网络请求重叠）
+        with _step("rewrite", timings):
+            search_kwargs = dict(
+                top_k=10,
+                search_mode=search_mode,
+                product_name=final_product_name,
+                document_sha1=document_sha1
+            )
+            speculative_search = asyncio.create_task(self.retrieval_service.search(query, **search_kwargs))
+            try:
+                optimized_query = await self.llm_service.rewrite_query(query, model=model_name)
+            except BaseException:
+                speculative_search.cancel()
+                raise
+        
+        # 4. 检索相关上下文：改写结果与原始查询足够相近时直接使用先行检索的结果
+        with _step("search", timings):
+            similarity = difflib.SequenceMatcher(None, query, optimized_query).quick_ratio()
+            if similarity >= SPECULATIVE_SEARCH_MIN_SIMILARITY:
+                search_results = await speculative_search
             else:
-                logger.warning(f"[Pipeline] 未找到产品名称 '{final_product_name}' 对应的文档SHA1")
-        logger.info(f"[Pipeline] 步骤2: 获取文档SHA1 -> {document_sha1[:16] + '...' if document_sha1 else '无'} (耗时: {time.time() - step_start:.2f}秒)")
-        
-        # 3. 查询改写 (可选)
-        step_start = time.time()
-        optimized_query = await self.llm_service.rewrite_query(query)
-        logger.info(f"[Pipeline] 步骤3: 查询改写")
-        logger.debug(f"[Pipeline] 原始查询: {query[:100]}...")
-        logger.debug(f"[Pipeline] 优化查询: {optimized_query[:100]}...")
-        logger.info(f"[Pipeline] 步骤3耗时: {time.time() - step_start:.2f}秒")
-        
-        # 4. 检索相关上下文
-        step_start = time.time()
-        logger.info(f"[Pipeline] 步骤4: 开始检索 (模式={search_mode}, top_k=10)")
-        search_results = await self.retrieval_service.search(
-            optimized_query,
-            top_k=10,
-            search_mode=search_mode,
-            product_name=final_product_name,
-            document_sha1=document_sha1
-        )
-        logger.info(f"[Pipeline] 步骤4: 检索完成，获得 {len(search_results)} 个结果 (耗时: {time.time() - step_start:.2f}秒)")
-        if search_results:
-            logger.debug(f"[Pipeline] 检索结果示例: {search_results[0].get('document_name', 'N/A')} (相似度: {search_results[0].get('similarity', 0):.3f})")
+                speculative_search.cancel()
+                search_results = await self.retrieval_service.search(optimized_query, **search_kwargs)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "[Pipeline] 原始查询: %s | 优化查询: %s | 相似度 %.2f（%s）| 检索结果 %d 个",
+                query[:100], optimized_query[:100], similarity,
+                "复用原始查询的检索结果" if similarity >= SPECULATIVE_SEARCH_MIN_SIMILARITY else "重新检索",
+                len(search_results)
+            )
         
         # 5. 组装 Prompt，包含结构化要求
-        step_start = time.time()
-        context_items = []
-        available_pages = set()
-        for i, res in enumerate(search_results):
-            page_info = f", 第 {res['page_num']} 页" if res.get('page_num') else ""
-            section_info = " > ".join(res.get('section_path', [])) if res.get('section_path') else ""
-            section_str = f" [{section_info}]" if section_info else ""
-            context_items.append(f"[{i+1}] 来自《{res['document_name']}》{section_str}{page_info}:\n{res['text']}")
-            if res.get('page_num'):
-                available_pages.add(res['page_num'])
-                
-        context = "\n\n".join(context_items)
-        logger.info(f"[Pipeline] 步骤5: 组装上下文 (总长度: {len(context)} 字符, 可用页码: {sorted(available_pages)}) (耗时: {time.time() - step_start:.2f}秒)")
-        
-        system_prompt = """你是一个专业的需求分析助手。请基于提供的参考内容回答用户问题。
-要求：
-1. 必须严格基于参考内容回答，不要编造。
-2. 给出推理过程（thoughts）。
-3. 列出引用的页码（citations）。
-4. 输出必须是 JSON 格式，包含字段：answer, thoughts, citations。
-"""
+        with _step("context", timings):
+            context_items = []
+            pages = set()
+            append = context_items.append
+            for i, res in enumerate(search_results, 1):
+                page_num = res.get('page_num')
+                section_path = res.get('section_path')
+                page_info = f", 第 {page_num} 页" if page_num else ""
+                section_str = f" [{' > '.join(section_path)}]" if section_path else ""
+                append(f"[{i}] 来自《{res['document_name']}》{section_str}{page_info}:\n{res['text']}")
+                if page_num:
+                    pages.add(page_num)
+            available_pages = frozenset(pages)
+            
+            context = "\n\n".join(context_items)
+        
+        # 系统提示词为固定常量，动态内容（上下文、问题）放在用户消息中，以便命中前缀缓存
+        system_prompt = SYSTEM_PROMPT_SEARCH
         
         prompt = f"参考内容：\n{context}\n\n用户问题：{query}\n\n请以 JSON 格式输出回答。"
         
         # 6. 生成答案（使用选定的模型）
-        step_start = time.time()
-        logger.info(f"[Pipeline] 步骤6: 调用LLM生成答案 (模型: {model_name})")
-        raw_answer = await self.llm_service.generate(prompt, system_prompt=system_prompt)
-        logger.info(f"[Pipeline] 步骤6: LLM生成完成 (答案长度: {len(raw_answer)} 字符, 耗时: {time.time() - step_start:.2f}秒)")
+        with _step("generate", timings):
+            raw_answer = await self.llm_service.generate(prompt, system_prompt=system_prompt, model=model_name)
         
         try:
-            # 尝试解析 JSON
-            step_start = time.time()
-            clean_json = raw_answer.strip()
-            if clean_json.startswith("```json"):
-                clean_json = clean_json[7:-3].strip()
-            elif clean_json.startswith("```"):
-                clean_json = clean_json[3:-3].strip()
+            # 7. 解析 JSON 并验证引用
+            with _step("parse", timings):
+                fence = _JSON_FENCE_RE.search(raw_answer)
+                clean_json = fence.group(1) if fence else raw_answer.strip()
+                answer_dict = json_loads(clean_json)
                 
-            answer_dict = json.loads(clean_json)
-            logger.info(f"[Pipeline] 步骤7: JSON解析成功 (耗时: {time.time() - step_start:.2f}秒)")
-            
-            # 7. 引用验证
-            step_start = time.time()
-            original_citations = answer_dict.get('citations', [])
-            valid_citations = [p for p in original_citations if p in available_pages]
-            answer_dict['citations'] = valid_citations
+                original_citations = answer_dict.get('citations') or []
+                valid_citations = self._validate_citations(original_citations, available_pages)
+                answer_dict['citations'] = valid_citations
             if len(original_citations) != len(valid_citations):
-                logger.warning(f"[Pipeline] 引用验证: 原始引用 {len(original_citations)} 个，有效引用 {len(valid_citations)} 个")
-            else:
-                logger.info(f"[Pipeline] 步骤7: 引用验证完成，有效引用 {len(valid_citations)} 个 (耗时: {time.time() - step_start:.2f}秒)")
-            
-            total_time = time.time() - pipeline_start
-            logger.info(f"[Pipeline] RAG流程全部完成，总耗时: {total_time:.2f}秒")
-            logger.info("-" * 80)
+                logger.warning(
+                    "[Pipeline] 引用验证: 原始引用 %d 个，有效引用 %d 个",
+                    len(original_citations), len(valid_citations)
+                )
             
             # 确保thoughts是字符串类型
             thoughts = answer_dict.get('thoughts')
@@ -228,64 +273,153 @@ class RAGPipeline:
             elif thoughts is not None:
                 thoughts = str(thoughts)
             
-            # 确保citations是整数列表
-            citations = answer_dict.get('citations', [])
-            if citations:
-                # 确保所有元素都是整数
-                citations = [int(c) if isinstance(c, (int, str)) and str(c).isdigit() else c for c in citations]
-                citations = [c for c in citations if isinstance(c, int)]
-            
+            self._log_answer_timings(timings, pipeline_start, model_name, final_product_name, search_results)
             return {
                 "answer": str(answer_dict.get('answer', '')),
                 "thoughts": thoughts,
-                "citations": citations,
+                "citations": valid_citations,
                 "sources": search_results
             }
         except Exception as e:
-            logger.error(f"[Pipeline] JSON解析失败: {str(e)}")
-            logger.debug(f"[Pipeline] 原始答案: {raw_answer[:200]}...")
-            total_time = time.time() - pipeline_start
-            logger.warning(f"[Pipeline] 使用原始答案返回，总耗时: {total_time:.2f}秒")
-            logger.info("-" * 80)
+            logger.error("[Pipeline] JSON解析失败: %s", e)
+            logger.debug("[Pipeline] 原始答案: %s...", raw_answer[:200])
+            self._log_answer_timings(timings, pipeline_start, model_name, final_product_name, search_results)
             return {
                 "answer": raw_answer,
                 "thoughts": "解析结构化输出失败",
                 "citations": [],
                 "sources": search_results
             }
+    
+    @staticmethod
+    def _log_answer_timings(
+        timings: Dict[str, float],
+        pipeline_start: float,
+        model_name: str,
+        product_name: Optional[str],
+        search_results: List[Dict]
+    ):
+        """answer 结束时输出一行汇总日志（各步骤耗时，单位秒），便于解析与定位瓶颈"""
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        logger.info(
+            "[Pipeline] RAG问答完成 total=%.3f model=%s product=%s results=%d steps=%s",
+            _probe() - pipeline_start,
+            model_name,
+            product_name or "-",
+            len(search_results),
+            " ".join(f"{name}={elapsed:.3f}" for name, elapsed in timings.items())
+        )
 
+    @staticmethod
+    def _validate_citations(citations: List, available_pages: frozenset) -> List[int]:
+        """
+        过滤模型输出的引用页码，只保留检索结果中出现过的页码
+        
+        引用先统一为整数页码（模型可能输出 "3" 这样的字符串），按首次出现的顺序去重，
+        再做集合成员判断（每个引用 O(1)）。
+        
+        Args:
+            citations: 模型输出的引用列表
+            available_pages: 检索结果中的页码集合
+            
+        Returns:
+            有效引用页码列表
+        """
+        pages = dict.fromkeys(
+            int(c) for c in citations
+            if isinstance(c, (int, str)) and str(c).isdigit()
+        )
+        return [p for p in pages if p in available_pages]
+    
+    def _refresh_name_matcher(self):
+        """文档名称集合变化时重建文档名称匹配器"""
+        signature = self.metadata_storage.document_names_version
+        if signature == self._name_matcher_signature:
+            return
+        
+        self._doc_names = list(self.metadata_storage.get_all_document_names())
+        self._name_matcher_signature = signature
+        logger.debug(f"[Pipeline] 可用文档名称: {self._doc_names[:5]}...")
+        
+        if ahocorasick is None:
+            self._name_automaton = None
+            return
+        
+        # 词 → 包含该词的文档名称：完整文档名称，以及名称中长度大于 2 的词
+        words: Dict[str, List[str]] = {}
+        for doc_name in self._doc_names:
+            words.setdefault(doc_name, []).append(doc_name)
+            for keyword in doc_name.split():
+                if len(keyword) > 2:
+                    words.setdefault(keyword, []).append(doc_name)
+        
+        automaton = ahocorasick.Automaton()
+        for word, targets in words.items():
+            automaton.add_word(word, tuple(targets))
+        if words:
+            automaton.make_automaton()
+            self._name_automaton = automaton
+        else:
+            self._name_automaton = None
+    
+    def _match_product_name(self, query: str) -> Optional[str]:
+        """
+        从查询中匹配文档名称
+        
+        查询中包含完整文档名称，或文档名称中长度大于 2 的词时视为匹配，
+        两类匹配不分先后，按 get_all_document_names() 的顺序取第一个匹配的文档。
+        安装了 pyahocorasick 时用 Aho-Corasick 自动机一次扫描查询，
+        否则逐个文档做子串判断。
+        
+        Args:
+            query: 用户查询
+            
+        Returns:
+            匹配到的文档名称，未匹配返回 None
+        """
+        self._refresh_name_matcher()
+        
+        if self._name_automaton is not None:
+            hits = {doc_name for _, doc_names in self._name_automaton.iter(query) for doc_name in doc_names}
+            if not hits:
+                return None
+            return next(doc_name for doc_name in self._doc_names if doc_name in hits)
+        
+        for doc_name in self._doc_names:
+            if doc_name in query or any(keyword in query for keyword in doc_name.split() if len(keyword) > 2):
+                return doc_name
+        return None
+    
     async def ingest_directory(self, directory_path: str):
         """
         离线入库流程 (支持异步)
         """
-        import os
-        
         all_chunks = []
         all_embeddings = []
         
-        for root, dirs, files in os.walk(directory_path):
-            for file in files:
-                if file.endswith(('.pdf', '.docx', '.txt', '.md')):
-                    file_path = os.path.join(root, file)
-                    print(f"正在处理文件: {file_path}")
-                    
-                    try:
-                        # 1. 解析
-                        doc = self.parser.parse(file_path)
-                        # 2. 切分
-                        chunks = self.chunker.chunk_document(doc)
-                        
-                        # 3. 生成 Embeddings (批量异步)
-                        texts = [c.text for c in chunks]
-                        embeddings = await self.embedding_service.embed_documents(texts)
-                        
-                        # 4. 暂存
-                        for chunk, emb in zip(chunks, embeddings):
-                            self.metadata_storage.save_chunk(chunk)
-                            all_chunks.append(chunk)
-                            all_embeddings.append(emb)
-                    except Exception as e:
-                        print(f"处理文件 {file_path} 失败: {e}")
+        for entry in walk_files(directory_path, INGEST_EXTENSIONS):
+            file_path = entry.path
+            print(f"正在处理文件: {file_path}")
+            
+            try:
+                # 1. 解析
+                doc = self.parser.parse(file_path)
+                # 2. 切分
+                chunks = self.chunker.chunk_document(doc)
+                
+                # 3. 生成 Embeddings (批量异步)
+                texts = [c.text for c in chunks]
+                embeddings = await self.embedding_service.embed_documents(texts)
+                
+                # 4. 暂存（每个文件写回一次元数据文件）
+                for chunk, emb in zip(chunks, embeddings):
+                    self.metadata_storage.save_chunk(chunk, flush=False)
+                    all_chunks.append(chunk)
+                    all_embeddings.append(emb)
+                self.metadata_storage.save_to_file()
+            except Exception as e:
+                print(f"处理文件 {file_path} 失败: {e}")
         
         # 5. 构建并保存索引
         chunk_ids = [c.chunk_id for c in all_chunks]
@@ -315,7 +449,7 @@ class RAGPipeline:
             raise FileNotFoundError(f"文档目录不存在: {documents_dir}")
         
         # 获取所有 PDF 文件
-        pdf_files = list(documents_dir.glob("*.pdf"))
+        pdf_files = [Path(entry.path) for entry in scan_files(documents_dir, ".pdf")]
         
         if not pdf_files:
             print(f"在 {documents_dir} 中未找到 PDF 文件")
@@ -323,57 +457,164 @@ class RAGPipeline:
         
         print(f"找到 {len(pdf_files)} 个 PDF 文件，开始处理...")
         
-        processed_count = 0
-        failed_count = 0
-        
-        for pdf_file in tqdm(pdf_files, desc="处理 PDF 文档"):
+        counts = {"processed": 0, "skipped": 0, "failed": 0}
+        progress = tqdm(total=len(pdf_files), desc="处理 PDF 文档")
+        
+        def report(pdf_file: Path, outcome: str, error: Optional[BaseException] = None):
+            counts[outcome] += 1
+            if error is not None:
+                print(f"✗ 处理失败 {pdf_file.name}: {error}")
+                traceback.print_exception(type(error), error, error.__traceback__)
+            progress.update(1)
+        
+        # 先在线程池中并行计算全部 PDF 的 SHA1（hashlib 计算时释放 GIL），据此过滤已处理的文件，
+        # 只为待处理的文件启动生产者
+        sha1_results = await asyncio.gather(
+            *(asyncio.to_thread(calculate_file_sha1_cached, pdf_file) for pdf_file in pdf_files),
+            return_exceptions=True
+        )
+        pending = []
+        for pdf_file, pdf_sha1 in zip(pdf_files, sha1_results):
+            if isinstance(pdf_sha1, BaseException):
+                report(pdf_file, "failed", pdf_sha1)
+            elif skip_existing and self._is_processed(pdf_file, pdf_sha1):
+                print(f"跳过已处理的文件: {pdf_file.name}")
+                report(pdf_file, "skipped")
+            else:
+                pending.append((pdf_file, pdf_sha1))
+        
+        # 生产者（PDF 解析 + 切分，CPU 密集）与消费者（embedding + FAISS，网络密集）流水线并行：
+        # 生产者把内存中的切分结果放入有界队列，消费者取出后生成向量索引，解析下一个文档的同时
+        # 为上一个文档请求 embedding；队列写满时生产者阻塞，限制积压的文档数
+        sem = asyncio.Semaphore(self.ingest_concurrency)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+        num_consumers = self.ingest_concurrency
+        
+        async def produce(pdf_file: Path, pdf_sha1: str):
+            async with sem:
+                try:
+                    chunk_report = await self._chunk_one_pdf(pdf_file, pdf_sha1)
+                except Exception as e:
+                    report(pdf_file, "failed", e)
+                    return
+                await queue.put((pdf_file, chunk_report))
+        
+        async def producer():
             try:
-                # 计算 PDF 的 SHA1
-                pdf_sha1 = calculate_file_sha1(pdf_file)
-                
-                # 检查是否已处理（如果启用跳过）
-                if skip_existing:
-                    chunk_json_path = self.paths.chunked_reports_dir / f"{pdf_file.stem}.json"
-                    faiss_path = self.paths.vector_dbs_dir / f"{pdf_sha1}.faiss"
-                    
-                    if chunk_json_path.exists() and faiss_path.exists():
-                        print(f"跳过已处理的文件: {pdf_file.name}")
-                        continue
-                
-                # 步骤 1: PDF → Markdown
-                print(f"\n[1/3] 转换 PDF 为 Markdown: {pdf_file.name}")
-                md_path = self.pdf_to_markdown.convert_pdf_to_markdown(
-                    str(pdf_file),
-                    str(self.paths.markdown_dir)
-                )
-                
-                # 步骤 2: Markdown → Chunks (保存为 JSON)
-                print(f"[2/3] 切分 Markdown 为 Chunks: {pdf_file.name}")
-                chunk_json_path = self.paths.chunked_reports_dir / f"{pdf_file.stem}.json"
-                self.chunker.chunk_markdown_and_save(
-                    md_path=str(md_path),
-                    output_path=str(chunk_json_path),
-                    sha1=pdf_sha1,
-                    company_name=None  # 可以后续从配置文件读取
-                )
-                
-                # 步骤 3: Chunks → Embeddings → FAISS
-                print(f"[3/3] 生成向量索引: {pdf_file.name}")
-                await self.vector_db.process_chunk_json(
-                    chunk_json_path=str(chunk_json_path),
-                    output_dir=str(self.paths.vector_dbs_dir)
-                )
-                
-                processed_count += 1
-                print(f"✓ 完成处理: {pdf_file.name}")
-                
-            except Exception as e:
-                failed_count += 1
-                print(f"✗ 处理失败 {pdf_file.name}: {e}")
-                import traceback
-                traceback.print_exc()
+                await asyncio.gather(*(produce(pdf_file, pdf_sha1) for pdf_file, pdf_sha1 in pending))
+            finally:
+                for _ in range(num_consumers):
+                    await queue.put(None)
+        
+        async def consumer():
+            # 多个消费者并发时，各文档的 embedding 请求由 EmbeddingBatcher 合并为整批
+            while (item := await queue.get()) is not None:
+                pdf_file, chunk_report = item
+                try:
+                    await self._index_one_pdf(pdf_file, chunk_report)
+                except Exception as e:
+                    report(pdf_file, "failed", e)
+                else:
+                    report(pdf_file, "processed")
+        
+        try:
+            await asyncio.gather(producer(), *(consumer() for _ in range(num_consumers)))
+        finally:
+            progress.close()
+        
+        print(f"\n处理完成！成功: {counts['processed']}, 跳过: {counts['skipped']}, 失败: {counts['failed']}")
+    
+    def _is_processed(self, pdf_file: Path, pdf_sha1: str) -> bool:
+        """chunk JSON 与 FAISS 索引均已存在时视为已处理"""
+        chunk_json_path = self.paths.chunked_reports_dir / f"{pdf_file.stem}.json"
+        faiss_path = self.paths.vector_dbs_dir / f"{pdf_sha1}.faiss"
+        return chunk_json_path.exists() and faiss_path.exists()
+    
+    async def _chunk_one_pdf(self, pdf_file: Path, pdf_sha1: str) -> dict:
+        """
+        处理单个 PDF 的前两步：PDF → Markdown → Chunks
         
-        print(f"\n处理完成！成功: {processed_count}, 失败: {failed_count}")
+        Args:
+            pdf_file: PDF 文件路径
+            pdf_sha1: PDF 的 SHA1
+            
+        Returns:
+            切分结果（与 chunk JSON 文件内容相同）
+        """
+        chunk_json_path = self.paths.chunked_reports_dir / f"{pdf_file.stem}.json"
+        
+        # 步骤 1: PDF → Markdown
+        print(f"\n[1/3] 转换 PDF 为 Markdown: {pdf_file.name}")
+        md_path = await self.pdf_to_markdown.aconvert_pdf_to_markdown(
+            str(pdf_file),
+            str(self.paths.markdown_dir),
+            executor=self._get_pdf_executor()
+        )
+        
+        # 步骤 2: Markdown → Chunks (保存为 JSON，同时把内存中的结果交给下一步，无需重新读取)
+        print(f"[2/3] 切分 Markdown 为 Chunks: {pdf_file.name}")
+        chunk_report = await asyncio.to_thread(
+            self.chunker.chunk_markdown,
+            md_path=str(md_path),
+            sha1=pdf_sha1,
+            company_name=None  # 可以后续从配置文件读取
+        )
+        await asyncio.to_thread(write_json, chunk_json_path, chunk_report)
+        return chunk_report
+    
+    async def _index_one_pdf(self, pdf_file: Path, chunk_report: dict):
+        """
+        处理单个 PDF 的第三步：Chunks → Embeddings → FAISS
+        
+        Args:
+            pdf_file: PDF 文件路径
+            chunk_report: _chunk_one_pdf 返回的切分结果
+        """
+        print(f"[3/3] 生成向量索引: {pdf_file.name}")
+        await self.vector_db.process_chunk_report(
+            chunk_report,
+            output_dir=str(self.paths.vector_dbs_dir),
+            source=pdf_file.name
+        )
+        print(f"✓ 完成处理: {pdf_file.name}")
+    
+    def _get_pdf_executor(self) -> ProcessPoolExecutor:
+        """
+        获取 PDF 解析进程池（首次使用时创建）
+        
+        子进程以 spawn 方式启动，与 pdf_to_markdown 的分片进程池相同：Pipeline 运行在多线程的 API 进程中，
+        fork 会把其他线程持有的锁复制到子进程中，可能导致子进程死锁。
+        """
+        if self._pdf_executor is None:
+            self._pdf_executor = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pdf_executor
+    
+    def shutdown(self):
+        """释放进程池资源"""
+        if self._pdf_executor is not None:
+            self._pdf_executor.shutdown(wait=False, cancel_futures=True)
+            self._pdf_executor = None
+    
+    async def aclose(self):
+        """关闭共享服务的 HTTP 连接池，并释放进程池"""
+        self.shutdown()
+        await aclose_services()
+
+
+@lru_cache(maxsize=8)
+def _get_single_pdf_pipeline(base_dir: str) -> RAGPipeline:
+    """按 base_dir 缓存 process_single_pdf 使用的 Pipeline，连续处理多个文件时不再重复初始化"""
+    paths = PipelinePaths(
+        base_dir=base_dir,
+        documents_dir="documents",
+        markdown_dir="debug_data",
+        chunked_reports_dir="metadata/chunked_reports",
+        vector_dbs_dir="metadata/vector_dbs"
+    )
+    return RAGPipeline(paths=paths)
 
 
 async def process_single_pdf(
@@ -413,28 +654,20 @@ async def process_single_pdf(
     print(f"📁 文件大小: {pdf_path.stat().st_size / 1024 / 1024:.2f} MB")
     print(f"📂 基础目录: {base_dir}\n")
     
-    # 配置路径
-    paths = PipelinePaths(
-        base_dir=base_dir,
-        documents_dir="documents",
-        markdown_dir="debug_data",
-        chunked_reports_dir="metadata/chunked_reports",
-        vector_dbs_dir="metadata/vector_dbs"
-    )
-    
-    # 创建 Pipeline 实例
-    pipeline = RAGPipeline(paths=paths)
+    # 获取（按 base_dir 复用的）Pipeline 实例
+    pipeline = _get_single_pdf_pipeline(base_dir)
+    paths = pipeline.paths
     
     try:
         # 计算 PDF 的 SHA1
-        pdf_sha1 = calculate_file_sha1(pdf_path)
+        pdf_sha1 = calculate_file_sha1_cached(pdf_path)
         print(f"🔐 SHA1: {pdf_sha1}\n")
         
         # 步骤 1: PDF → Markdown
         print("-" * 60)
         print("步骤 1/4: PDF → Markdown 转换")
         print("-" * 60)
-        md_path = pipeline.pdf_to_markdown.convert_pdf_to_markdown(
+        md_path = await pipeline.pdf_to_markdown.aconvert_pdf_to_markdown(
             str(pdf_path),
             str(paths.markdown_dir)
         )
@@ -445,23 +678,21 @@ async def process_single_pdf(
         print("步骤 2/4: Markdown → Chunks 切分")
         print("-" * 60)
         chunk_json_path = paths.chunked_reports_dir / f"{pdf_path.stem}.json"
-        pipeline.chunker.chunk_markdown_and_save(
+        chunk_report = pipeline.chunker.chunk_markdown(
             md_path=str(md_path),
-            output_path=str(chunk_json_path),
             sha1=pdf_sha1,
             company_name=company_name,
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap
         )
+        write_json(chunk_json_path, chunk_report)
+        chunks = chunk_report["content"]["chunks"]
+        chunk_count = len(chunks)
         
-        # 读取并显示 chunk 统计信息
-        with open(chunk_json_path, 'r', encoding='utf-8') as f:
-            chunk_data = json.load(f)
-        
-        chunk_count = len(chunk_data['content']['chunks'])
+        # 显示 chunk 统计信息
         print(f"✅ Chunk JSON 文件已保存: {chunk_json_path}")
         print(f"   - 共生成 {chunk_count} 个 chunks")
-        print(f"   - SHA1: {chunk_data['metainfo']['sha1']}")
+        print(f"   - SHA1: {pdf_sha1}")
         
         # 步骤 3: Chunks → Embeddings
         print("\n" + "-" * 60)
@@ -469,11 +700,9 @@ async def process_single_pdf(
         print("-" * 60)
         print(f"   正在为 {chunk_count} 个 chunks 生成 embeddings...")
         
-        # 提取所有 chunk 文本
-        chunks = chunk_data['content']['chunks']
-        texts = [chunk['text'] for chunk in chunks]
-        
-        embeddings = await pipeline.embedding_service.embed_documents(texts)
+        # 直接使用内存中的 chunk 文本，无需重新读取刚写入的 JSON
+        texts, chunk_ids = pipeline.vector_db.extract_texts(chunks, pdf_sha1)
+        embeddings = await pipeline.vector_db.embed_texts(texts, use_batcher=False)
         print(f"✅ 成功生成 {len(embeddings)} 个 embeddings")
         print(f"   - Embedding 维度: {len(embeddings[0])}")
         
@@ -481,10 +710,8 @@ async def process_single_pdf(
         print("\n" + "-" * 60)
         print("步骤 4/4: 创建并保存 FAISS 向量索引")
         print("-" * 60)
-        faiss_path = await pipeline.vector_db.process_chunk_json(
-            chunk_json_path=str(chunk_json_path),
-            output_dir=str(paths.vector_dbs_dir)
-        )
+        # 复用步骤 3 的 embeddings 构建索引
+        faiss_path = pipeline.vector_db.save_index(embeddings, chunk_ids, pdf_sha1, paths.vector_dbs_dir)
         
         print(f"✅ FAISS 索引文件已保存: {faiss_path}")
         
@@ -517,7 +744,6 @@ async def process_single_pdf(
 
 if __name__ == "__main__":
     import sys
-    import asyncio
     from pathlib import Path
     
     # 添加项目根目录到 Python 路径，确保可以导入 app 模块
@@ -529,6 +755,8 @@ if __name__ == "__main__":
     if str(backend_dir) not in sys.path:
         sys.path.insert(0, str(backend_dir))
     
+    from app.utils.async_utils import run as run_async
+    
     # 解析命令行参数
     base_dir = "./data"
     documents_dir = None
@@ -584,7 +812,7 @@ if __name__ == "__main__":
     print()
     
     try:
-        asyncio.run(pipeline.process_documents(
+        run_async(pipeline.process_documents(
             documents_dir=documents_dir,
             skip_existing=skip_existing
         ))
@@ -0,0 +1,64 @@
+"""
+共享服务注册表
+各服务在首次获取时创建，之后在进程内复用：
+避免每个 RAGPipeline / DocumentProcessor 重复加载 tokenizer、FAISS 索引、BM25 与 HTTP 连接池
+"""
+from functools import lru_cache
+
+from app.services.chunking import DocumentChunker
+from app.services.embedding import EmbeddingService
+from app.services.llm import LLMService, get_llm
+from app.services.pdf_to_markdown import PDFToMarkdownService
+from app.services.rerank import RerankService
+from app.services.retrieval import RetrievalService
+from app.utils.parser import DocumentParser
+
+
+@lru_cache(maxsize=1)
+def get_embedding_service() -> EmbeddingService:
+    """获取共享的 EmbeddingService（线程池、查询缓存与文档向量缓存在各处共用）"""
+    return EmbeddingService()
+
+
+@lru_cache(maxsize=1)
+def get_rerank_service() -> RerankService:
+    """获取共享的 RerankService"""
+    return RerankService()
+
+
+@lru_cache(maxsize=1)
+def get_retrieval_service() -> RetrievalService:
+    """获取共享的 RetrievalService（FAISS 索引与 BM25 只构建一次）"""
+    return RetrievalService(
+        embedding_service=get_embedding_service(),
+        rerank_service=get_rerank_service()
+    )
+
+
+def get_llm_service() -> LLMService:
+    """获取共享的 LLMService（启用语义缓存时复用共享的 EmbeddingService）"""
+    return get_llm(embedding_service=get_embedding_service())
+
+
+@lru_cache(maxsize=1)
+def get_chunker() -> DocumentChunker:
+    """获取共享的 DocumentChunker（tiktoken 编码只加载一次）"""
+    return DocumentChunker()
+
+
+@lru_cache(maxsize=1)
+def get_document_parser() -> DocumentParser:
+    """获取共享的 DocumentParser"""
+    return DocumentParser()
+
+
+@lru_cache(maxsize=1)
+def get_pdf_to_markdown() -> PDFToMarkdownService:
+    """获取共享的 PDFToMarkdownService"""
+    return PDFToMarkdownService()
+
+
+async def aclose_services():
+    """关闭共享服务持有的 HTTP 连接池（之后再次使用时会按需重建）"""
+    await get_llm_service().aclose()
+    await get_rerank_service().aclose()
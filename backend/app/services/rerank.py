@@ -2,10 +2,13 @@
 重排服务
 使用 Jina Reranker API 对检索结果进行重排
 """
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import os
-import requests
+import asyncio
 import logging
+import httpx
+
+from app.services.rerank_cache import RerankCache
 
 logger = logging.getLogger(__name__)
 
@@ -28,15 +31,48 @@ class RerankService:
             "https://api.jina.ai/v1/rerank"
         )
         self.model = os.getenv("JINA_RERANK_MODEL", "jina-reranker-v2-base-multilingual")
+        
+        # 复用的 HTTP 客户端（连接池），首次调用时在当前事件循环中创建
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+        # 进行中的重排请求，相同的并发请求共用一次 API 调用
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        # (查询, 文档) → 相关性分数的持久化缓存（SQLite），RERANK_CACHE_PATH 为空时关闭
+        cache_path = os.getenv("RERANK_CACHE_PATH", "./data/cache/rerank.sqlite3")
+        self._cache: Optional[RerankCache] = RerankCache(cache_path) if cache_path else None
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """
+        获取复用的 httpx 客户端
+        
+        保持长连接，后续请求省去 TCP/TLS 握手；连接池与事件循环绑定，事件循环变化时重新创建。
+        """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=30,
+                limits=httpx.Limits(max_keepalive_connections=32)
+            )
+            self._client_loop = loop
+        return self._client
     
-    def rerank(
+    async def aclose(self):
+        """关闭 HTTP 客户端，释放连接池"""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+        self._client_loop = None
+    
+    async def rerank(
         self, 
         query: str, 
         documents: List[Dict], 
         top_k: int = 10
     ) -> List[Dict]:
         """
-        对检索结果进行重排
+        对检索结果进行重排 (异步)
         
         Args:
             query: 查询文本
@@ -54,60 +90,118 @@ class RerankService:
             return sorted(documents, key=lambda x: x.get("similarity", 0.0), reverse=True)[:top_k]
         texts = [doc.get("text", "") for doc in documents]
         
-        # 调用 Jina Reranker API
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        payload = {
-            "model": self.model,
-            "query": query,
-            "documents": texts,
-            "top_n": top_k
-        }
-        
         try:
-            response = requests.post(
-                self.base_url,
-                json=payload,
-                headers=headers,
-                timeout=30
-            )
-            response.raise_for_status()
-            result = response.json()
-            
-            # 解析返回结果
-            reranked_results = []
-            if "results" in result:
-                for item in result["results"]:
-                    # 获取原始文档索引
-                    doc_index = item.get("index", 0)
-                    if doc_index < len(documents):
-                        original_doc = documents[doc_index].copy()
-                        # 更新相似度分数
-                        original_doc["similarity"] = item.get("relevance_score", 0.0)
-                        original_doc["rerank_score"] = item.get("relevance_score", 0.0)
-                        reranked_results.append(original_doc)
-            
-            return reranked_results
-            
-        except requests.exceptions.RequestException as e:
+            scores = await self._scores(query, texts, top_k)
+        except httpx.HTTPError as e:
             # 如果 API 调用失败，返回原始结果（按原始相似度排序）
             logger.error(f"Jina Reranker API 调用失败: {e}")
-            sorted_docs = sorted(
-                documents, 
-                key=lambda x: x.get("similarity", 0.0), 
-                reverse=True
-            )
-            return sorted_docs[:top_k]
+            return self._fallback(documents, top_k)
         except Exception as e:
             # 处理其他异常
             logger.error(f"Jina Reranker 处理异常: {e}")
-            sorted_docs = sorted(
-                documents, 
-                key=lambda x: x.get("similarity", 0.0), 
-                reverse=True
-            )
-            return sorted_docs[:top_k]
-
+            return self._fallback(documents, top_k)
+        
+        reranked_results = []
+        for doc_index, score in scores:
+            if doc_index < len(documents):
+                original_doc = documents[doc_index].copy()
+                # 更新相似度分数
+                original_doc["similarity"] = score
+                original_doc["rerank_score"] = score
+                reranked_results.append(original_doc)
+        return reranked_results
+    
+    async def batch_rerank(
+        self,
+        requests: List[Tuple[str, List[Dict]]],
+        top_k: int = 10
+    ) -> List[List[Dict]]:
+        """
+        同时重排多组 (查询, 检索结果)
+        
+        Jina Reranker 每次请求只接受一个查询，这里并发发出各组请求，
+        在同一个 HTTP/2 连接上多路复用；相同的请求只调用一次 API。
+        
+        Args:
+            requests: (查询文本, 检索结果列表) 的列表
+            top_k: 每组返回 Top-K 结果
+            
+        Returns:
+            与 requests 一一对应的重排结果
+        """
+        if len(requests) == 1:
+            query, documents = requests[0]
+            return [await self.rerank(query, documents, top_k)]
+        return list(await asyncio.gather(
+            *(self.rerank(query, documents, top_k) for query, documents in requests)
+        ))
+    
+    async def _scores(self, query: str, texts: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """
+        获取重排分数，相同的并发请求（查询、文档与 top_k 都相同）共用一次 API 调用
+        
+        Returns:
+            (文档索引, 相关性分数) 列表，按相关性从高到低排序
+        """
+        key = (id(asyncio.get_running_loop()), query, tuple(texts), top_k)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._request_scores(query, texts, top_k))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            logger.debug("[Rerank] 复用进行中的相同重排请求")
+        # shield：某个调用方被取消时不影响其他等待同一请求的调用方
+        return await asyncio.shield(task)
+    
+    async def _request_scores(self, query: str, texts: List[str], top_k: int) -> List[Tuple[int, float]]:
+        """
+        调用 Jina Reranker API，返回 (文档索引, 相关性分数) 列表
+        
+        启用持久化缓存时先查缓存，只对未命中的文档调用 API，并取回它们的全部分数写入缓存
+        （交叉编码器的分数只取决于查询与单个文档，可与缓存分数合并排序）。
+        """
+        if self._cache is None:
+            return await self._post_scores(query, texts, top_k)
+        
+        keys = [RerankCache.make_key(self.model, query, text) for text in texts]
+        cached = await asyncio.to_thread(self._cache.get_many, keys)
+        scores = {i: cached[key] for i, key in enumerate(keys) if key in cached}
+        miss_rows = [i for i in range(len(texts)) if i not in scores]
+        if miss_rows:
+            miss_scores = await self._post_scores(query, [texts[i] for i in miss_rows], len(miss_rows))
+            fresh = {miss_rows[j]: score for j, score in miss_scores if j < len(miss_rows)}
+            scores.update(fresh)
+            try:
+                await asyncio.to_thread(self._cache.put_many, {keys[i]: score for i, score in fresh.items()})
+            except Exception as e:
+                logger.warning(f"[Rerank] 写入持久化缓存失败: {e}")
+        if cached:
+            logger.debug(f"[Rerank] 持久化缓存命中 {len(texts) - len(miss_rows)}/{len(texts)} 个文档")
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    
+    async def _post_scores(self, query: str, texts: List[str], top_n: int) -> List[Tuple[int, float]]:
+        """发送一次 Jina Reranker API 请求，返回 (文档索引, 相关性分数) 列表"""
+        payload = {
+            "model": self.model,
+            "query": query,
+            "documents": texts,
+            "top_n": top_n
+        }
+        response = await self._get_client().post(self.base_url, json=payload)
+        response.raise_for_status()
+        result = response.json()
+        return [
+            (item.get("index", 0), item.get("relevance_score", 0.0))
+            for item in result.get("results", [])
+        ]
+    
+    @staticmethod
+    def _fallback(documents: List[Dict], top_k: int) -> List[Dict]:
+        """重排失败时按原始相似度排序返回"""
+        sorted_docs = sorted(
+            documents, 
+            key=lambda x: x.get("similarity", 0.0), 
+            reverse=True
+        )
+        return sorted_docs[:top_k]
@@ -0,0 +1,87 @@
+"""
+重排分数持久化缓存
+以 sha256(模型名 + 查询 + 文档文本) 为键，将 Jina Reranker 返回的相关性分数存入 SQLite，
+相同查询再次检索到相同 chunk 时无需再次调用重排 API
+"""
+import hashlib
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Union
+
+logger = logging.getLogger(__name__)
+
+# SQLite 单条语句的参数个数上限（旧版本为 999）
+_MAX_SQL_VARIABLES = 900
+
+
+class RerankCache:
+    """基于 SQLite（WAL 模式）的重排分数缓存"""
+
+    def __init__(self, path: Union[str, Path]):
+        """
+        打开（或创建）缓存数据库
+
+        Args:
+            path: SQLite 数据库文件路径
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # 连接在线程池中共享使用，由 _lock 串行化访问
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS score (key BLOB PRIMARY KEY, value REAL NOT NULL) WITHOUT ROWID"
+        )
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, query: str, text: str) -> bytes:
+        """计算缓存键：sha256(模型名 + 查询 + 文档文本)"""
+        return hashlib.sha256(f"{model}\0{query}\0{text}".encode("utf-8")).digest()
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, float]:
+        """
+        批量查询缓存
+
+        Args:
+            keys: 缓存键列表
+
+        Returns:
+            命中的 键 → 相关性分数
+        """
+        found: Dict[bytes, float] = {}
+        with self._lock:
+            for i in range(0, len(keys), _MAX_SQL_VARIABLES):
+                part = keys[i:i + _MAX_SQL_VARIABLES]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM score WHERE key IN ({placeholders})", part
+                ).fetchall()
+                found.update(rows)
+        return found
+
+    def put_many(self, items: Dict[bytes, float]):
+        """
+        批量写入缓存（单个事务提交）
+
+        Args:
+            items: 键 → 相关性分数
+        """
+        if not items:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("INSERT OR REPLACE INTO score (key, value) VALUES (?, ?)", items.items())
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
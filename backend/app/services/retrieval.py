@@ -2,31 +2,113 @@
 检索服务
 整合向量检索、重排等流程
 """
+import asyncio
+import hashlib
+import heapq
 import logging
+import multiprocessing
 import time
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from typing import List, Dict, Tuple, Optional, Set
-from rank_bm25 import BM25Okapi
-import jieba
+try:
+    # jieba 的 C 扩展实现（可选），分词结果相同、速度更快
+    import jieba_fast as jieba
+except ImportError:
+    import jieba
 from app.services.embedding import EmbeddingService
 from app.services.rerank import RerankService
+from app.services.search_batcher import FaissSearchBatcher
+from app.storage.bm25_index import BM25Index
 from app.storage.faiss_index import FAISSIndex
 from app.storage.metadata import MetadataStorage
+from app.utils.cache_utils import LRUCache
 
 logger = logging.getLogger(__name__)
 
+# BM25 查询分词与检索结果的 LRU 缓存条目数（0 关闭）
+BM25_QUERY_CACHE_SIZE = int(os.getenv("BM25_QUERY_CACHE_SIZE", "4096"))
+# BM25 索引缓存文件（语料未变化时跳过分词与构建），留空关闭
+BM25_CACHE_PATH = os.getenv("BM25_CACHE_PATH", "./data/metadata/bm25_cache.pkl")
+# 构建 BM25 时分词的进程数；chunk 数少于 _PARALLEL_TOKENIZE_MIN_CHUNKS 时在当前进程分词
+BM25_TOKENIZE_WORKERS = int(os.getenv("BM25_TOKENIZE_WORKERS", str(os.cpu_count() or 1)))
+_PARALLEL_TOKENIZE_MIN_CHUNKS = 2000
+
+
+def _init_tokenizer():
+    """进程池子进程启动时加载 jieba 词典（需为模块级函数）"""
+    jieba.initialize()
+
+
+def _tokenize_text(text: str) -> List[str]:
+    """jieba 分词（进程池任务，需为模块级函数）"""
+    return list(jieba.cut(text))
+
+
+def _tokenize_corpus(texts: List[str]) -> List[List[str]]:
+    """
+    对语料分词，chunk 较多时使用进程池并行（jieba 为纯 Python 实现，受 GIL 限制）
+    
+    Args:
+        texts: 文本列表
+        
+    Returns:
+        与 texts 一一对应的分词结果
+    """
+    if BM25_TOKENIZE_WORKERS > 1 and len(texts) >= _PARALLEL_TOKENIZE_MIN_CHUNKS:
+        # 以 spawn 方式启动子进程：服务进程中已有 FAISS/OpenMP、httpx、SQLite 等线程，fork 可能使子进程死锁。
+        # spawn 出的子进程不继承父进程已加载的词典，由 initializer 在各子进程启动时加载一次
+        with ProcessPoolExecutor(
+            max_workers=BM25_TOKENIZE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_tokenizer
+        ) as executor:
+            return list(executor.map(_tokenize_text, texts, chunksize=64))
+    return [_tokenize_text(text) for text in texts]
+
+
+def _corpus_key(chunks: List[Dict]) -> str:
+    """计算 BM25 语料指纹：分词器与各 chunk 的 chunk_id、文本"""
+    digest = hashlib.sha1(jieba.__name__.encode("utf-8"))
+    for chunk in chunks:
+        digest.update(b"\0")
+        digest.update(chunk['chunk_id'].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(chunk['text'].encode("utf-8"))
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=max(BM25_QUERY_CACHE_SIZE, 0))
+def _tokenize_query(query: str) -> Tuple[str, ...]:
+    """jieba 分词（按查询缓存，重复查询省去一次分词）"""
+    return tuple(jieba.cut(query))
+
+
 class RetrievalService:
     """检索服务类，整合向量检索和关键字检索（BM25）"""
     
-    def __init__(self):
+    def __init__(
+        self,
+        embedding_service: Optional[EmbeddingService] = None,
+        rerank_service: Optional[RerankService] = None
+    ):
+        """
+        Args:
+            embedding_service: Embedding 服务实例，为 None 时新建
+            rerank_service: 重排服务实例，为 None 时新建
+        """
         logger.info("[Retrieval] 初始化RetrievalService...")
-        self.embedding_service = EmbeddingService()
-        self.rerank_service = RerankService()
+        self.embedding_service = embedding_service or EmbeddingService()
+        self.rerank_service = rerank_service or RerankService()
         
         # 初始化FAISS索引（需要设置index_dir以支持按文档存储模式）
         index_dir = os.getenv("FAISS_INDEX_DIR", "./data/metadata/vector_dbs")
         logger.info(f"[Retrieval] FAISS索引目录: {index_dir}")
         self.faiss_index = FAISSIndex(index_dir=index_dir)
+        # 并发请求的查询向量合并为一次 FAISS 检索
+        self.search_batcher = FaissSearchBatcher(self.faiss_index)
         
         # 使用默认路径初始化MetadataStorage
         chunked_reports_dir = os.getenv("CHUNKED_REPORTS_DIR", "./data/metadata/chunked_reports")
@@ -37,9 +119,22 @@ class RetrievalService:
         
         self.bm25 = None
         self.bm25_chunk_ids = []
-        self._init_bm25()
+        # 相同查询的 BM25 检索结果缓存，BM25 索引重建时清空
+        self._bm25_cache = LRUCache(maxsize=BM25_QUERY_CACHE_SIZE)
+        # BM25 索引在首次混合检索时才构建（或从缓存读取），只做向量检索 / 入库的进程无需承担这部分开销
+        self._bm25_loaded = False
+        self._bm25_lock = threading.Lock()
         logger.info("[Retrieval] RetrievalService初始化完成")
     
+    def ensure_bm25(self):
+        """确保 BM25 索引已初始化（线程安全，只初始化一次）；可在启动后于后台线程中调用以预热"""
+        if self._bm25_loaded:
+            return
+        with self._bm25_lock:
+            if not self._bm25_loaded:
+                self._init_bm25()
+                self._bm25_loaded = True
+    
     def _init_bm25(self):
         """初始化 BM25 索引"""
         chunks = list(self.metadata_storage.chunks.values())
@@ -49,11 +144,24 @@ class RetrievalService:
             logger.warning(f"[Retrieval] 这通常意味着chunks.json文件不存在或为空，或者chunk JSON文件未被加载")
             return
             
-        # 使用 jieba 对中文进行分词
-        logger.info(f"[Retrieval] 开始对 {len(chunks)} 个chunks进行jieba分词...")
-        tokenized_corpus = [list(jieba.cut(chunk['text'])) for chunk in chunks]
-        self.bm25 = BM25Okapi(tokenized_corpus)
+        # 语料未变化时直接读取缓存的 BM25 索引
+        corpus_key = _corpus_key(chunks)
+        bm25 = BM25Index.load(BM25_CACHE_PATH, corpus_key) if BM25_CACHE_PATH else None
+        if bm25 is not None:
+            logger.info(f"[Retrieval] 语料未变化，使用缓存的BM25索引: {BM25_CACHE_PATH}")
+        else:
+            # 使用 jieba 对中文进行分词
+            logger.info(f"[Retrieval] 开始对 {len(chunks)} 个chunks进行jieba分词...")
+            tokenized_corpus = _tokenize_corpus([chunk['text'] for chunk in chunks])
+            bm25 = BM25Index(tokenized_corpus)
+            if BM25_CACHE_PATH:
+                try:
+                    bm25.save(BM25_CACHE_PATH, corpus_key)
+                except OSError as e:
+                    logger.warning(f"[Retrieval] 保存BM25索引缓存失败: {e}")
+        self.bm25 = bm25
         self.bm25_chunk_ids = [chunk['chunk_id'] for chunk in chunks]
+        self._bm25_cache.clear()
         logger.info(f"[Retrieval] BM25索引初始化完成，chunk_ids数量: {len(self.bm25_chunk_ids)}")
         if len(self.bm25_chunk_ids) > 0:
             logger.debug(f"[Retrieval] 示例chunk_id: {self.bm25_chunk_ids[0]}")
@@ -78,13 +186,26 @@ class RetrievalService:
         
         return matched_chunk_ids
     
+    @staticmethod
+    def _filter_results(
+        results: List[Tuple[str, float]],
+        allowed_chunk_ids: Set[str]
+    ) -> List[Tuple[str, float]]:
+        """
+        只保留 chunk_id 在 allowed_chunk_ids 中的 (chunk_id, score)，保持原有顺序
+        
+        检索结果最多 50 条，逐条哈希查找比转换为 numpy 数组后 np.isin 更快。
+        """
+        return [(cid, score) for cid, score in results if cid in allowed_chunk_ids]
+    
     async def search(
         self, 
         query: str, 
         top_k: int = 10,
         search_mode: int = 2,
         product_name: Optional[str] = None,
-        document_sha1: Optional[str] = None
+        document_sha1: Optional[str] = None,
+        ef_search: Optional[int] = None
     ) -> List[Dict]:
         """
         检索流程 (异步)
@@ -95,6 +216,7 @@ class RetrievalService:
             search_mode: 搜索模式，1=纯向量搜索，2=混合检索+rerank
             product_name: 可选的产品名称，用于过滤相关文档
             document_sha1: 可选的文档SHA1，用于限定搜索范围
+            ef_search: 可选，HNSW 索引检索时的 efSearch（越大召回越高、越慢）
         """
         search_start = time.time()
         logger.info(f"[Retrieval] 开始检索流程 (模式={search_mode}, top_k={top_k})")
@@ -103,24 +225,24 @@ class RetrievalService:
         step_start = time.time()
         filtered_chunk_ids = None
         if product_name:
-            filtered_chunk_ids = list(self._filter_by_document_name(product_name))
+            # 保持为集合：过滤检索结果时每个 chunk_id 为 O(1) 的哈希查找（转为列表后为 O(M) 的线性扫描）
+            filtered_chunk_ids = self._filter_by_document_name(product_name)
             logger.info(f"[Retrieval] 产品名称过滤: '{product_name}' -> {len(filtered_chunk_ids)} 个chunks (耗时: {time.time() - step_start:.2f}秒)")
             if not filtered_chunk_ids:
                 logger.warning(f"[Retrieval] 未找到匹配的文档，回退到全库搜索")
         else:
             logger.debug(f"[Retrieval] 未提供产品名称，使用全库搜索")
         
-        # 步骤2: 向量检索
+        # 步骤2: 向量检索（查询向量为网络请求）与 BM25 检索（jieba 分词 + 打分，CPU 密集，在线程中执行）并发进行
         step_start = time.time()
-        query_embedding = await self.embedding_service.embed_query(query)
-        logger.debug(f"[Retrieval] 生成查询向量完成 (维度: {len(query_embedding)})")
-        
-        # 如果指定了document_sha1，使用按文档存储模式
-        if document_sha1:
-            logger.info(f"[Retrieval] 使用文档SHA1限定搜索范围: {document_sha1[:16]}...")
-            vector_results = self.faiss_index.search(query_embedding, top_k=50, document_sha1=document_sha1)
+        if search_mode == 1:
+            vector_results = await self._vector_search(query, document_sha1, ef_search)
+            bm25_results = []
         else:
-            vector_results = self.faiss_index.search(query_embedding, top_k=50)
+            vector_results, bm25_results = await asyncio.gather(
+                self._vector_search(query, document_sha1, ef_search),
+                asyncio.to_thread(self._bm25_search, query)
+            )
         
         logger.info(f"[Retrieval] 向量检索完成，获得 {len(vector_results)} 个候选结果 (耗时: {time.time() - step_start:.2f}秒)")
         if vector_results:
@@ -129,7 +251,7 @@ class RetrievalService:
         # 如果提供了产品名称过滤，过滤向量检索结果
         if filtered_chunk_ids:
             before_count = len(vector_results)
-            vector_results = [(cid, score) for cid, score in vector_results if cid in filtered_chunk_ids]
+            vector_results = self._filter_results(vector_results, filtered_chunk_ids)
             logger.info(f"[Retrieval] 产品名称过滤后: {before_count} -> {len(vector_results)} 个结果")
         
         # 步骤3: 根据search_mode选择检索策略
@@ -166,35 +288,28 @@ class RetrievalService:
             # 混合检索模式：向量 + BM25 + rerank
             logger.info(f"[Retrieval] 使用混合检索模式 (向量 + BM25 + rerank)")
             
-            # 2. BM25 检索
-            step_start = time.time()
-            bm25_results = []
+            # 2. BM25 检索结果（已与向量检索并发完成）
             if self.bm25:
-                tokenized_query = list(jieba.cut(query))
-                scores = self.bm25.get_scores(tokenized_query)
-                # 获取前 50 个结果
-                top_n_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:50]
-                bm25_results = [(self.bm25_chunk_ids[i], float(scores[i])) for i in top_n_indices if scores[i] > 0]
-                logger.info(f"[Retrieval] BM25检索完成，获得 {len(bm25_results)} 个结果 (耗时: {time.time() - step_start:.2f}秒)")
+                logger.info(f"[Retrieval] BM25检索完成，获得 {len(bm25_results)} 个结果")
                 
                 # 如果提供了产品名称过滤，过滤BM25结果
                 if filtered_chunk_ids:
                     before_count = len(bm25_results)
-                    bm25_results = [(cid, score) for cid, score in bm25_results if cid in filtered_chunk_ids]
+                    bm25_results = self._filter_results(bm25_results, filtered_chunk_ids)
                     logger.debug(f"[Retrieval] BM25过滤后: {before_count} -> {len(bm25_results)} 个结果")
             else:
                 logger.warning(f"[Retrieval] BM25索引未初始化，跳过BM25检索")
             
             # 3. 合并结果
             step_start = time.time()
-            combined_results = self._combine_results(vector_results, bm25_results)
+            combined_results = self._combine_results(vector_results, bm25_results, top_n=20)
             logger.info(f"[Retrieval] 结果合并完成，获得 {len(combined_results)} 个合并结果 (耗时: {time.time() - step_start:.2f}秒)")
             
             # 4. 获取详细元数据
             step_start = time.time()
             chunk_details = []
             missing_chunks = []
-            for chunk_id, score in combined_results[:20]:
+            for chunk_id, score in combined_results:
                 detail = self.metadata_storage.get_chunk(chunk_id)
                 if detail:
                     detail['similarity'] = score
@@ -215,11 +330,11 @@ class RetrievalService:
                 logger.error(f"[Retrieval] 严重问题：检索到 {len(combined_results)} 个结果，但无法获取任何chunk详情！")
                 logger.error(f"[Retrieval] 请检查：1) MetadataStorage是否加载了chunks 2) chunk_id映射是否正确")
                     
-            # 5. 重排 (Jina API 目前是同步调用，或可改为异步)
+            # 5. 重排（异步调用 Jina API，复用连接池）
             if chunk_details and self.rerank_service:
                 step_start = time.time()
                 logger.info(f"[Retrieval] 开始重排，候选数量: {len(chunk_details)}")
-                reranked_results = self.rerank_service.rerank(query, chunk_details)
+                reranked_results = await self.rerank_service.rerank(query, chunk_details)
                 logger.info(f"[Retrieval] 重排完成，返回 {len(reranked_results[:top_k])} 个结果 (耗时: {time.time() - step_start:.2f}秒)")
                 
                 total_time = time.time() - search_start
@@ -230,8 +345,76 @@ class RetrievalService:
             logger.info(f"[Retrieval] 混合检索完成 (未重排)，返回 {len(chunk_details[:top_k])} 个结果，总耗时: {total_time:.2f}秒")
             return chunk_details[:top_k]
 
-    def _combine_results(self, vector_results: List[Tuple[str, float]], bm25_results: List[Tuple[str, float]]) -> List[Tuple[str, float]]:
-        """合并向量检索和 BM25 结果"""
+    async def _vector_search(
+        self,
+        query: str,
+        document_sha1: Optional[str] = None,
+        ef_search: Optional[int] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        生成查询向量并检索 FAISS 索引（经由批处理队列与并发请求合并，检索在线程中执行，不阻塞事件循环）
+        
+        Args:
+            query: 查询文本
+            document_sha1: 可选的文档SHA1，用于限定搜索范围
+            ef_search: 可选，HNSW 索引检索时的 efSearch
+            
+        Returns:
+            (chunk_id, score) 列表，最多 50 个
+        """
+        query_embedding = await self.embedding_service.embed_query(query)
+        logger.debug(f"[Retrieval] 生成查询向量完成 (维度: {len(query_embedding)})")
+        
+        # 如果指定了document_sha1，使用按文档存储模式
+        if document_sha1:
+            logger.info(f"[Retrieval] 使用文档SHA1限定搜索范围: {document_sha1[:16]}...")
+        return await self.search_batcher.search(
+            query_embedding,
+            top_k=50,
+            document_sha1=document_sha1,
+            ef_search=ef_search
+        )
+    
+    def _bm25_search(self, query: str, top_n: int = 50) -> List[Tuple[str, float]]:
+        """
+        BM25 检索（同步，CPU 密集）
+        
+        Args:
+            query: 查询文本
+            top_n: 最多返回的结果数
+            
+        Returns:
+            得分大于 0 的 (chunk_id, score) 列表，按得分从高到低排序；没有可用的 BM25 索引时为空
+        """
+        self.ensure_bm25()
+        if not self.bm25:
+            return []
+        key = (query, top_n)
+        results = self._bm25_cache.get(key)
+        if results is None:
+            hits = self.bm25.top_n(_tokenize_query(query), top_n)
+            results = [(self.bm25_chunk_ids[i], score) for i, score in hits]
+            self._bm25_cache.set(key, results)
+        # 返回副本，调用方过滤结果时不影响缓存
+        return list(results)
+    
+    def _combine_results(
+        self,
+        vector_results: List[Tuple[str, float]],
+        bm25_results: List[Tuple[str, float]],
+        top_n: Optional[int] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        合并向量检索和 BM25 结果
+        
+        Args:
+            vector_results: 向量检索的 (chunk_id, score) 列表
+            bm25_results: BM25 检索的 (chunk_id, score) 列表
+            top_n: 只需要前 top_n 个结果时用堆选取，不对全部候选排序
+            
+        Returns:
+            按融合分数从高到低排序的 (chunk_id, score) 列表
+        """
         # 简单权重融合
         scores = {}
         for cid, dist in vector_results:
@@ -246,6 +429,8 @@ class RetrievalService:
         for cid, score in bm25_results:
             scores[cid] = scores.get(cid, 0) + (score / 10.0) * 0.3
             
+        if top_n is not None:
+            return heapq.nlargest(top_n, scores.items(), key=lambda x: x[1])
         sorted_results = sorted(scores.items(), key=lambda x: x[1], reverse=True)
         return sorted_results
 
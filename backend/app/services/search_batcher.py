@@ -0,0 +1,130 @@
+"""
+FAISS 检索批处理服务
+在短时间窗口内合并并发请求的查询向量，统一调用一次 FAISS 检索，
+多条查询共享一次矩阵乘（GEMM），并发检索时吞吐更高
+"""
+import os
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from app.storage.faiss_index import FAISSIndex
+
+logger = logging.getLogger(__name__)
+
+# 同一批次的检索参数：(top_k, document_sha1, ef_search)
+_BatchKey = Tuple[int, Optional[str], Optional[int]]
+
+
+class FaissSearchBatcher:
+    """
+    动态批处理的 FAISS 检索队列
+
+    调用方通过 search() 提交单条查询向量；检索参数相同的查询累计到 max_batch 条，
+    或距首次提交超过 flush_interval 毫秒时，合并为一次 FAISSIndex.search_batch 调用（在线程中执行），
+    再把各行结果分发给对应的调用方。
+    """
+
+    def __init__(
+        self,
+        faiss_index: FAISSIndex,
+        max_batch: Optional[int] = None,
+        flush_interval_ms: Optional[float] = None
+    ):
+        """
+        初始化批处理队列
+
+        Args:
+            faiss_index: FAISS 索引管理实例
+            max_batch: 触发立即检索的累计查询数，默认读取 FAISS_SEARCH_BATCH_MAX（16）
+            flush_interval_ms: 最长等待时间（毫秒），默认读取 FAISS_SEARCH_BATCH_MS（5）；
+                为 0 时只合并同一轮事件循环中到达的查询
+        """
+        self.faiss_index = faiss_index
+        if max_batch is None:
+            max_batch = int(os.getenv("FAISS_SEARCH_BATCH_MAX", "16"))
+        if flush_interval_ms is None:
+            flush_interval_ms = float(os.getenv("FAISS_SEARCH_BATCH_MS", "5"))
+        self.max_batch = max(1, max_batch)
+        self.flush_interval = max(0.0, flush_interval_ms) / 1000
+
+        self._pending: Dict[_BatchKey, List[Tuple[np.ndarray, asyncio.Future]]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def search(
+        self,
+        query_embedding: np.ndarray,
+        top_k: int = 50,
+        document_sha1: Optional[str] = None,
+        ef_search: Optional[int] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        提交一条查询并等待检索结果
+
+        Args:
+            query_embedding: 查询向量
+            top_k: 返回 Top-K 结果
+            document_sha1: 可选，只在该文档的索引中搜索
+            ef_search: 可选，HNSW 索引检索时的 efSearch
+
+        Returns:
+            (chunk_id, similarity) 列表
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (top_k, document_sha1, ef_search)
+        group = self._pending.setdefault(key, [])
+        group.append((np.asarray(query_embedding, dtype=np.float32), future))
+
+        if len(group) >= self.max_batch:
+            self._start_batch(key, self._pending.pop(key))
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._flush)
+
+        return await future
+
+    def _flush(self):
+        """提交当前队列中的所有分组"""
+        self._timer = None
+        pending, self._pending = self._pending, {}
+        for key, requests in pending.items():
+            self._start_batch(key, requests)
+
+    def _start_batch(self, key: _BatchKey, requests: List[Tuple[np.ndarray, asyncio.Future]]):
+        """为一组查询创建批量检索任务"""
+        task = asyncio.get_running_loop().create_task(self._run_batch(key, requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, key: _BatchKey, requests: List[Tuple[np.ndarray, asyncio.Future]]):
+        """
+        执行合并后的检索，并把结果分发给各调用方
+
+        Args:
+            key: 检索参数 (top_k, document_sha1, ef_search)
+            requests: (查询向量, Future) 列表
+        """
+        top_k, document_sha1, ef_search = key
+        if len(requests) > 1:
+            logger.debug(f"[SearchBatcher] 合并 {len(requests)} 条查询为一次检索")
+        try:
+            results = await asyncio.to_thread(
+                self.faiss_index.search_batch,
+                np.stack([query for query, _ in requests]),
+                top_k,
+                document_sha1,
+                ef_search
+            )
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(requests, results):
+            # 调用方可能已取消等待
+            if not future.done():
+                future.set_result(result)
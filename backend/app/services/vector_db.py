@@ -3,16 +3,22 @@
 为每个文档单独创建和保存 FAISS 索引
 参考 RAG-cy 的 VectorDBIngestor 实现
 """
-import json
+import asyncio
 import logging
+import os
 import uuid
 import faiss
 import numpy as np
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple, Union
 from tqdm import tqdm
 
 from app.services.embedding import EmbeddingService
+from app.services.embedding_batcher import EmbeddingBatcher
+from app.services.registry import get_embedding_service
+from app.storage.faiss_index import build_vector_index, write_chunk_ids, write_vector_index
+from app.utils.fs_utils import scan_files
+from app.utils.json_utils import read_json
 
 logger = logging.getLogger(__name__)
 
@@ -20,48 +26,50 @@ logger = logging.getLogger(__name__)
 class VectorDBService:
     """向量数据库服务类，用于创建和管理 FAISS 索引"""
     
-    def __init__(self, embedding_service: Optional[EmbeddingService] = None):
+    def __init__(
+        self,
+        embedding_service: Optional[EmbeddingService] = None,
+        embedding_batcher: Optional[EmbeddingBatcher] = None
+    ):
         """
         初始化向量数据库服务
         
         Args:
-            embedding_service: Embedding 服务实例，如果为 None 则自动创建
+            embedding_service: Embedding 服务实例，如果为 None 则使用共享实例
+            embedding_batcher: Embedding 批处理队列（可选），提供时多个文档的 chunk 会合并调用 API
         """
-        self.embedding_service = embedding_service or EmbeddingService()
+        self.embedding_service = embedding_service or get_embedding_service()
+        self.embedding_batcher = embedding_batcher
     
-    def _create_vector_index(self, embeddings: List[List[float]]) -> faiss.Index:
+    def _create_vector_index(self, embeddings: np.ndarray) -> faiss.Index:
         """
         使用 FAISS 构建向量索引，采用内积（余弦距离）
         
         Args:
-            embeddings: embedding 向量列表
+            embeddings: embedding 矩阵 (N, D)，float32 连续矩阵会被原地归一化
             
         Returns:
             FAISS 索引对象
         """
-        if not embeddings:
+        if len(embeddings) == 0:
             raise ValueError("embeddings 列表不能为空")
         
-        embeddings_array = np.array(embeddings, dtype=np.float32)
-        dimension = len(embeddings[0])
-        
-        # 使用 IndexFlatIP（内积）进行余弦相似度计算
-        # 注意：使用内积前需要先对向量进行归一化
-        # 归一化向量
-        norms = np.linalg.norm(embeddings_array, axis=1, keepdims=True)
-        norms[norms == 0] = 1  # 避免除零
-        normalized_embeddings = embeddings_array / norms
+        # EmbeddingService 已返回 float32 连续矩阵，此处不会再复制
+        embeddings_array = np.ascontiguousarray(embeddings, dtype=np.float32)
         
-        index = faiss.IndexFlatIP(dimension)
-        index.add(normalized_embeddings)
+        # 使用内积度量进行余弦相似度计算（向量数较少时为暴力检索，较多时为 HNSW / 压缩索引）
+        # 注意：使用内积前需要先对向量进行归一化（原地进行，不另分配 (N, D) 矩阵；零向量保持不变）
+        faiss.normalize_L2(embeddings_array)
         
-        return index
+        # 向量按 FAISS_QUANTIZATION 量化存储（默认 FP16）；向量数超过阈值时自动改用 HNSW / IVF 近似索引
+        return build_vector_index(embeddings_array, faiss.METRIC_INNER_PRODUCT)
     
     async def process_chunk_json(
         self,
         chunk_json_path: str,
         output_dir: str,
-        max_chunk_length: int = 2048
+        max_chunk_length: int = 2048,
+        use_batcher: bool = True
     ) -> str:
         """
         处理单个 chunk JSON 文件，生成并保存 FAISS 索引
@@ -70,39 +78,107 @@ class VectorDBService:
             chunk_json_path: chunk JSON 文件路径
             output_dir: 输出目录
             max_chunk_length: 最大 chunk 长度（字符数），超长内容会被截断
+            use_batcher: 是否经由批处理队列与其他文档合并请求（单文件处理时可关闭，省去等待窗口）
             
         Returns:
             FAISS 索引文件路径
         """
         chunk_json_path = Path(chunk_json_path)
-        output_dir = Path(output_dir)
-        output_dir.mkdir(parents=True, exist_ok=True)
         
         # 加载 chunk JSON
-        with open(chunk_json_path, 'r', encoding='utf-8') as f:
-            report_data = json.load(f)
+        report_data = read_json(chunk_json_path)
+        
+        logger.info(f"[VectorDB] 处理chunk JSON文件: {chunk_json_path.name}")
+        return await self.process_chunk_report(
+            report_data,
+            output_dir,
+            max_chunk_length=max_chunk_length,
+            use_batcher=use_batcher,
+            source=f"chunk JSON 文件 {chunk_json_path}"
+        )
+    
+    async def process_chunk_report(
+        self,
+        report_data: dict,
+        output_dir: Union[str, Path],
+        max_chunk_length: int = 2048,
+        use_batcher: bool = True,
+        source: str = "chunk 报告"
+    ) -> str:
+        """
+        处理内存中的 chunk 报告（与 chunk JSON 文件内容相同），生成并保存 FAISS 索引
+        
+        Args:
+            report_data: {"metainfo": {...}, "content": {"chunks": [...]}}
+            output_dir: 输出目录
+            max_chunk_length: 最大 chunk 长度（字符数），超长内容会被截断
+            use_batcher: 是否经由批处理队列与其他文档合并请求
+            source: 报告来源描述，用于错误信息
+            
+        Returns:
+            FAISS 索引文件路径
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
         
         # 提取 metainfo 和 chunks
         metainfo = report_data.get("metainfo", {})
         chunks = report_data.get("content", {}).get("chunks", [])
         
-        logger.info(f"[VectorDB] 处理chunk JSON文件: {chunk_json_path.name}")
         logger.info(f"[VectorDB] chunks数量: {len(chunks)}")
         
         # 获取 SHA1 作为文件名
         sha1 = metainfo.get("sha1", "")
         file_name = metainfo.get("file_name", "")
         if not sha1:
-            raise ValueError(f"chunk JSON 文件 {chunk_json_path} 缺少 sha1 字段")
+            raise ValueError(f"{source} 缺少 sha1 字段")
         
         logger.info(f"[VectorDB] 文档SHA1: {sha1}, 文件名: {file_name}")
         
         # 提取文本块并生成chunk_ids
+        text_chunks, chunk_ids = self.extract_texts(chunks, sha1, max_chunk_length)
+        
+        logger.info(f"[VectorDB] 提取了 {len(text_chunks)} 个有效文本块")
+        logger.info(f"[VectorDB] 生成了 {len(chunk_ids)} 个chunk_ids")
+        if len(chunk_ids) > 0:
+            logger.debug(f"[VectorDB] 示例chunk_id: {chunk_ids[0]}")
+        
+        if not text_chunks:
+            raise ValueError(f"{source} 中没有有效的文本块")
+        
+        if len(text_chunks) != len(chunk_ids):
+            logger.error(f"[VectorDB] 文本块数量({len(text_chunks)})与chunk_ids数量({len(chunk_ids)})不匹配！")
+        
+        # 生成 embeddings（异步）
+        logger.info(f"[VectorDB] 开始生成embeddings...")
+        embeddings = await self.embed_texts(text_chunks, use_batcher=use_batcher)
+        logger.info(f"[VectorDB] 生成了 {len(embeddings)} 个embeddings (维度: {embeddings.shape[1] if len(embeddings) else 0})")
+        
+        return self.save_index(embeddings, chunk_ids, sha1, output_dir)
+    
+    @staticmethod
+    def extract_texts(
+        chunks: List[dict],
+        sha1: str,
+        max_chunk_length: int = 2048,
+        start_index: int = 0
+    ) -> Tuple[List[str], List[str]]:
+        """
+        从 chunk 字典中提取待向量化的文本及对应的 chunk_id
+        
+        Args:
+            chunks: chunk 字典列表（包含 text，可选 chunk_id）
+            sha1: 文档 SHA1
+            max_chunk_length: 最大 chunk 长度（字符数），超长内容会被截断
+            start_index: 第一个 chunk 在整个文档中的序号（用于生成默认 chunk_id）
+            
+        Returns:
+            (文本列表, chunk_id 列表)
+        """
         text_chunks = []
         chunk_ids = []
-        document_name = Path(file_name).stem if file_name else Path(chunk_json_path).stem
         
-        for idx, chunk in enumerate(chunks):
+        for idx, chunk in enumerate(chunks, start_index):
             text = chunk.get("text", "")
             if text and len(text) > 0:
                 # 截断超长内容
@@ -117,37 +193,58 @@ class VectorDBService:
                     chunk_id = f"{sha1}_{idx}"
                 chunk_ids.append(chunk_id)
         
-        logger.info(f"[VectorDB] 提取了 {len(text_chunks)} 个有效文本块")
-        logger.info(f"[VectorDB] 生成了 {len(chunk_ids)} 个chunk_ids")
-        if len(chunk_ids) > 0:
-            logger.debug(f"[VectorDB] 示例chunk_id: {chunk_ids[0]}")
-        
-        if not text_chunks:
-            raise ValueError(f"chunk JSON 文件 {chunk_json_path} 中没有有效的文本块")
+        return text_chunks, chunk_ids
+    
+    async def embed_texts(self, texts: List[str], use_batcher: bool = True) -> np.ndarray:
+        """
+        生成文本的 embedding，配置了批处理队列时经由队列合并请求
         
-        if len(text_chunks) != len(chunk_ids):
-            logger.error(f"[VectorDB] 文本块数量({len(text_chunks)})与chunk_ids数量({len(chunk_ids)})不匹配！")
+        Args:
+            texts: 文本列表
+            use_batcher: 是否使用批处理队列（未配置队列时忽略）
+            
+        Returns:
+            embedding 矩阵 (N, D)
+        """
+        if use_batcher and self.embedding_batcher is not None:
+            return await self.embedding_batcher.add(texts)
+        return await self.embedding_service.embed_documents(texts)
+    
+    def save_index(
+        self,
+        embeddings: np.ndarray,
+        chunk_ids: List[str],
+        sha1: str,
+        output_dir: Union[str, Path]
+    ) -> str:
+        """
+        构建 FAISS 索引并保存索引文件与 chunk_ids 映射
         
-        # 生成 embeddings（异步）
-        logger.info(f"[VectorDB] 开始生成embeddings...")
-        embeddings = await self.embedding_service.embed_documents(text_chunks)
-        logger.info(f"[VectorDB] 生成了 {len(embeddings)} 个embeddings (维度: {len(embeddings[0]) if embeddings else 0})")
+        Args:
+            embeddings: embedding 矩阵 (N, D)
+            chunk_ids: 与 embeddings 一一对应的 chunk_id 列表
+            sha1: 文档 SHA1（作为文件名）
+            output_dir: 输出目录
+            
+        Returns:
+            FAISS 索引文件路径
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
         
         # 创建 FAISS 索引
         logger.info(f"[VectorDB] 创建FAISS索引...")
         index = self._create_vector_index(embeddings)
         logger.info(f"[VectorDB] FAISS索引创建完成，向量数: {index.ntotal}")
         
-        # 保存索引文件
+        # 保存索引文件（先原子替换索引，再原子替换 chunk_ids 映射）
         faiss_file_path = output_dir / f"{sha1}.faiss"
-        faiss.write_index(index, str(faiss_file_path))
+        write_vector_index(index, faiss_file_path)
         logger.info(f"[VectorDB] FAISS索引已保存: {faiss_file_path}")
         
         # 保存 chunk_ids 映射文件
         ids_file_path = output_dir / f"{sha1}.faiss.ids"
-        import pickle
-        with open(ids_file_path, 'wb') as f:
-            pickle.dump(chunk_ids, f)
+        write_chunk_ids(ids_file_path, chunk_ids)
         logger.info(f"[VectorDB] chunk_ids映射已保存: {ids_file_path} ({len(chunk_ids)} 个chunk_ids)")
         
         # 注意：这里没有将chunks加载到MetadataStorage
@@ -161,15 +258,20 @@ class VectorDBService:
         self,
         chunk_json_dir: str,
         output_dir: str,
-        max_chunk_length: int = 2048
+        max_chunk_length: int = 2048,
+        concurrency: Optional[int] = None
     ) -> List[str]:
         """
         批量处理目录下的所有 chunk JSON 文件
         
+        多个文件并发处理，各文件的 embedding 请求经由批处理队列合并为整批调用 API
+        （未配置队列时为本次处理临时创建一个）。
+        
         Args:
             chunk_json_dir: chunk JSON 文件目录
             output_dir: 输出目录
             max_chunk_length: 最大 chunk 长度
+            concurrency: 同时处理的文件数，默认读取 INGEST_CONCURRENCY（4）
             
         Returns:
             FAISS 索引文件路径列表
@@ -178,20 +280,40 @@ class VectorDBService:
         output_dir = Path(output_dir)
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        all_json_paths = list(chunk_json_dir.glob("*.json"))
+        all_json_paths = [Path(entry.path) for entry in scan_files(chunk_json_dir, ".json")]
         faiss_files = []
         
-        for json_path in tqdm(all_json_paths, desc="Processing chunk JSON files for FAISS"):
-            try:
-                faiss_path = await self.process_chunk_json(
-                    str(json_path),
-                    str(output_dir),
-                    max_chunk_length=max_chunk_length
-                )
-                faiss_files.append(faiss_path)
-                print(f"已处理: {json_path.name} -> {Path(faiss_path).name}")
-            except Exception as e:
-                print(f"处理失败 {json_path.name}: {e}")
+        if concurrency is None:
+            concurrency = int(os.getenv("INGEST_CONCURRENCY", "4"))
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        ingestor = self
+        if self.embedding_batcher is None:
+            ingestor = VectorDBService(self.embedding_service, EmbeddingBatcher(self.embedding_service))
+        progress = tqdm(total=len(all_json_paths), desc="Processing chunk JSON files for FAISS")
+        
+        async def process_one(json_path: Path) -> str:
+            async with semaphore:
+                try:
+                    return await ingestor.process_chunk_json(
+                        str(json_path),
+                        str(output_dir),
+                        max_chunk_length=max_chunk_length
+                    )
+                finally:
+                    progress.update(1)
+        
+        results = await asyncio.gather(
+            *(process_one(json_path) for json_path in all_json_paths),
+            return_exceptions=True
+        )
+        progress.close()
+        
+        for json_path, result in zip(all_json_paths, results):
+            if isinstance(result, BaseException):
+                print(f"处理失败 {json_path.name}: {result}")
+            else:
+                faiss_files.append(result)
+                print(f"已处理: {json_path.name} -> {Path(result).name}")
         
         print(f"共处理 {len(faiss_files)} 个文件")
         return faiss_files
@@ -3,15 +3,419 @@ FAISS 索引管理
 支持单个索引文件和按文档分别存储的索引文件
 """
 import faiss
+import heapq
+import math
 import numpy as np
 import pickle
 import logging
-from typing import List, Tuple, Optional, Dict
+import threading
+import time
+from collections.abc import MutableMapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Tuple, Optional, Dict, Union
 import os
 from pathlib import Path
 
+from app.utils.fs_utils import create_partial_file
+
 logger = logging.getLogger(__name__)
 
+# 向量数达到该阈值时改用近似索引（小文档仍使用精确的暴力检索）
+IVF_THRESHOLD = int(os.getenv("FAISS_IVF_THRESHOLD", "10000"))
+# 向量数达到该阈值时改用 OPQ + IVF(HNSW 粗量化器) + PQ 压缩索引（百万级向量，内存与检索开销都随之大幅下降）
+COMPRESSED_THRESHOLD = int(os.getenv("FAISS_COMPRESSED_THRESHOLD", "1000000"))
+# 大文档的近似索引类型：hnsw（图索引，检索复杂度约 O(log N)）/ ivf（倒排索引）
+LARGE_INDEX_TYPE = os.getenv("FAISS_LARGE_INDEX", "hnsw").lower()
+# IVF 检索时探查的聚类数
+IVF_NPROBE = int(os.getenv("FAISS_IVF_NPROBE", "16"))
+# HNSW 每个节点的邻居数、构建时与检索时的候选队列长度
+HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+# 向量存储精度：fp32（原始浮点）/ fp16（标量量化，内存减半，精度损失可忽略）/
+# sq8（int8 标量量化，内存为 fp32 的 1/4）/
+# pq（乘积量化，每 4 维压缩为 1 字节，适合超大文档；训练样本不足时退回 fp16）
+QUANTIZATION = os.getenv("FAISS_QUANTIZATION", "fp16")
+# 标量量化方式对应的 FAISS 量化类型
+_SQ_TYPES = {
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+    "sq8": faiss.ScalarQuantizer.QT_8bit,
+}
+# PQ 每个子量化器 256 个码字，训练样本至少需要这么多
+_PQ_MIN_TRAIN = 256
+# PQ 索引的精排倍数：> 0 时先在 PQ 编码中取 top_k × 倍数 个候选，再用 int8 编码重新计算距离排序（每维多占 1 字节）
+PQ_REFINE_K_FACTOR = int(os.getenv("FAISS_PQ_REFINE_K_FACTOR", "0"))
+# 是否把各文档索引合并为一个全局索引，用于不限定文档的检索（一次检索代替逐个文档检索）
+MERGE_DOCUMENT_INDICES = os.getenv("FAISS_MERGE_DOCUMENT_INDICES", "1") == "1"
+# 逐个文档检索时并行搜索的线程数
+SEARCH_THREADS = max(1, int(os.getenv("FAISS_SEARCH_THREADS", str(os.cpu_count() or 4))))
+# 读取索引时是否使用 mmap（只对 IVF 索引的倒排表生效；Flat / SQ / HNSW 索引仍会整体读入内存）
+USE_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
+
+
+def _pq_subquantizers(dimension: int) -> int:
+    """选择 PQ 子量化器个数 m：不超过 D/4 且能整除 D 的最大值"""
+    m = max(1, dimension // 4)
+    while dimension % m:
+        m -= 1
+    return m
+
+
+def _with_refine(index: faiss.Index, dimension: int, metric: int) -> faiss.Index:
+    """按 PQ_REFINE_K_FACTOR 为 PQ 索引套上 int8 精排层（未开启时原样返回）"""
+    if PQ_REFINE_K_FACTOR <= 0:
+        return index
+    refine = faiss.IndexRefine(index, faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric))
+    refine.k_factor = PQ_REFINE_K_FACTOR
+    return refine
+
+
+def build_vector_index(
+    vectors: np.ndarray,
+    metric: int = faiss.METRIC_INNER_PRODUCT,
+    quantization: Optional[str] = None
+) -> faiss.Index:
+    """
+    根据向量数量与量化方式选择索引类型并添加向量
+    
+    - N < IVF_THRESHOLD：精确（暴力）检索
+      fp32 → IndexFlatIP / IndexFlatL2；fp16 / sq8 → IndexScalarQuantizer；pq → IndexPQ
+    - N >= IVF_THRESHOLD 且 FAISS_LARGE_INDEX=hnsw（默认）：HNSW 图索引（M=HNSW_M）
+      fp32 → IndexHNSWFlat；fp16 / sq8 → IndexHNSWSQ；pq 仍使用 IndexIVFPQ
+    - N >= IVF_THRESHOLD 且 FAISS_LARGE_INDEX=ivf：倒排索引（nlist ≈ 4·√N），检索复杂度随 nprobe 而非 N 增长
+      fp32 → IndexIVFFlat；fp16 / sq8 → IndexIVFScalarQuantizer；pq → IndexIVFPQ
+    - N >= COMPRESSED_THRESHOLD：不论量化方式，使用 "OPQm,IVF{nlist}_HNSW32,PQm"
+      （OPQ 旋转后乘积量化，每 4 维压缩为 1 字节；聚类中心用 HNSW 检索）
+    
+    使用 PQ 编码的索引在 FAISS_PQ_REFINE_K_FACTOR > 0 时外包一层 IndexRefine（int8 编码精排）。
+    
+    Args:
+        vectors: float32 向量矩阵 (N, D)；内积度量时应已归一化
+        metric: faiss.METRIC_INNER_PRODUCT 或 faiss.METRIC_L2
+        quantization: "fp32" / "fp16" / "sq8" / "pq"，默认读取 FAISS_QUANTIZATION（fp16）
+        
+    Returns:
+        已添加向量的 FAISS 索引
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dimension = vectors.shape
+    quantization = (quantization or QUANTIZATION).lower()
+    if quantization == "pq" and n < _PQ_MIN_TRAIN:
+        quantization = "fp16"
+    # 未知的量化方式按 fp16 处理
+    sq_type = _SQ_TYPES.get(quantization, faiss.ScalarQuantizer.QT_fp16)
+    
+    if n < IVF_THRESHOLD:
+        if quantization == "pq":
+            index = _with_refine(faiss.IndexPQ(dimension, _pq_subquantizers(dimension), 8, metric), dimension, metric)
+        elif quantization != "fp32":
+            index = faiss.IndexScalarQuantizer(dimension, sq_type, metric)
+        elif metric == faiss.METRIC_INNER_PRODUCT:
+            index = faiss.IndexFlatIP(dimension)
+        else:
+            index = faiss.IndexFlatL2(dimension)
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        return index
+    
+    # 每个聚类至少约 39 个训练样本，避免 k-means 训练不足
+    nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+    
+    if n >= COMPRESSED_THRESHOLD:
+        m = _pq_subquantizers(dimension)
+        index = faiss.index_factory(dimension, f"OPQ{m},IVF{nlist}_HNSW32,PQ{m}", metric)
+        index = _with_refine(index, dimension, metric)
+        index.train(vectors)
+        index.add(vectors)
+        faiss.extract_index_ivf(index).nprobe = min(IVF_NPROBE, nlist)
+        logger.info(f"[FAISSIndex] 构建 OPQ-IVF-HNSW-PQ 索引: 向量数 {n}, nlist {nlist}, PQ{m}")
+        return index
+    
+    if LARGE_INDEX_TYPE == "hnsw" and quantization != "pq":
+        if quantization == "fp32":
+            index = faiss.IndexHNSWFlat(dimension, HNSW_M, metric)
+        else:
+            index = faiss.IndexHNSWSQ(dimension, sq_type, HNSW_M, metric)
+            index.train(vectors)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.add(vectors)
+        # efSearch 随索引一起保存，作为默认的检索参数
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+        logger.info(f"[FAISSIndex] 构建 HNSW-{quantization.upper()} 索引: 向量数 {n}, M {HNSW_M}, efSearch {HNSW_EF_SEARCH}")
+        return index
+    
+    if metric == faiss.METRIC_INNER_PRODUCT:
+        quantizer = faiss.IndexFlatIP(dimension)
+    else:
+        quantizer = faiss.IndexFlatL2(dimension)
+    if quantization == "pq":
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, _pq_subquantizers(dimension), 8, metric)
+        index = _with_refine(index, dimension, metric)
+    elif quantization == "fp32":
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, metric)
+    else:
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, sq_type, metric)
+    index.train(vectors)
+    index.add(vectors)
+    nprobe = min(IVF_NPROBE, nlist)
+    faiss.extract_index_ivf(index).nprobe = nprobe
+    logger.info(f"[FAISSIndex] 构建 IVF-{quantization.upper()} 索引: 向量数 {n}, nlist {nlist}, nprobe {nprobe}")
+    return index
+
+
+def read_vector_index(path: Union[str, Path]) -> faiss.Index:
+    """
+    读取 FAISS 索引文件，优先使用 mmap，失败时回退到普通读取
+    
+    Args:
+        path: 索引文件路径
+        
+    Returns:
+        FAISS 索引
+    """
+    if USE_MMAP:
+        try:
+            # 只读 mmap：IVF 索引的倒排表由操作系统按需换入，多个进程读取同一文件时共享页缓存；
+            # FAISS 对 Flat / SQ 等索引仍会把向量复制到内存中，节省内存靠的是按文档延迟读取（LazyIndexMap）
+            return faiss.read_index(str(path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except Exception as e:
+            logger.debug(f"[FAISSIndex] mmap 读取失败，回退到普通读取 {path}: {e}")
+    return faiss.read_index(str(path))
+
+
+def write_vector_index(index: faiss.Index, path: Union[str, Path]):
+    """
+    保存 FAISS 索引文件：先写同目录临时文件（<文件名>.part），再 os.replace 到目标路径
+    
+    正在检索的进程可能以 mmap 持有旧的索引文件，原地覆盖会使其读取出错。
+    与 chunk_id 映射一起保存时先调用本函数，最后再写 .ids 文件：
+    .ids 文件存在才会登记 chunk_id 映射，新文档的索引写了一半时不会被检索到。
+    
+    Args:
+        index: FAISS 索引
+        path: 索引文件路径
+    """
+    tmp = create_partial_file(path)
+    tmp.close()
+    try:
+        faiss.write_index(index, tmp.name)
+        os.replace(tmp.name, path)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+
+class ChunkIdArray(Sequence):
+    """
+    以定长字节串 numpy 数组（通常为 mmap）存储的 chunk_id 序列，按下标访问时解码为 str
+    
+    相比 pickle 的 List[str]，读取时无需逐个构建 Python 字符串对象，也不执行任意代码。
+    """
+    
+    def __init__(self, values: np.ndarray):
+        self._values = values
+    
+    def __len__(self) -> int:
+        return len(self._values)
+    
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return ChunkIdArray(self._values[idx])
+        return self._values[idx].decode("utf-8")
+
+
+def write_chunk_ids(path: Union[str, Path], chunk_ids: List[str]):
+    """
+    把 chunk_id 列表保存为定长字节串的 .npy 格式（文件名保持 <sha1>.faiss.ids 不变）
+    
+    先写同目录临时文件再 os.replace：正在检索的进程可能以 mmap 持有旧文件，原地截断会使其读取出错。
+    
+    Args:
+        path: 文件路径
+        chunk_ids: chunk_id 列表
+    """
+    values = np.array([chunk_id.encode("utf-8") for chunk_id in chunk_ids], dtype=np.bytes_)
+    tmp = create_partial_file(path)
+    try:
+        with tmp:
+            # 传入文件对象，避免 np.save 给文件名追加 .npy 后缀
+            np.save(tmp, values, allow_pickle=False)
+        os.replace(tmp.name, path)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+
+def read_chunk_ids(path: Union[str, Path]) -> Sequence:
+    """
+    读取 write_chunk_ids 保存的 chunk_id（mmap，零拷贝）；旧版本以 pickle 保存的文件仍可读取
+    
+    Args:
+        path: 文件路径
+        
+    Returns:
+        chunk_id 序列（ChunkIdArray，旧格式为 List[str]）
+    """
+    try:
+        return ChunkIdArray(np.load(path, mmap_mode='r', allow_pickle=False))
+    except ValueError:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def search_index(
+    index: faiss.Index,
+    queries: np.ndarray,
+    top_k: int,
+    ef_search: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    检索索引，HNSW 索引可按次指定 efSearch（越大召回越高、越慢），其他索引忽略该参数
+    
+    Args:
+        index: FAISS 索引
+        queries: 查询向量矩阵 (Q, D)
+        top_k: 返回 Top-K 结果
+        ef_search: HNSW 检索时的候选队列长度，None 表示使用索引中保存的值
+        
+    Returns:
+        (distances, indices)
+    """
+    if ef_search and isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(efSearch=max(ef_search, top_k))
+        return index.search(queries, top_k, params=params)
+    return index.search(queries, top_k)
+
+
+def reconstruct_all(index: faiss.Index) -> Optional[np.ndarray]:
+    """
+    取回索引中的全部向量（FP16 / PQ 索引得到的是解码后的值）
+    
+    Args:
+        index: FAISS 索引
+        
+    Returns:
+        向量矩阵 (ntotal, D)，索引类型不支持取回时返回 None
+    """
+    try:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            # IVF 索引需要先建立 id → 倒排位置 的直接映射才能取回向量
+            ivf.make_direct_map()
+        return index.reconstruct_n(0, index.ntotal)
+    except RuntimeError as e:
+        logger.debug(f"[FAISSIndex] 无法从 {type(index).__name__} 取回向量: {e}")
+        return None
+
+
+# 内积（余弦）度量，与缓存的 metric_type 做整数比较
+IP = faiss.METRIC_INNER_PRODUCT
+
+
+def is_inner_product(index: faiss.Index) -> bool:
+    """判断索引是否使用内积（余弦）度量，适用于 Flat / IVF 等所有索引类型"""
+    return index.metric_type == IP
+
+class LazyIndexMap(MutableMapping):
+    """
+    文档 SHA1 → FAISS 索引的映射，只登记索引文件路径，首次访问某个文档时才读取
+    
+    启动时不再把全部文档索引读入内存；读取失败的文档会被移除，get() 返回 None。
+    items() / values() 只返回能成功读取的索引；peek() 读取索引但不放入缓存。
+    读取（或写入）索引时把它的度量类型记入 metrics，检索时按文档做整数比较，无需再访问 SWIG 对象。
+    """
+    
+    def __init__(self):
+        self._paths: Dict[str, Optional[Path]] = {}
+        self._loaded: Dict[str, faiss.Index] = {}
+        self.metrics: Dict[str, int] = {}  # 已读取文档的 metric_type
+        # 检索在线程池中执行，避免并发的首次访问重复读取同一文件
+        self._lock = threading.Lock()
+    
+    def add_path(self, sha1: str, path: Union[str, Path]):
+        """登记文档索引文件，暂不读取"""
+        self._paths[sha1] = Path(path)
+        self._loaded.pop(sha1, None)
+        self.metrics.pop(sha1, None)
+    
+    def __getitem__(self, sha1: str) -> faiss.Index:
+        index = self._loaded.get(sha1)
+        if index is not None:
+            return index
+        path = self._paths[sha1]
+        with self._lock:
+            index = self._loaded.get(sha1)
+            if index is None:
+                try:
+                    index = read_vector_index(path)
+                except Exception as e:
+                    logger.error(f"[FAISSIndex] 加载索引文件失败 {path}: {e}", exc_info=True)
+                    self._paths.pop(sha1, None)
+                    raise KeyError(sha1) from e
+                self.metrics[sha1] = index.metric_type
+                self._loaded[sha1] = index
+                logger.info(f"[FAISSIndex] 加载索引文件: {path.name} (SHA1: {sha1[:16]}..., 向量数: {index.ntotal})")
+        return index
+    
+    def __setitem__(self, sha1: str, index: faiss.Index):
+        self._paths[sha1] = None
+        self.metrics[sha1] = index.metric_type
+        self._loaded[sha1] = index
+    
+    def __delitem__(self, sha1: str):
+        del self._paths[sha1]
+        self._loaded.pop(sha1, None)
+        self.metrics.pop(sha1, None)
+    
+    def __contains__(self, sha1: object) -> bool:
+        return sha1 in self._paths
+    
+    def __iter__(self) -> Iterator[str]:
+        # 遍历快照，读取失败的文档在遍历过程中被移除时不影响迭代
+        return iter(list(self._paths))
+    
+    def __len__(self) -> int:
+        return len(self._paths)
+    
+    def items(self) -> Iterator[Tuple[str, faiss.Index]]:
+        for sha1 in self:
+            index = self.get(sha1)
+            if index is not None:
+                yield sha1, index
+    
+    def values(self) -> Iterator[faiss.Index]:
+        for _, index in self.items():
+            yield index
+    
+    def peek(self, sha1: str) -> Optional[faiss.Index]:
+        """
+        取得文档索引但不放入缓存：已读取的直接返回，否则从文件读取一份由调用方用完即释放
+        
+        Args:
+            sha1: 文档 SHA1
+            
+        Returns:
+            FAISS 索引，文档不存在或读取失败时返回 None
+        """
+        index = self._loaded.get(sha1)
+        if index is not None:
+            return index
+        path = self._paths.get(sha1)
+        if path is None:
+            return None
+        try:
+            return read_vector_index(path)
+        except Exception as e:
+            logger.error(f"[FAISSIndex] 加载索引文件失败 {path}: {e}", exc_info=True)
+            return None
+    
+    @property
+    def loaded_count(self) -> int:
+        """已读取的索引数"""
+        return len(self._loaded)
+
+
 class FAISSIndex:
     """FAISS 索引管理类，用于高效的相似度搜索"""
     
@@ -34,8 +438,20 @@ class FAISSIndex:
         self.id_map_path = self.index_path + ".ids" if self.index_path else None
         self.index = None
         self.chunk_ids = []
-        self.document_indices: Dict[str, faiss.Index] = {}  # 按文档存储的索引
-        self.document_chunk_maps: Dict[str, List[str]] = {}  # 每个文档的 chunk_id 映射
+        self.document_indices = LazyIndexMap()  # 按文档存储的索引（首次访问时读取）
+        # 每个已读取文档索引的度量类型（faiss.METRIC_INNER_PRODUCT / METRIC_L2），由 document_indices 维护
+        self.document_metric: Dict[str, int] = self.document_indices.metrics
+        self.document_chunk_maps: Dict[str, Sequence] = {}  # 每个文档的 chunk_id 映射
+        # 所有文档向量合并后的全局索引快照：(构建时的文档版本, 索引, chunk_id 列表)，chunk_id 按文档依次排列。
+        # 重建完成后整体替换，检索时只读取一次，索引与 chunk_id 总是来自同一次构建；索引为 None 表示无法合并
+        self.merged: Optional[Tuple[int, Optional[faiss.Index], List[str]]] = None
+        # 文档索引每变化一次加 1，快照版本与之不同时说明合并索引已过期
+        self._documents_version = 0
+        self._merge_lock = threading.Lock()  # 保护 _documents_version 与后台重建线程的启动
+        self._merge_build_lock = threading.Lock()  # 同一时间只进行一次合并索引重建
+        self._merge_thread: Optional[threading.Thread] = None
+        # 逐个文档检索时使用的线程池，首次需要时创建
+        self._search_pool: Optional[ThreadPoolExecutor] = None
         
         # 如果指定了 index_dir，则使用目录模式
         if self.index_dir:
@@ -54,20 +470,17 @@ class FAISSIndex:
         faiss_files = list(index_dir.glob("*.faiss"))
         logger.info(f"[FAISSIndex] 找到 {len(faiss_files)} 个FAISS索引文件")
         
-        # 加载所有 .faiss 文件
+        # 登记所有 .faiss 文件（索引本身在首次检索该文档时读取），并加载 chunk_ids
         for faiss_file in faiss_files:
             sha1 = faiss_file.stem
             try:
-                index = faiss.read_index(str(faiss_file))
-                self.document_indices[sha1] = index
-                logger.info(f"[FAISSIndex] 加载索引文件: {faiss_file.name} (SHA1: {sha1[:16]}..., 向量数: {index.ntotal})")
+                self.document_indices.add_path(sha1, faiss_file)
                 
                 # 尝试加载对应的 chunk_ids（如果有）
                 ids_file = faiss_file.with_suffix('.faiss.ids')
                 if ids_file.exists():
-                    with open(ids_file, 'rb') as f:
-                        chunk_ids = pickle.load(f)
-                        self.document_chunk_maps[sha1] = chunk_ids
+                    chunk_ids = read_chunk_ids(ids_file)
+                    self.document_chunk_maps[sha1] = chunk_ids
                     logger.info(f"[FAISSIndex] 加载chunk_ids映射: {ids_file.name} ({len(chunk_ids)} 个chunk_ids)")
                     if len(chunk_ids) > 0:
                         logger.debug(f"[FAISSIndex] 示例chunk_id: {chunk_ids[0]}")
@@ -75,35 +488,131 @@ class FAISSIndex:
                     logger.warning(f"[FAISSIndex] 未找到chunk_ids映射文件: {ids_file.name}")
                     logger.warning(f"[FAISSIndex] 这将导致检索时无法将索引位置映射到chunk_id！")
             except Exception as e:
-                logger.error(f"[FAISSIndex] 加载索引文件失败 {faiss_file}: {e}", exc_info=True)
+                logger.error(f"[FAISSIndex] 加载chunk_ids映射失败 {faiss_file}: {e}", exc_info=True)
         
-        logger.info(f"[FAISSIndex] 总共加载 {len(self.document_indices)} 个文档索引")
+        logger.info(f"[FAISSIndex] 总共登记 {len(self.document_indices)} 个文档索引")
         logger.info(f"[FAISSIndex] 有chunk_ids映射的文档数: {len(self.document_chunk_maps)}")
+        # 全局合并索引需要读取全部文档索引，不在启动时构建，首次不限定文档的检索时在后台构建
+    
+    def _get_search_pool(self) -> ThreadPoolExecutor:
+        """
+        获取逐个文档检索用的线程池
+        
+        各工作线程内把 FAISS 的 OpenMP 线程数设为 1：并行已在文档之间进行，避免线程过度订阅。
+        """
+        if self._search_pool is None:
+            self._search_pool = ThreadPoolExecutor(
+                max_workers=SEARCH_THREADS,
+                thread_name_prefix="faiss-search",
+                initializer=faiss.omp_set_num_threads,
+                initargs=(1,)
+            )
+        return self._search_pool
     
-    def build_index(self, embeddings: List[List[float]], chunk_ids: List[str]):
+    def _build_merged_index(self):
+        """
+        把所有文档索引中的向量合并为一个全局索引
+        
+        不限定文档的检索只需一次 search 调用；向量数较多时 build_vector_index 会选用 HNSW 等近似索引。
+        任一文档的向量无法取回或度量不是内积时放弃合并，检索回退到逐个文档检索。
+        在局部变量中构建，完成后一次性替换 self.merged。
+        尚未读取的文档索引只临时读取一份用于取回向量，不放入 document_indices 的缓存，
+        合并后内存中只多出合并索引本身。
+        """
+        with self._merge_build_lock:
+            version = self._documents_version
+            parts = []
+            merged_chunk_ids: List[str] = []
+            for sha1 in self.document_indices:
+                chunk_ids = self.document_chunk_maps.get(sha1)
+                if not chunk_ids:
+                    continue
+                index = self.document_indices.peek(sha1)
+                if index is None:
+                    continue
+                if not is_inner_product(index):
+                    logger.info(f"[FAISSIndex] 文档 {sha1[:16]}... 不是内积索引，不合并全局索引")
+                    self.merged = (version, None, [])
+                    return
+                vectors = reconstruct_all(index)
+                if vectors is None:
+                    logger.info(f"[FAISSIndex] 文档 {sha1[:16]}... 的向量无法取回，不合并全局索引")
+                    self.merged = (version, None, [])
+                    return
+                count = min(len(vectors), len(chunk_ids))
+                parts.append(vectors[:count])
+                merged_chunk_ids.extend(chunk_ids[:count])
+            
+            if not parts:
+                self.merged = (version, None, [])
+                return
+            start = time.perf_counter()
+            merged_index = build_vector_index(np.vstack(parts), faiss.METRIC_INNER_PRODUCT)
+            self.merged = (version, merged_index, merged_chunk_ids)
+            logger.info(
+                f"[FAISSIndex] 合并 {len(parts)} 个文档索引为全局索引: 向量数 {merged_index.ntotal} "
+                f"(耗时: {time.perf_counter() - start:.2f}秒)"
+            )
+    
+    def _merge_worker(self):
+        """后台重建合并索引；重建期间文档索引又有变化时继续重建，直到与当前文档版本一致"""
+        while True:
+            merged = self.merged
+            if merged is not None and merged[0] == self._documents_version:
+                return
+            try:
+                self._build_merged_index()
+            except Exception as e:
+                logger.error(f"[FAISSIndex] 重建全局合并索引失败: {e}", exc_info=True)
+                return
+    
+    def _get_merged_index(self) -> Optional[Tuple[faiss.Index, List[str]]]:
+        """
+        获取与当前文档索引一致的全局合并索引
+        
+        合并索引尚未构建或已过期时在后台线程中重建并返回 None，本次检索改为逐个文档检索，
+        检索请求不会等待合并索引的构建。
+        
+        Returns:
+            (合并索引, chunk_id 列表)，不可用时返回 None
+        """
+        merged = self.merged
+        if merged is not None and merged[0] == self._documents_version:
+            if merged[1] is None:
+                return None
+            return merged[1], merged[2]
+        
+        with self._merge_lock:
+            if self._merge_thread is None or not self._merge_thread.is_alive():
+                self._merge_thread = threading.Thread(
+                    target=self._merge_worker, name="faiss-merge", daemon=True
+                )
+                self._merge_thread.start()
+        return None
+    
+    def build_index(self, embeddings: Union[np.ndarray, List[np.ndarray]], chunk_ids: List[str]):
         """
         构建 FAISS 索引（全局索引模式）
         
         Args:
-            embeddings: embedding 向量列表
+            embeddings: embedding 矩阵 (N, D)，或 embedding 向量列表
             chunk_ids: 对应的 chunk_id 列表
         """
-        if not embeddings:
+        if len(embeddings) == 0:
             return
-            
-        dimension = len(embeddings[0])
+        
+        # 转换为 float32 numpy 数组（已是 float32 矩阵时不复制）
+        np_embeddings = np.asarray(embeddings, dtype=np.float32)
+        dimension = np_embeddings.shape[1]
         # 使用 IndexFlatL2 或 IndexIVFFlat
         self.index = faiss.IndexFlatL2(dimension)
-        
-        # 转换为 numpy 数组
-        np_embeddings = np.array(embeddings).astype('float32')
         self.index.add(np_embeddings)
         self.chunk_ids = chunk_ids
         self.save()
     
     def build_index_for_document(
         self,
-        embeddings: List[List[float]],
+        embeddings: np.ndarray,
         chunk_ids: List[str],
         sha1: str,
         use_cosine: bool = True
@@ -112,52 +621,50 @@ class FAISSIndex:
         为单个文档构建 FAISS 索引（按文档存储模式）
         
         Args:
-            embeddings: embedding 向量列表
+            embeddings: embedding 矩阵 (N, D)
             chunk_ids: 对应的 chunk_id 列表
             sha1: 文档的 SHA1 标识
             use_cosine: 是否使用余弦相似度（内积），True 则使用 IndexFlatIP，False 使用 IndexFlatL2
+                （使用余弦相似度时，float32 连续的 embeddings 会被原地归一化）
         """
-        if not embeddings:
+        if len(embeddings) == 0:
             return
         
         if not self.index_dir:
             raise ValueError("必须指定 index_dir 才能使用按文档存储模式")
         
-        dimension = len(embeddings[0])
-        embeddings_array = np.array(embeddings, dtype=np.float32)
+        embeddings_array = np.ascontiguousarray(embeddings, dtype=np.float32)
         
         if use_cosine:
-            # 使用内积（余弦相似度），需要先归一化
-            norms = np.linalg.norm(embeddings_array, axis=1, keepdims=True)
-            norms[norms == 0] = 1
-            normalized_embeddings = embeddings_array / norms
-            index = faiss.IndexFlatIP(dimension)
-            index.add(normalized_embeddings)
+            # 使用内积（余弦相似度），需要先归一化（原地进行，不另分配 (N, D) 矩阵；零向量保持不变）
+            faiss.normalize_L2(embeddings_array)
+            index = build_vector_index(embeddings_array, faiss.METRIC_INNER_PRODUCT)
         else:
             # 使用 L2 距离
-            index = faiss.IndexFlatL2(dimension)
-            index.add(embeddings_array)
+            index = build_vector_index(embeddings_array, faiss.METRIC_L2)
         
-        # 保存索引文件
+        # 保存索引文件（先原子替换索引，再原子替换 chunk_ids 映射）
         index_dir = Path(self.index_dir)
         index_dir.mkdir(parents=True, exist_ok=True)
         faiss_file_path = index_dir / f"{sha1}.faiss"
-        faiss.write_index(index, str(faiss_file_path))
+        write_vector_index(index, faiss_file_path)
         
         # 保存 chunk_ids 映射
         ids_file_path = index_dir / f"{sha1}.faiss.ids"
-        with open(ids_file_path, 'wb') as f:
-            pickle.dump(chunk_ids, f)
+        write_chunk_ids(ids_file_path, chunk_ids)
         
-        # 更新内存中的索引
+        # 更新内存中的索引；全局合并索引随之过期，下次不限定文档的检索时在后台重建
         self.document_indices[sha1] = index
         self.document_chunk_maps[sha1] = chunk_ids
+        with self._merge_lock:
+            self._documents_version += 1
     
     def search(
         self, 
-        query_embedding: List[float], 
+        query_embedding: np.ndarray, 
         top_k: int = 50,
-        document_sha1: Optional[str] = None
+        document_sha1: Optional[str] = None,
+        ef_search: Optional[int] = None
     ) -> List[Tuple[str, float]]:
         """
         向量检索
@@ -166,6 +673,7 @@ class FAISSIndex:
             query_embedding: 查询向量
             top_k: 返回 Top-K 结果
             document_sha1: 如果指定，则只在该文档的索引中搜索（按文档存储模式）
+            ef_search: HNSW 索引检索时的 efSearch（可选）
             
         Returns:
             (chunk_id, similarity) 列表
@@ -173,11 +681,10 @@ class FAISSIndex:
         # 如果指定了文档 SHA1，使用按文档存储模式
         if document_sha1 and self.index_dir:
             logger.debug(f"[FAISSIndex] 使用文档SHA1限定搜索: {document_sha1[:16]}...")
-            if document_sha1 not in self.document_indices:
+            index = self.document_indices.get(document_sha1)
+            if index is None:
                 logger.warning(f"[FAISSIndex] 文档SHA1不在索引中: {document_sha1[:16]}...")
                 return []
-            
-            index = self.document_indices[document_sha1]
             chunk_ids = self.document_chunk_maps.get(document_sha1, [])
             
             if not chunk_ids:
@@ -186,14 +693,12 @@ class FAISSIndex:
             
             logger.debug(f"[FAISSIndex] 文档索引向量数: {index.ntotal}, chunk_ids数量: {len(chunk_ids)}")
             
-            np_query = np.array([query_embedding]).astype('float32')
+            np_query = np.array([query_embedding], dtype=np.float32)
             # 如果使用内积，需要归一化查询向量
-            if isinstance(index, faiss.IndexFlatIP):
-                norm = np.linalg.norm(np_query)
-                if norm > 0:
-                    np_query = np_query / norm
+            if is_inner_product(index):
+                faiss.normalize_L2(np_query)
             
-            distances, indices = index.search(np_query, top_k)
+            distances, indices = search_index(index, np_query, top_k, ef_search)
             
             results = []
             for i, idx in enumerate(indices[0]):
@@ -210,54 +715,90 @@ class FAISSIndex:
             logger.info(f"[FAISSIndex] 文档限定搜索完成，返回 {len(results)} 个结果")
             return results
         
-        # 如果没有指定document_sha1，但有index_dir（按文档存储模式），遍历所有文档索引
+        # 如果没有指定document_sha1，但有index_dir（按文档存储模式），优先在合并后的全局索引中一次检索
+        merged = None
+        if self.index_dir and self.document_indices and MERGE_DOCUMENT_INDICES:
+            merged = self._get_merged_index()
+        if merged is not None:
+            merged_index, merged_chunk_ids = merged
+            np_query = np.array([query_embedding], dtype=np.float32)
+            if not np_query.any():
+                return []
+            faiss.normalize_L2(np_query)
+            distances, indices = search_index(merged_index, np_query, top_k, ef_search)
+            results = [
+                (merged_chunk_ids[idx], float(score))
+                for score, idx in zip(distances[0], indices[0])
+                if idx != -1 and idx < len(merged_chunk_ids)
+            ]
+            logger.info(f"[FAISSIndex] 全局合并索引搜索完成，返回 {len(results)} 个结果")
+            return results
+        
+        # 无法使用合并索引时，遍历所有文档索引
         if self.index_dir and self.document_indices:
             logger.info(f"[FAISSIndex] 未指定文档SHA1，遍历所有 {len(self.document_indices)} 个文档索引进行搜索")
-            all_results = []
             
-            np_query = np.array([query_embedding]).astype('float32')
+            np_query = np.array([query_embedding], dtype=np.float32)
+            # 内积索引使用的归一化查询向量（零向量时为 None，跳过内积索引）
+            np_query_normalized = None
+            if np_query.any():
+                np_query_normalized = np_query.copy()
+                faiss.normalize_L2(np_query_normalized)
             
-            # 遍历所有文档索引
-            for sha1, index in self.document_indices.items():
-                chunk_ids = self.document_chunk_maps.get(sha1, [])
-                
-                if not chunk_ids:
+            sha1_list = []
+            for sha1 in self.document_indices:
+                if self.document_chunk_maps.get(sha1):
+                    sha1_list.append(sha1)
+                else:
                     logger.warning(f"[FAISSIndex] 文档 {sha1[:16]}... 没有chunk_ids映射，跳过")
-                    continue
-                
+            
+            def search_one(sha1: str) -> List[Tuple[str, float]]:
+                """在单个文档索引中搜索（取top_k个结果）"""
+                index = self.document_indices.get(sha1)
+                if index is None:
+                    return []
                 # 如果使用内积，需要归一化查询向量
-                if isinstance(index, faiss.IndexFlatIP):
-                    norm = np.linalg.norm(np_query)
-                    if norm > 0:
-                        np_query_normalized = np_query / norm
-                    else:
-                        continue
+                if self.document_metric[sha1] == IP:
+                    if np_query_normalized is None:
+                        return []
+                    index_query = np_query_normalized
                 else:
-                    np_query_normalized = np_query
-                
-                # 在每个文档索引中搜索（取top_k个结果）
-                distances, indices = index.search(np_query_normalized, top_k)
+                    index_query = np_query
                 
-                for i, idx in enumerate(indices[0]):
-                    if idx != -1 and idx < len(chunk_ids):
-                        score = float(distances[0][i])
-                        chunk_id = chunk_ids[idx]
-                        all_results.append((chunk_id, score))
+                distances, indices = search_index(index, index_query, top_k, ef_search)
+                chunk_ids = self.document_chunk_maps[sha1]
+                return [
+                    (chunk_ids[idx], float(score))
+                    for score, idx in zip(distances[0], indices[0])
+                    if idx != -1 and idx < len(chunk_ids)
+                ]
             
-            # 对所有结果按分数排序，取top_k
-            # 对于L2距离，距离越小越好；对于内积，值越大越好
-            if all_results:
-                # 判断第一个索引的类型来决定排序方式
-                first_index = next(iter(self.document_indices.values()))
-                if isinstance(first_index, faiss.IndexFlatIP):
-                    # 内积：值越大越好，降序
-                    all_results.sort(key=lambda x: x[1], reverse=True)
-                else:
-                    # L2距离：距离越小越好，升序
-                    all_results.sort(key=lambda x: x[1])
-                
-                final_results = all_results[:top_k]
-                logger.info(f"[FAISSIndex] 遍历所有文档索引完成，从 {len(all_results)} 个候选结果中选择 top {len(final_results)} 个")
+            # FAISS 检索时释放 GIL，各文档索引在线程池中并行搜索
+            if len(sha1_list) > 1:
+                per_document = self._get_search_pool().map(search_one, sha1_list)
+            else:
+                per_document = map(search_one, sha1_list)
+            
+            # 边收集边维护大小为 top_k 的最小堆（堆顶为当前第 top_k 好的结果），不保存全部候选
+            heap: List[Tuple[float, str, float]] = []
+            candidate_count = 0
+            sign = None
+            for sha1, results in zip(sha1_list, per_document):
+                if sign is None:
+                    # 按第一个索引的类型决定排序方式（search_one 读取索引时已记录度量类型）
+                    # 对于L2距离，距离越小越好；对于内积，值越大越好
+                    sign = 1.0 if self.document_metric.get(sha1, IP) == IP else -1.0
+                for chunk_id, score in results:
+                    candidate_count += 1
+                    item = (sign * score, chunk_id, score)
+                    if len(heap) < top_k:
+                        heapq.heappush(heap, item)
+                    elif item > heap[0]:
+                        heapq.heapreplace(heap, item)
+            
+            if heap:
+                final_results = [(chunk_id, score) for _, chunk_id, score in sorted(heap, reverse=True)]
+                logger.info(f"[FAISSIndex] 遍历所有文档索引完成，从 {candidate_count} 个候选结果中选择 top {len(final_results)} 个")
                 return final_results
             else:
                 logger.warning(f"[FAISSIndex] 遍历所有文档索引，未找到任何结果")
@@ -271,7 +812,7 @@ class FAISSIndex:
         logger.debug(f"[FAISSIndex] 使用全局索引模式，向量数: {self.index.ntotal}, chunk_ids数量: {len(self.chunk_ids)}")
             
         np_query = np.array([query_embedding]).astype('float32')
-        distances, indices = self.index.search(np_query, top_k)
+        distances, indices = search_index(self.index, np_query, top_k, ef_search)
         
         results = []
         for i, idx in enumerate(indices[0]):
@@ -288,19 +829,73 @@ class FAISSIndex:
         logger.info(f"[FAISSIndex] 全局索引搜索完成，返回 {len(results)} 个结果")
         return results
     
+    def search_batch(
+        self,
+        query_embeddings: np.ndarray,
+        top_k: int = 50,
+        document_sha1: Optional[str] = None,
+        ef_search: Optional[int] = None
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        批量向量检索：多条查询合并为一次 index.search 调用（矩阵乘代替逐条的矩阵向量乘）
+        
+        限定文档与全局合并索引两种情形批量检索，其余情形逐条调用 search()。
+        
+        Args:
+            query_embeddings: 查询向量矩阵 (Q, D)
+            top_k: 每条查询返回 Top-K 结果
+            document_sha1: 如果指定，则只在该文档的索引中搜索
+            ef_search: HNSW 索引检索时的 efSearch（可选）
+            
+        Returns:
+            与各条查询一一对应的 (chunk_id, similarity) 列表
+        """
+        # 复制一份，归一化时不修改调用方的数据
+        queries = np.array(query_embeddings, dtype=np.float32, ndmin=2)
+        index = None
+        chunk_ids = []
+        use_merged = False
+        if document_sha1 and self.index_dir:
+            index = self.document_indices.get(document_sha1)
+            chunk_ids = self.document_chunk_maps.get(document_sha1, [])
+        elif self.index_dir and self.document_indices and MERGE_DOCUMENT_INDICES:
+            merged = self._get_merged_index()
+            if merged is not None:
+                index, chunk_ids = merged
+                use_merged = True
+        if index is None or not chunk_ids:
+            return [self.search(query, top_k, document_sha1, ef_search) for query in queries]
+        
+        nonzero = queries.any(axis=1)
+        if is_inner_product(index):
+            faiss.normalize_L2(queries)
+        distances, indices = search_index(index, queries, top_k, ef_search)
+        
+        results = []
+        for row, (scores, ids) in enumerate(zip(distances, indices)):
+            # 与 search() 一致：全局合并索引对零向量查询不返回结果
+            if use_merged and not nonzero[row]:
+                results.append([])
+                continue
+            results.append([
+                (chunk_ids[idx], float(score))
+                for score, idx in zip(scores, ids)
+                if idx != -1 and idx < len(chunk_ids)
+            ])
+        logger.info(f"[FAISSIndex] 批量检索完成: {len(queries)} 条查询")
+        return results
+    
     def save(self):
         """保存索引到文件"""
         if self.index is not None:
             os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
-            faiss.write_index(self.index, self.index_path)
-            with open(self.id_map_path, 'wb') as f:
-                pickle.dump(self.chunk_ids, f)
+            write_vector_index(self.index, self.index_path)
+            write_chunk_ids(self.id_map_path, self.chunk_ids)
     
     def load(self):
         """从文件加载索引"""
         if os.path.exists(self.index_path):
-            self.index = faiss.read_index(self.index_path)
+            self.index = read_vector_index(self.index_path)
             if os.path.exists(self.id_map_path):
-                with open(self.id_map_path, 'rb') as f:
-                    self.chunk_ids = pickle.load(f)
+                self.chunk_ids = read_chunk_ids(self.id_map_path)
 
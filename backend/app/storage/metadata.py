@@ -1,15 +1,54 @@
 """
 元数据存储（JSON）
 """
-import json
 import os
+import re
+import itertools
 import logging
-from typing import List, Dict, Optional, Set
+import threading
+from typing import List, Dict, Optional, Set, Tuple
 from pathlib import Path
 from app.models.chunk import Chunk
+from app.utils.cache_utils import LRUCache
+from app.utils.chunk_report import ChunkRecord, ChunkReport, read_chunk_report, to_chunk_record
+from app.utils.fs_utils import scan_files
+from app.utils.json_utils import read_json, write_json
+
+try:
+    import ijson
+except ImportError:  # ijson 为可选依赖，未安装时整体解析 chunk 报告
+    ijson = None
 
 logger = logging.getLogger(__name__)
 
+# chunk 文本中的页码标记（例如 "# 第 1 页"）
+_PAGE_RE = re.compile(r'#\s*第\s*(\d+)\s*页')
+# 缓存解析结果的 chunk 报告（JSON 文件）个数
+REPORT_CACHE_SIZE = int(os.getenv("METADATA_REPORT_CACHE_SIZE", "32"))
+# chunks.json 是否缩进输出（便于人工查看，默认紧凑输出，文件更小、读写更快）
+METADATA_PRETTY = os.getenv("METADATA_PRETTY", "").lower() in ("1", "true", "yes")
+
+
+def _read_metainfo(json_file: Path) -> Tuple[Optional[str], str, Optional[ChunkReport]]:
+    """
+    读取 chunk 报告的 metainfo
+    
+    安装 ijson 时流式解析，读完位于文件开头的 metainfo 即停止；否则整体解析报告。
+    
+    Args:
+        json_file: chunk 报告路径
+        
+    Returns:
+        (SHA1, 原始文件名, 完整报告)，流式解析时完整报告为 None
+    """
+    if ijson is not None:
+        with open(json_file, 'rb') as f:
+            metainfo = next(ijson.items(f, 'metainfo'), {})
+        return metainfo.get("sha1"), metainfo.get("file_name", ""), None
+    report = read_chunk_report(json_file)
+    return report.metainfo.sha1, report.metainfo.file_name or "", report
+
+
 class MetadataStorage:
     """元数据存储类，用于持久化存储 chunk 的文本和相关信息"""
     
@@ -30,17 +69,68 @@ class MetadataStorage:
             "./data/metadata/chunked_reports"
         )
         self.chunks: Dict[str, Dict] = {}
+        # 文档名称 → chunk_id 列表的倒排索引，随 chunks 同步维护
+        self._by_doc: Dict[str, List[str]] = {}
+        # 文档名称集合每变化一次加 1，调用方据此判断按文档名称建立的缓存是否过期
+        self.document_names_version = 0
+        # chunked_reports 目录索引，首次使用时建立，按文件 mtime 增量刷新
+        self._report_meta: Dict[Path, Tuple[float, Optional[str], str]] = {}  # JSON 文件 → (mtime, sha1, file_name)
+        self._sha1_index: Dict[str, Path] = {}  # sha1 → JSON 文件
+        self._name_index: Dict[str, str] = {}  # 小写的文件名 / 去扩展名的文件名 → sha1
+        self._report_cache = LRUCache(REPORT_CACHE_SIZE)  # sha1 → (JSON 文件, mtime, 报告数据)
+        self._index_lock = threading.Lock()
         self.load_from_file()
     
-    def save_chunk(self, chunk: Chunk):
+    def save_chunk(self, chunk: Chunk, flush: bool = True):
         """
         保存 chunk 元数据
         
         Args:
             chunk: chunk 对象
+            flush: 是否立即写回 JSON 文件；批量写入时传 False，全部写入后再调用一次 save_to_file()
+        """
+        self._put_chunk(chunk.chunk_id, chunk.model_dump())
+        if flush:
+            self.save_to_file()
+    
+    def save_chunk_dict(self, chunk_dict: Dict, flush: bool = False):
+        """
+        保存已是字典形式的 chunk 元数据（字段与 Chunk.model_dump() 相同），
+        批量导入时省去逐条构建、校验 pydantic 模型的开销
+        
+        Args:
+            chunk_dict: chunk 字典，需包含 chunk_id
+            flush: 是否立即写回 JSON 文件
         """
-        self.chunks[chunk.chunk_id] = chunk.model_dump()
-        self.save_to_file()
+        self._put_chunk(chunk_dict["chunk_id"], chunk_dict)
+        if flush:
+            self.save_to_file()
+    
+    def _put_chunk(self, chunk_id: str, chunk_dict: Dict):
+        """写入 chunks 并更新文档名称倒排索引"""
+        old = self.chunks.get(chunk_id)
+        doc_name = chunk_dict.get('document_name') or ''
+        if old is not None:
+            old_doc_name = old.get('document_name') or ''
+            if old_doc_name == doc_name:
+                self.chunks[chunk_id] = chunk_dict
+                return
+            self._by_doc[old_doc_name].remove(chunk_id)
+            if not self._by_doc[old_doc_name]:
+                del self._by_doc[old_doc_name]
+                self.document_names_version += 1
+        self.chunks[chunk_id] = chunk_dict
+        if doc_name not in self._by_doc:
+            self._by_doc[doc_name] = []
+            self.document_names_version += 1
+        self._by_doc[doc_name].append(chunk_id)
+    
+    def _rebuild_doc_index(self):
+        """根据当前 chunks 重建文档名称倒排索引"""
+        self._by_doc = {}
+        for chunk_id, chunk in self.chunks.items():
+            self._by_doc.setdefault(chunk.get('document_name') or '', []).append(chunk_id)
+        self.document_names_version += 1
     
     def get_chunk(self, chunk_id: str) -> Optional[Dict]:
         """
@@ -64,71 +154,152 @@ class MetadataStorage:
             try:
                 sha1, index_str = chunk_id.rsplit('_', 1)
                 index = int(index_str)
-                
-                # 在chunked_reports目录中查找对应的JSON文件
-                chunked_reports_path = Path(self.chunked_reports_dir)
-                if chunked_reports_path.exists():
-                    for json_file in chunked_reports_path.glob("*.json"):
-                        try:
-                            with open(json_file, 'r', encoding='utf-8') as f:
-                                data = json.load(f)
-                            
-                            file_sha1 = data.get("metainfo", {}).get("sha1")
-                            if file_sha1 == sha1:
-                                # 找到匹配的文件，提取chunk
-                                chunks_data = data.get("content", {}).get("chunks", [])
-                                if 0 <= index < len(chunks_data):
-                                    chunk_data = chunks_data[index]
-                                    text = chunk_data.get("text", "")
-                                    
-                                    if text and text.strip():
-                                        file_name = data.get("metainfo", {}).get("file_name", json_file.stem)
-                                        document_name = Path(file_name).stem if file_name else json_file.stem
-                                        
-                                        # 提取页码
-                                        page_num = None
-                                        if "page" in chunk_data:
-                                            page_num = chunk_data["page"]
-                                        else:
-                                            import re
-                                            page_match = re.search(r'#\s*第\s*(\d+)\s*页', text)
-                                            if page_match:
-                                                page_num = int(page_match.group(1))
-                                        
-                                        # 提取lines作为position
-                                        lines = chunk_data.get("lines", [])
-                                        position = {
-                                            "start": lines[0] if len(lines) > 0 else 0,
-                                            "end": lines[1] if len(lines) > 1 else lines[0] if len(lines) > 0 else 0
-                                        }
-                                        
-                                        # 构建chunk字典
-                                        chunk_dict = {
-                                            "chunk_id": chunk_id,
-                                            "document_name": document_name,
-                                            "section_path": [],
-                                            "text": text,
-                                            "position": position,
-                                            "page_num": page_num,
-                                            "metadata": {
-                                                "sha1": sha1,
-                                                "file_name": file_name,
-                                                "lines": lines
-                                            }
-                                        }
-                                        
-                                        # 保存到内存中，避免下次再次查找
-                                        self.chunks[chunk_id] = chunk_dict
-                                        logger.debug(f"[MetadataStorage] 从JSON文件动态加载chunk: {chunk_id}")
-                                        return chunk_dict
-                        except Exception as e:
-                            logger.debug(f"[MetadataStorage] 读取JSON文件失败 {json_file.name}: {e}")
-                            continue
             except (ValueError, AttributeError) as e:
                 logger.debug(f"[MetadataStorage] 解析chunk_id失败: {chunk_id}, 错误: {e}")
+                return None
+            
+            # 通过目录索引直接定位对应的JSON文件（报告解析结果有 LRU 缓存，安装 ijson 时只流式解析到该 chunk）
+            try:
+                found = self._load_chunk_data(sha1, index)
+            except Exception as e:
+                logger.debug(f"[MetadataStorage] 读取JSON文件失败 (SHA1: {sha1[:16]}...): {e}")
+                return None
+            if found is None:
+                return None
+            json_file, file_name, chunk_data = found
+            text = chunk_data.text
+            
+            if text and text.strip():
+                document_name = Path(file_name).stem if file_name else json_file.stem
+                
+                # 提取页码
+                page_num = chunk_data.page
+                if page_num is None and '第' in text:
+                    page_match = _PAGE_RE.search(text)
+                    if page_match:
+                        page_num = int(page_match.group(1))
+                
+                # 提取lines作为position
+                lines = chunk_data.lines
+                position = {
+                    "start": lines[0] if len(lines) > 0 else 0,
+                    "end": lines[1] if len(lines) > 1 else lines[0] if len(lines) > 0 else 0
+                }
+                
+                # 构建chunk字典
+                chunk_dict = {
+                    "chunk_id": chunk_id,
+                    "document_name": document_name,
+                    "section_path": [],
+                    "text": text,
+                    "position": position,
+                    "page_num": page_num,
+                    "metadata": {
+                        "sha1": sha1,
+                        "file_name": file_name,
+                        "lines": lines
+                    }
+                }
+                
+                # 保存到内存中，避免下次再次查找
+                self._put_chunk(chunk_id, chunk_dict)
+                logger.debug(f"[MetadataStorage] 从JSON文件动态加载chunk: {chunk_id}")
+                return chunk_dict
         
         return None
     
+    def _ensure_report_index(self):
+        """
+        刷新 chunked_reports 目录索引（SHA1 → JSON 文件，文件名 → SHA1）
+        
+        每次只扫描一次目录（os.scandir）并 stat 其中的 JSON 文件，mtime 未变化的文件不再读取；
+        新增或修改过的文件读取一次 metainfo，已删除的文件从索引中移除。
+        """
+        entries = scan_files(self.chunked_reports_dir, ".json")
+        json_files = [Path(entry.path) for entry in entries]
+        
+        with self._index_lock:
+            changed = False
+            for entry, json_file in zip(entries, json_files):
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                cached = self._report_meta.get(json_file)
+                if cached is not None and cached[0] == mtime:
+                    continue
+                changed = True
+                try:
+                    sha1, file_name, report = _read_metainfo(json_file)
+                except Exception as e:
+                    logger.debug(f"[MetadataStorage] 读取JSON文件失败 {json_file.name}: {e}")
+                    self._report_meta[json_file] = (mtime, None, "")
+                    continue
+                self._report_meta[json_file] = (mtime, sha1, file_name)
+                if sha1 and report is not None:
+                    self._report_cache.set(sha1, (json_file, mtime, report))
+            
+            removed = set(self._report_meta) - set(json_files)
+            for json_file in removed:
+                del self._report_meta[json_file]
+            
+            if changed or removed:
+                # 按目录遍历顺序重建，重复时保留先出现的文件（与逐个扫描时的匹配结果一致）
+                sha1_index: Dict[str, Path] = {}
+                name_index: Dict[str, str] = {}
+                for json_file in json_files:
+                    _, sha1, file_name = self._report_meta.get(json_file, (0.0, None, ""))
+                    if not sha1:
+                        continue
+                    sha1_index.setdefault(sha1, json_file)
+                    # 文件名在建索引时统一规范化（去扩展名、小写），查询时只需一次字典查找
+                    name_index.setdefault(file_name.lower(), sha1)
+                    name_index.setdefault(Path(file_name).stem.lower(), sha1)
+                self._sha1_index = sha1_index
+                self._name_index = name_index
+    
+    def _load_chunk_data(self, sha1: str, index: int) -> Optional[Tuple[Path, str, ChunkRecord]]:
+        """
+        读取指定文档的第 index 个 chunk
+        
+        报告在 LRU 缓存中且文件未修改时直接取用。安装了 ijson 时，文档首次未命中只流式解析到该 chunk 即停止；
+        同一文档再次未命中（检索结果常来自同一文档的多个 chunk）或未安装 ijson 时，整体解析报告并放入缓存。
+        
+        Args:
+            sha1: 文档SHA1
+            index: chunk 序号
+            
+        Returns:
+            (JSON 文件路径, 原始文件名, chunk 数据)，文档或 chunk 不存在时返回 None
+        """
+        self._ensure_report_index()
+        json_file = self._sha1_index.get(sha1)
+        if json_file is None or index < 0:
+            return None
+        mtime, _, file_name = self._report_meta[json_file]
+        
+        cached = self._report_cache.get(sha1)
+        cache_valid = cached is not None and cached[0] == json_file and cached[1] == mtime
+        if cache_valid and cached[2] is not None:
+            report = cached[2]
+        elif ijson is not None and not cache_valid:
+            with open(json_file, 'rb') as f:
+                items = ijson.items(f, 'content.chunks.item', use_float=True)
+                chunk_data = next(itertools.islice(items, index, None), None)
+            # 记录该文档已流式读取过一次（报告数据为 None）
+            self._report_cache.set(sha1, (json_file, mtime, None))
+            if chunk_data is None:
+                return None
+            return json_file, file_name or json_file.stem, to_chunk_record(chunk_data)
+        else:
+            report = read_chunk_report(json_file)
+            self._report_cache.set(sha1, (json_file, mtime, report))
+        
+        chunks_data = report.content.chunks
+        if index >= len(chunks_data):
+            return None
+        return json_file, report.metainfo.file_name or json_file.stem, chunks_data[index]
+    
     def get_chunks(self, chunk_ids: List[str]) -> List[Dict]:
         """
         批量获取 chunk 元数据
@@ -148,12 +319,7 @@ class MetadataStorage:
         Returns:
             文档名称集合
         """
-        document_names = set()
-        for chunk in self.chunks.values():
-            doc_name = chunk.get('document_name')
-            if doc_name:
-                document_names.add(doc_name)
-        return document_names
+        return {doc_name for doc_name in self._by_doc if doc_name}
     
     def get_chunks_by_document_name(self, document_name: str, fuzzy_match: bool = False) -> List[Dict]:
         """
@@ -166,16 +332,7 @@ class MetadataStorage:
         Returns:
             匹配的chunk列表
         """
-        matched_chunks = []
-        for chunk in self.chunks.values():
-            chunk_doc_name = chunk.get('document_name', '')
-            if fuzzy_match:
-                if document_name in chunk_doc_name or chunk_doc_name in document_name:
-                    matched_chunks.append(chunk)
-            else:
-                if chunk_doc_name == document_name:
-                    matched_chunks.append(chunk)
-        return matched_chunks
+        return [self.chunks[cid] for cid in self.get_chunk_ids_by_document_name(document_name, fuzzy_match)]
     
     def get_chunk_ids_by_document_name(self, document_name: str, fuzzy_match: bool = False) -> List[str]:
         """
@@ -188,8 +345,15 @@ class MetadataStorage:
         Returns:
             匹配的chunk ID列表
         """
-        matched_chunks = self.get_chunks_by_document_name(document_name, fuzzy_match)
-        return [chunk['chunk_id'] for chunk in matched_chunks]
+        if not fuzzy_match:
+            return list(self._by_doc.get(document_name, []))
+        
+        # 模糊匹配只需遍历文档名称（数量远小于 chunk 数）
+        matched_ids = []
+        for chunk_doc_name, chunk_ids in self._by_doc.items():
+            if document_name in chunk_doc_name or chunk_doc_name in document_name:
+                matched_ids.extend(chunk_ids)
+        return matched_ids
     
     def get_document_sha1_by_name(self, document_name: str, fuzzy_match: bool = False) -> Optional[str]:
         """
@@ -204,47 +368,31 @@ class MetadataStorage:
         Returns:
             SHA1字符串，如果未找到则返回None
         """
-        chunked_reports_path = Path(self.chunked_reports_dir)
-        if not chunked_reports_path.exists():
-            return None
+        self._ensure_report_index()
         
-        # 遍历所有JSON文件
-        for json_file in chunked_reports_path.glob("*.json"):
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    report_data = json.load(f)
-                
-                metainfo = report_data.get("metainfo", {})
-                file_name = metainfo.get("file_name", "")
-                
-                # 检查是否匹配
-                if fuzzy_match:
-                    if document_name in file_name or file_name in document_name:
-                        return metainfo.get("sha1")
-                else:
-                    # 去掉扩展名比较
-                    file_name_no_ext = Path(file_name).stem
-                    doc_name_no_ext = Path(document_name).stem
-                    if file_name_no_ext == doc_name_no_ext or file_name == document_name:
-                        return metainfo.get("sha1")
-            except Exception:
-                continue
+        if fuzzy_match:
+            for _, sha1, file_name in list(self._report_meta.values()):
+                if sha1 and (document_name in file_name or file_name in document_name):
+                    return sha1
+            return None
         
-        return None
+        # 去掉扩展名比较（不区分大小写）
+        return self._name_index.get(Path(document_name).stem.lower()) or self._name_index.get(document_name.lower())
     
     def save_to_file(self):
-        """保存元数据到 JSON 文件"""
+        """保存元数据到 JSON 文件（先写临时文件再替换，写入中断时不会留下不完整的文件）"""
         os.makedirs(os.path.dirname(self.metadata_path), exist_ok=True)
-        with open(self.metadata_path, 'w', encoding='utf-8') as f:
-            json.dump(self.chunks, f, ensure_ascii=False, indent=2)
+        tmp_path = self.metadata_path + ".tmp"
+        write_json(tmp_path, self.chunks, indent=METADATA_PRETTY)
+        os.replace(tmp_path, self.metadata_path)
     
     def load_from_file(self):
         """从 JSON 文件加载元数据"""
         logger.info(f"[MetadataStorage] 尝试从文件加载chunks: {self.metadata_path}")
         if os.path.exists(self.metadata_path):
             try:
-                with open(self.metadata_path, 'r', encoding='utf-8') as f:
-                    self.chunks = json.load(f)
+                self.chunks = read_json(self.metadata_path)
+                self._rebuild_doc_index()
                 logger.info(f"[MetadataStorage] 成功加载 {len(self.chunks)} 个chunks")
                 if len(self.chunks) == 0:
                     logger.warning(f"[MetadataStorage] chunks.json文件存在但为空！")
@@ -254,8 +402,10 @@ class MetadataStorage:
             except Exception as e:
                 logger.error(f"[MetadataStorage] 加载chunks失败: {e}", exc_info=True)
                 self.chunks = {}
+                self._rebuild_doc_index()
         else:
             logger.warning(f"[MetadataStorage] chunks.json文件不存在: {self.metadata_path}")
             logger.warning(f"[MetadataStorage] 如果chunk JSON文件在chunked_reports目录，需要先加载到MetadataStorage")
             self.chunks = {}
+            self._rebuild_doc_index()
 
@@ -0,0 +1,29 @@
+"""
+异步运行工具
+命令行脚本的事件循环入口：安装了 uvloop 时使用 uvloop（libuv 实现，I/O 唤醒开销更低），
+否则回退到标准库 asyncio
+"""
+import asyncio
+from typing import Any, Coroutine, TypeVar
+
+try:
+    import uvloop
+except ImportError:  # uvloop 为可选依赖（Windows 不支持）
+    uvloop = None
+
+T = TypeVar("T")
+
+
+def run(main: Coroutine[Any, Any, T]) -> T:
+    """
+    运行协程直到完成，用法同 asyncio.run
+
+    Args:
+        main: 待运行的协程
+
+    Returns:
+        协程的返回值
+    """
+    if uvloop is not None:
+        return uvloop.run(main)
+    return asyncio.run(main)
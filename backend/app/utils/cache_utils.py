@@ -0,0 +1,92 @@
+"""
+缓存工具
+提供线程安全的 LRU 缓存（可选 TTL 过期）
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存，超过容量时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        """
+        初始化 LRU 缓存
+
+        Args:
+            maxsize: 最大条目数
+            ttl: 条目存活时间（秒），为 None 时永不过期
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._expires: dict = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, key: Hashable) -> bool:
+        """检查条目是否过期，过期则删除（需在持有锁时调用）"""
+        if self.ttl is None:
+            return False
+        if self._expires.get(key, 0) > time.monotonic():
+            return False
+        self._data.pop(key, None)
+        self._expires.pop(key, None)
+        return True
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """
+        获取缓存值，命中时将条目移到最近使用的位置
+
+        Args:
+            key: 缓存键
+            default: 未命中时返回的默认值
+
+        Returns:
+            缓存值或 default
+        """
+        with self._lock:
+            if key not in self._data or self._expired(key):
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any):
+        """
+        写入缓存值
+
+        Args:
+            key: 缓存键
+            value: 缓存值
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.ttl is not None:
+                self._expires[key] = time.monotonic() + self.ttl
+            while len(self._data) > self.maxsize:
+                oldest, _ = self._data.popitem(last=False)
+                self._expires.pop(oldest, None)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """删除并返回缓存值"""
+        with self._lock:
+            self._expires.pop(key, None)
+            return self._data.pop(key, default)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data and not self._expired(key)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,122 @@
+"""
+chunk 报告读取工具
+chunked_reports 目录下的 JSON 文件结构相同：
+{"metainfo": {"sha1", "file_name"}, "content": {"chunks": [{"text", "page", "lines", "chunk_id"}]}}
+安装 msgspec 时按该结构直接解码为 Struct（不创建中间 dict），未安装时解析为 dict 后转换为同名字段的 NamedTuple
+"""
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Union
+
+from app.utils.json_utils import loads, mapped_bytes
+
+try:
+    import msgspec
+except ImportError:  # msgspec 为可选依赖，未安装时通过 json_utils 解析
+    msgspec = None
+
+
+if msgspec is not None:
+    class ChunkRecord(msgspec.Struct):
+        """报告中的单个 chunk"""
+        text: str = ""
+        lines: List[int] = []
+        page: Optional[int] = None
+        chunk_id: Optional[str] = None
+
+    class ChunkMetainfo(msgspec.Struct):
+        """报告的文档信息"""
+        sha1: Optional[str] = None
+        file_name: Optional[str] = None
+
+    class ChunkContent(msgspec.Struct):
+        """报告的 chunk 列表"""
+        chunks: List[ChunkRecord] = []
+
+    class ChunkReport(msgspec.Struct):
+        """chunk 报告"""
+        metainfo: ChunkMetainfo = msgspec.field(default_factory=ChunkMetainfo)
+        content: ChunkContent = msgspec.field(default_factory=ChunkContent)
+
+    _decoder = msgspec.json.Decoder(ChunkReport)
+else:
+    class ChunkRecord(NamedTuple):
+        """报告中的单个 chunk"""
+        text: str = ""
+        lines: List[int] = []
+        page: Optional[int] = None
+        chunk_id: Optional[str] = None
+
+    class ChunkMetainfo(NamedTuple):
+        """报告的文档信息"""
+        sha1: Optional[str] = None
+        file_name: Optional[str] = None
+
+    class ChunkContent(NamedTuple):
+        """报告的 chunk 列表"""
+        chunks: List[ChunkRecord] = []
+
+    class ChunkReport(NamedTuple):
+        """chunk 报告"""
+        metainfo: ChunkMetainfo = ChunkMetainfo()
+        content: ChunkContent = ChunkContent()
+
+    _decoder = None
+
+
+def to_chunk_record(chunk_data: Dict[str, Any]) -> ChunkRecord:
+    """
+    将 chunk 字典转换为 ChunkRecord
+
+    Args:
+        chunk_data: 报告中的 chunk 字典
+
+    Returns:
+        ChunkRecord
+    """
+    return ChunkRecord(
+        text=chunk_data.get("text", ""),
+        lines=chunk_data.get("lines", []),
+        page=chunk_data.get("page"),
+        chunk_id=chunk_data.get("chunk_id")
+    )
+
+
+def decode_chunk_report(data: Union[bytes, memoryview]) -> ChunkReport:
+    """
+    解码 chunk 报告
+
+    字段类型与预期不符（如 page 为字符串）时 msgspec 会拒绝解码，此时按 dict 解析后逐个转换。
+
+    Args:
+        data: JSON 字节串（或 memoryview）
+
+    Returns:
+        ChunkReport
+    """
+    if _decoder is not None:
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError:
+            pass
+
+    obj = loads(data)
+    metainfo = obj.get("metainfo", {})
+    chunks = obj.get("content", {}).get("chunks", [])
+    return ChunkReport(
+        metainfo=ChunkMetainfo(sha1=metainfo.get("sha1"), file_name=metainfo.get("file_name")),
+        content=ChunkContent(chunks=[to_chunk_record(chunk_data) for chunk_data in chunks])
+    )
+
+
+def read_chunk_report(path: Union[str, Path]) -> ChunkReport:
+    """
+    读取 chunk 报告文件（通过 mmap 读取文件内容）
+
+    Args:
+        path: 文件路径
+
+    Returns:
+        ChunkReport
+    """
+    with mapped_bytes(path) as data:
+        return decode_chunk_report(data)
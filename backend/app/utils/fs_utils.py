@@ -0,0 +1,122 @@
+"""
+文件系统工具
+提供原子写入、目录扫描等文件操作
+"""
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import FrozenSet, Iterator, List, Union
+
+# 临时文件后缀，避免被 *.pdf / *.json 等扫描误认为正式文件
+PARTIAL_SUFFIX = ".part"
+
+
+def create_partial_file(dest: Union[str, Path]):
+    """
+    在目标文件所在目录创建临时文件（与目标位于同一文件系统，可原子重命名）
+    
+    Args:
+        dest: 目标文件路径
+        
+    Returns:
+        以二进制写模式打开的临时文件对象（delete=False，需调用方 replace 或删除）
+    """
+    dest = Path(dest)
+    return tempfile.NamedTemporaryFile(
+        mode='wb',
+        dir=str(dest.parent),
+        prefix=f".{dest.name}.",
+        suffix=PARTIAL_SUFFIX,
+        delete=False
+    )
+
+
+def write_file_atomic(dest: Union[str, Path], data: bytes):
+    """
+    原子写入文件：先写同目录临时文件，再 os.replace 到目标路径
+    
+    Args:
+        dest: 目标文件路径
+        data: 文件内容
+    """
+    tmp = create_partial_file(dest)
+    try:
+        with tmp:
+            tmp.write(data)
+        os.replace(tmp.name, dest)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+
+def copy_file_atomic(src: Union[str, Path], dest: Union[str, Path]):
+    """
+    原子复制文件：先复制到目标目录下的临时文件，再 os.replace 到目标路径
+    
+    Args:
+        src: 源文件路径
+        dest: 目标文件路径
+    """
+    tmp = create_partial_file(dest)
+    tmp.close()
+    try:
+        shutil.copyfile(src, tmp.name)
+        os.replace(tmp.name, dest)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+
+
+def scan_files(directory: Union[str, Path], suffix: str) -> List[os.DirEntry]:
+    """
+    列出目录下（不递归）指定后缀的文件
+    
+    基于 os.scandir：文件类型来自目录项本身，无需逐个 stat；需要大小等信息时
+    可调用 DirEntry.stat()。
+    
+    Args:
+        directory: 目录路径
+        suffix: 文件后缀，如 ".pdf"
+        
+    Returns:
+        按文件名排序的 DirEntry 列表，目录不存在时返回空列表
+    """
+    try:
+        with os.scandir(directory) as it:
+            entries = [e for e in it if e.name.endswith(suffix) and e.is_file()]
+    except FileNotFoundError:
+        return []
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+
+def walk_files(directory: Union[str, Path], suffixes: FrozenSet[str]) -> Iterator[os.DirEntry]:
+    """
+    递归列出目录下扩展名属于 suffixes 的文件
+    
+    用显式栈代替 os.walk，只遍历一次目录项；扩展名按小写在集合中查找。
+    
+    Args:
+        directory: 根目录
+        suffixes: 小写扩展名集合，如 frozenset({".pdf", ".md"})
+        
+    Yields:
+        匹配的文件 DirEntry（目录内按名称排序）
+    """
+    stack = [str(directory)]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in suffixes:
+                yield entry
+        # 逆序入栈，使子目录按名称顺序出栈
+        stack.extend(reversed(subdirs))
@@ -3,28 +3,80 @@ SHA1 哈希计算工具
 用于生成文档的唯一标识符
 """
 import hashlib
+import mmap
+import os
 from pathlib import Path
 from typing import Union
 
+# SHA1 缓存旁路文件的后缀，例如 report.pdf → report.pdf.sha1
+SHA1_SIDECAR_SUFFIX = ".sha1"
+# 无法 mmap 时逐块读取的块大小
+_READ_BLOCK_SIZE = 1 << 20
+
 
 def calculate_file_sha1(file_path: Union[str, Path]) -> str:
     """
     基于文件内容计算 SHA1 哈希值
     
+    通过 mmap 将整个文件交给 hashlib 一次性计算，避免 Python 层逐块循环；
+    hashlib 基于 OpenSSL，在支持 SHA-NI 的 CPU 上会自动使用硬件指令。
+    无法 mmap 的文件（如管道、部分网络文件系统）改用 hashlib.file_digest（Python 3.11+，读取循环在 C 中执行），
+    旧版本 Python 按 1 MiB 分块读取。
+    
     Args:
         file_path: 文件路径
         
     Returns:
         SHA1 哈希值（十六进制字符串）
     """
-    sha1_hash = hashlib.sha1()
-    
     with open(file_path, 'rb') as f:
-        # 分块读取，避免大文件占用过多内存
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha1_hash.update(chunk)
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha1(mm).hexdigest()
+        except (ValueError, OSError):
+            # 空文件或不支持 mmap 的文件（mmap 失败时未读取任何内容），改为流式读取
+            pass
+        
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha1").hexdigest()
+        sha1_hash = hashlib.sha1()
+        for block in iter(lambda: f.read(_READ_BLOCK_SIZE), b''):
+            sha1_hash.update(block)
+        return sha1_hash.hexdigest()
+
+
+def calculate_file_sha1_cached(file_path: Union[str, Path]) -> str:
+    """
+    计算文件 SHA1，并将结果缓存到同目录的 <文件名>.sha1 旁路文件
     
-    return sha1_hash.hexdigest()
+    旁路文件记录 "sha1 size mtime_ns"，文件大小或修改时间变化时自动重新计算。
+    旁路文件无法写入（如只读目录）时仅返回计算结果。
+    
+    Args:
+        file_path: 文件路径
+        
+    Returns:
+        SHA1 哈希值（十六进制字符串）
+    """
+    file_path = Path(file_path)
+    st = file_path.stat()
+    sidecar = file_path.with_name(file_path.name + SHA1_SIDECAR_SUFFIX)
+    
+    try:
+        sha1, size, mtime_ns = sidecar.read_text(encoding='utf-8').split()
+        if int(size) == st.st_size and int(mtime_ns) == st.st_mtime_ns and len(sha1) == 40:
+            return sha1
+    except (OSError, ValueError):
+        pass
+    
+    sha1 = calculate_file_sha1(file_path)
+    try:
+        tmp_path = sidecar.with_name(sidecar.name + ".tmp")
+        tmp_path.write_text(f"{sha1} {st.st_size} {st.st_mtime_ns}\n", encoding='utf-8')
+        os.replace(tmp_path, sidecar)
+    except OSError:
+        pass
+    return sha1
 
 
 def calculate_text_sha1(text: str) -> str:
@@ -0,0 +1,117 @@
+"""
+JSON 工具
+优先使用 orjson（C 实现，序列化/反序列化更快），未安装时回退到标准库 json
+"""
+import json
+import mmap
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson 为可选依赖
+    orjson = None
+
+# 标准库 json 写文件时的缓冲区大小
+_WRITE_BUFFER_SIZE = 1 << 20
+
+
+def dumps(obj: Any, indent: bool = True) -> bytes:
+    """
+    将对象序列化为 UTF-8 编码的 JSON 字节串（非 ASCII 字符不转义）
+
+    Args:
+        obj: 待序列化的对象
+        indent: 是否使用 2 空格缩进
+
+    Returns:
+        JSON 字节串
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+
+def loads(data: Union[bytes, memoryview, str]) -> Any:
+    """
+    反序列化 JSON 字节串或字符串
+
+    orjson 比标准库更严格（如不接受 NaN），解析失败时再用标准库 json 尝试一次。
+    标准库 json 不接受 memoryview，此时先复制为 bytes。
+
+    Args:
+        data: JSON 数据
+
+    Returns:
+        解析后的对象
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+@contextmanager
+def mapped_bytes(path: Union[str, Path]) -> Iterator[Union[memoryview, bytes]]:
+    """
+    以只读 mmap 打开文件，提供文件内容的 memoryview
+
+    orjson / msgspec 可直接从页缓存解析，无需先把整个文件复制到新的 bytes 对象中。
+    空文件或不支持 mmap 的文件退回到普通读取。解析结果不引用文件内容，退出上下文后即可释放映射。
+
+    Args:
+        path: 文件路径
+
+    Yields:
+        文件内容（memoryview 或 bytes）
+    """
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            yield f.read()
+            return
+        try:
+            with memoryview(mm) as view:
+                yield view
+        finally:
+            mm.close()
+
+
+def read_json(path: Union[str, Path]) -> Any:
+    """
+    读取 JSON 文件（通过 mmap 读取文件内容）
+
+    Args:
+        path: 文件路径
+
+    Returns:
+        解析后的对象
+    """
+    with mapped_bytes(path) as data:
+        return loads(data)
+
+
+def write_json(path: Union[str, Path], obj: Any, indent: bool = True):
+    """
+    将对象写入 JSON 文件
+
+    Args:
+        path: 文件路径
+        obj: 待写入的对象
+        indent: 是否使用 2 空格缩进
+    """
+    if orjson is not None:
+        Path(path).write_bytes(dumps(obj, indent=indent))
+        return
+    # 标准库 json 边编码边写入大缓冲区：不在内存中拼出完整的字符串和字节串，写入时也只有少量大块系统调用
+    with open(path, 'w', encoding='utf-8', newline='', buffering=_WRITE_BUFFER_SIZE) as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2 if indent else None)
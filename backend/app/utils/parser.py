@@ -8,6 +8,9 @@ import pdfplumber
 import docx
 from app.models.document import Document
 
+# PDF 文本提取引擎：pymupdf（默认，速度快、内存占用低）/ pdfplumber（对版面更敏感的文档可切换）
+PDF_TEXT_EXTRACTOR = os.getenv("PDF_TEXT_EXTRACTOR", "pymupdf").lower()
+
 class DocumentParser:
     """文档解析器类，支持 .docx、.pdf、.txt、.md 格式"""
     
@@ -48,15 +51,36 @@ class DocumentParser:
 
     def _parse_pdf_with_pages(self, file_path: str) -> (str, List[str], List[Dict]):
         """解析 PDF 并保留页码信息"""
-        content = []
+        if PDF_TEXT_EXTRACTOR == "pdfplumber":
+            return self._parse_pdf_with_pdfplumber(file_path)
+        
+        import fitz  # PyMuPDF
+        
+        # 与 PDFToMarkdownConverter 相同的提取选项：默认文本提取并合并行尾连字符断开的单词
+        flags = fitz.TEXTFLAGS_TEXT | fitz.TEXT_DEHYPHENATE
         pages = []
-        with pdfplumber.open(file_path) as pdf:
-            for i, page in enumerate(pdf.pages):
-                text = page.extract_text()
+        with fitz.open(file_path, filetype="pdf") as doc:
+            for i, page in enumerate(doc):
+                # 去掉行尾换行，与 pdfplumber 的输出保持一致（空白页同样跳过）
+                text = page.get_text("text", flags=flags).rstrip()
                 if text:
-                    content.append(text)
                     pages.append({"page_num": i + 1, "text": text})
-        return "\n".join(content), [], pages
+        return "\n".join(p["text"] for p in pages), [], pages
+    
+    def _parse_pdf_with_pdfplumber(self, file_path: str) -> (str, List[str], List[Dict]):
+        """使用 pdfplumber 解析 PDF 并保留页码信息"""
+        pages = []
+        with pdfplumber.open(file_path) as pdf:
+            for i, page in enumerate(pdf.pages):
+                try:
+                    text = page.extract_text()
+                    if text:
+                        pages.append({"page_num": i + 1, "text": text})
+                finally:
+                    # pdf.pages 会一直持有所有 Page 对象，提取后立即释放其布局对象与 textmap 缓存，
+                    # 使峰值内存只与单页相关
+                    page.close()
+        return "\n".join(p["text"] for p in pages), [], pages
     
     def _get_file_type(self, file_path: str) -> str:
         """获取文件类型"""
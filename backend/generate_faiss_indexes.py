@@ -2,9 +2,9 @@
 批量生成FAISS索引文件
 为chunked_reports目录下的所有JSON文件生成对应的FAISS索引
 """
-import asyncio
+import os
 import sys
-import json
+import asyncio
 import logging
 from pathlib import Path
 
@@ -16,6 +16,10 @@ sys.path.insert(0, str(Path(__file__).parent))
 
 from app.services.vector_db import VectorDBService
 from app.services.embedding import EmbeddingService
+from app.services.embedding_batcher import EmbeddingBatcher
+from app.utils.async_utils import run
+from app.utils.fs_utils import scan_files
+from app.utils.json_utils import read_json
 
 async def generate_all_faiss_indexes():
     """为所有chunk JSON文件生成FAISS索引"""
@@ -29,63 +33,69 @@ async def generate_all_faiss_indexes():
     vector_dbs_dir.mkdir(parents=True, exist_ok=True)
     
     # 获取所有JSON文件
-    json_files = list(chunked_reports_dir.glob("*.json"))
+    json_files = [Path(entry.path) for entry in scan_files(chunked_reports_dir, ".json")]
     print(f"找到 {len(json_files)} 个chunk JSON文件")
     
-    # 初始化服务
+    # 初始化服务（各文件的 embedding 请求经由批处理队列合并调用 API）
     try:
         embedding_service = EmbeddingService()
-        vector_db = VectorDBService(embedding_service)
+        vector_db = VectorDBService(embedding_service, EmbeddingBatcher(embedding_service))
     except Exception as e:
         print(f"初始化服务失败: {e}")
         print("请检查环境变量 QWEN_API_KEY 或 DASHSCOPE_API_KEY 是否设置")
         return
     
-    processed_count = 0
-    skipped_count = 0
-    failed_count = 0
+    # 多个文件并发处理，重叠 embedding API 的网络等待
+    semaphore = asyncio.Semaphore(max(1, int(os.getenv("INGEST_CONCURRENCY", "4"))))
+    
+    def _read_metainfo(json_file: Path):
+        """读取 chunk JSON 文件的 SHA1 与文件名，解析出的报告在返回前即释放"""
+        metainfo = read_json(json_file).get("metainfo", {})
+        return metainfo.get("sha1"), metainfo.get("file_name", json_file.name)
+    
+    async def _process_one(json_file: Path) -> str:
+        """处理单个 chunk JSON 文件，返回 processed / skipped / failed"""
+        # 读取前先取得信号量，同一时间最多 INGEST_CONCURRENCY 个报告在内存中
+        async with semaphore:
+            # 读取JSON文件获取SHA1
+            try:
+                sha1, file_name = await asyncio.to_thread(_read_metainfo, json_file)
+            except Exception as e:
+                print(f"读取 {json_file.name} 失败: {e}")
+                return "failed"
+            
+            if not sha1:
+                print(f"跳过 {json_file.name}：缺少SHA1")
+                return "skipped"
+            
+            # 检查是否已存在
+            faiss_file = vector_dbs_dir / f"{sha1}.faiss"
+            if faiss_file.exists():
+                print(f"跳过 {json_file.name}：FAISS索引已存在 ({faiss_file.name})")
+                return "skipped"
+            
+            print(f"\n处理: {json_file.name}")
+            print(f"  SHA1: {sha1}")
+            print(f"  文件名: {file_name}")
+            
+            try:
+                faiss_path = await vector_db.process_chunk_json(
+                    chunk_json_path=str(json_file),
+                    output_dir=str(vector_dbs_dir),
+                    max_chunk_length=2048
+                )
+                print(f"  [OK] 成功生成: {json_file.name} -> {Path(faiss_path).name}")
+                return "processed"
+            except Exception as e:
+                print(f"  [ERROR] 处理失败 {json_file.name}: {e}")
+                import traceback
+                traceback.print_exc()
+                return "failed"
     
-    for json_file in json_files:
-        # 读取JSON文件获取SHA1
-        try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                sha1 = data.get("metainfo", {}).get("sha1")
-                file_name = data.get("metainfo", {}).get("file_name", json_file.name)
-        except Exception as e:
-            print(f"读取 {json_file.name} 失败: {e}")
-            failed_count += 1
-            continue
-        
-        if not sha1:
-            print(f"跳过 {json_file.name}：缺少SHA1")
-            skipped_count += 1
-            continue
-        
-        # 检查是否已存在
-        faiss_file = vector_dbs_dir / f"{sha1}.faiss"
-        if faiss_file.exists():
-            print(f"跳过 {json_file.name}：FAISS索引已存在 ({faiss_file.name})")
-            skipped_count += 1
-            continue
-        
-        print(f"\n处理: {json_file.name}")
-        print(f"  SHA1: {sha1}")
-        print(f"  文件名: {file_name}")
-        
-        try:
-            faiss_path = await vector_db.process_chunk_json(
-                chunk_json_path=str(json_file),
-                output_dir=str(vector_dbs_dir),
-                max_chunk_length=2048
-            )
-            print(f"  [OK] 成功生成: {Path(faiss_path).name}")
-            processed_count += 1
-        except Exception as e:
-            print(f"  [ERROR] 处理失败: {e}")
-            failed_count += 1
-            import traceback
-            traceback.print_exc()
+    results = await asyncio.gather(*(_process_one(json_file) for json_file in json_files))
+    processed_count = results.count("processed")
+    skipped_count = results.count("skipped")
+    failed_count = results.count("failed")
     
     print(f"\n完成！")
     print(f"  处理: {processed_count} 个文件")
@@ -94,4 +104,4 @@ async def generate_all_faiss_indexes():
     print(f"  总计: {len(json_files)} 个文件")
 
 if __name__ == "__main__":
-    asyncio.run(generate_all_faiss_indexes())
+    run(generate_all_faiss_indexes())
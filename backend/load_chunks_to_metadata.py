@@ -1,113 +1,156 @@
 """
 将chunk JSON文件中的chunks加载到MetadataStorage
 """
-import json
+import os
+import re
 import sys
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Any, Dict, Optional
 
 # 添加项目根目录到路径
 sys.path.insert(0, str(Path(__file__).parent))
 
 from app.storage.metadata import MetadataStorage
-from app.models.chunk import Chunk
+from app.utils.fs_utils import scan_files
+from app.utils.chunk_report import read_chunk_report
 
 # 设置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-def load_chunks_from_json(chunk_json_path: Path, metadata_storage: MetadataStorage):
+# chunk 文本中的页码标记（例如 "# 第 1 页"）
+_PAGE_RE = re.compile(r'#\s*第\s*(\d+)\s*页')
+# 并行解析 chunk JSON 文件的进程数
+PARSE_WORKERS = os.cpu_count() or 1
+
+def parse_chunk_report(chunk_json_path: Path) -> Dict[str, Any]:
+    """
+    读取 chunk JSON 文件并构建 chunk 字典（不依赖 MetadataStorage，可在子进程中执行）
+    
+    Args:
+        chunk_json_path: chunk JSON文件路径
+        
+    Returns:
+        {"document_name", "sha1", "total", "chunks", "skipped", "errors"}：
+        chunks 为与 Chunk.model_dump() 结构相同的字典列表，skipped 为空文本的 chunk 数，
+        errors 为 (chunk 序号, 错误信息) 列表
+    """
+    report = read_chunk_report(chunk_json_path)
+    
+    sha1 = report.metainfo.sha1
+    file_name = report.metainfo.file_name
+    if file_name is None:
+        file_name = chunk_json_path.stem
+    document_name = Path(file_name).stem if file_name else chunk_json_path.stem
+    
+    chunks_data = report.content.chunks
+    chunk_dicts = []
+    skipped_count = 0
+    errors = []
+    
+    for idx, chunk_data in enumerate(chunks_data):
+        try:
+            # 从chunk数据中提取信息
+            text = chunk_data.text
+            if not text or not text.strip():
+                skipped_count += 1
+                continue
+            
+            # 生成chunk_id（与vector_db.py中的逻辑保持一致）
+            chunk_id = chunk_data.chunk_id
+            if not chunk_id:
+                # 使用格式: {sha1}_{index} 作为chunk_id
+                chunk_id = f"{sha1}_{idx}"
+            
+            # 提取页码（从text中提取，或者从chunk数据中获取）
+            page_num = chunk_data.page
+            if page_num is None and '第' in text:
+                # 尝试从text中提取页码（例如 "# 第 1 页"）
+                page_match = _PAGE_RE.search(text)
+                if page_match:
+                    page_num = int(page_match.group(1))
+            
+            # 提取lines作为position
+            lines = chunk_data.lines
+            position = {
+                "start": lines[0] if len(lines) > 0 else 0,
+                "end": lines[1] if len(lines) > 1 else lines[0] if len(lines) > 0 else 0
+            }
+            
+            # 直接构建与 Chunk.model_dump() 相同结构的字典，省去逐条的 pydantic 校验
+            chunk_dicts.append({
+                "chunk_id": chunk_id,
+                "document_name": document_name,
+                "section_path": [],  # chunk JSON中没有section_path信息
+                "text": text,
+                "position": position,
+                "page_num": page_num,
+                "metadata": {
+                    "sha1": sha1,
+                    "file_name": file_name,
+                    "lines": lines
+                }
+            })
+        except Exception as e:
+            errors.append((idx, str(e)))
+    
+    return {
+        "document_name": document_name,
+        "sha1": sha1,
+        "total": len(chunks_data),
+        "chunks": chunk_dicts,
+        "skipped": skipped_count,
+        "errors": errors
+    }
+
+def _parse_chunk_report_safe(chunk_json_path: Path) -> Any:
+    """在子进程中解析 chunk JSON 文件，失败时返回异常对象（由 load_chunks_from_json 统一记录）"""
+    try:
+        return parse_chunk_report(chunk_json_path)
+    except Exception as e:
+        return e
+
+def load_chunks_from_json(chunk_json_path: Path, metadata_storage: MetadataStorage, parsed: Optional[Any] = None):
     """
     从chunk JSON文件加载chunks到MetadataStorage
     
     Args:
         chunk_json_path: chunk JSON文件路径
         metadata_storage: MetadataStorage实例
+        parsed: parse_chunk_report 的结果（或解析时的异常），为 None 时在此解析
     """
     try:
-        with open(chunk_json_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        metainfo = data.get("metainfo", {})
-        sha1 = metainfo.get("sha1")
-        file_name = metainfo.get("file_name", chunk_json_path.stem)
-        document_name = Path(file_name).stem if file_name else chunk_json_path.stem
-        
-        chunks_data = data.get("content", {}).get("chunks", [])
+        if parsed is None:
+            parsed = parse_chunk_report(chunk_json_path)
+        elif isinstance(parsed, BaseException):
+            raise parsed
         
         logger.info(f"处理文件: {chunk_json_path.name}")
-        logger.info(f"  文档名称: {document_name}")
-        logger.info(f"  SHA1: {sha1}")
-        logger.info(f"  Chunks数量: {len(chunks_data)}")
+        logger.info(f"  文档名称: {parsed['document_name']}")
+        logger.info(f"  SHA1: {parsed['sha1']}")
+        logger.info(f"  Chunks数量: {parsed['total']}")
         
         loaded_count = 0
-        skipped_count = 0
+        skipped_count = parsed["skipped"] + len(parsed["errors"])
+        for idx, error in parsed["errors"]:
+            logger.error(f"  处理chunk {idx} 失败: {error}")
         
-        for idx, chunk_data in enumerate(chunks_data):
-            try:
-                # 从chunk数据中提取信息
-                text = chunk_data.get("text", "")
-                if not text or not text.strip():
-                    skipped_count += 1
-                    continue
-                
-                # 生成chunk_id（与vector_db.py中的逻辑保持一致）
-                chunk_id = chunk_data.get("chunk_id")
-                if not chunk_id:
-                    # 使用格式: {sha1}_{index} 作为chunk_id
-                    chunk_id = f"{sha1}_{idx}"
-                
-                # 检查是否已存在
-                if chunk_id in metadata_storage.chunks:
-                    logger.debug(f"  Chunk {chunk_id} 已存在，跳过")
-                    skipped_count += 1
-                    continue
-                
-                # 提取页码（从text中提取，或者从chunk数据中获取）
-                page_num = None
-                if "page" in chunk_data:
-                    page_num = chunk_data["page"]
-                else:
-                    # 尝试从text中提取页码（例如 "# 第 1 页"）
-                    import re
-                    page_match = re.search(r'#\s*第\s*(\d+)\s*页', text)
-                    if page_match:
-                        page_num = int(page_match.group(1))
-                
-                # 提取lines作为position
-                lines = chunk_data.get("lines", [])
-                position = {
-                    "start": lines[0] if len(lines) > 0 else 0,
-                    "end": lines[1] if len(lines) > 1 else lines[0] if len(lines) > 0 else 0
-                }
-                
-                # 创建Chunk对象
-                chunk = Chunk(
-                    chunk_id=chunk_id,
-                    document_name=document_name,
-                    section_path=[],  # chunk JSON中没有section_path信息
-                    text=text,
-                    position=position,
-                    page_num=page_num,
-                    metadata={
-                        "sha1": sha1,
-                        "file_name": file_name,
-                        "lines": lines
-                    }
-                )
-                
-                # 保存到MetadataStorage
-                metadata_storage.save_chunk(chunk)
-                loaded_count += 1
-                
-            except Exception as e:
-                logger.error(f"  处理chunk {idx} 失败: {e}")
+        for chunk_dict in parsed["chunks"]:
+            # 检查是否已存在
+            if chunk_dict["chunk_id"] in metadata_storage.chunks:
+                logger.debug(f"  Chunk {chunk_dict['chunk_id']} 已存在，跳过")
                 skipped_count += 1
                 continue
+            
+            # 保存到MetadataStorage（main 中全部加载完成后统一写回文件）
+            metadata_storage.save_chunk_dict(chunk_dict, flush=False)
+            loaded_count += 1
         
         logger.info(f"  加载: {loaded_count} 个chunks, 跳过: {skipped_count} 个chunks")
         return loaded_count
-        
+    
     except Exception as e:
         logger.error(f"处理文件 {chunk_json_path.name} 失败: {e}", exc_info=True)
         return 0
@@ -125,15 +168,21 @@ def main():
     logger.info(f"MetadataStorage初始化完成，当前有 {len(metadata_storage.chunks)} 个chunks")
     
     # 获取所有JSON文件
-    json_files = list(chunked_reports_dir.glob("*.json"))
+    json_files = [Path(entry.path) for entry in scan_files(chunked_reports_dir, ".json")]
     logger.info(f"找到 {len(json_files)} 个chunk JSON文件")
     
     total_loaded = 0
     total_skipped = 0
     
-    for json_file in json_files:
-        loaded = load_chunks_from_json(json_file, metadata_storage)
-        total_loaded += loaded
+    # 在多个进程中并行解析 JSON 文件并构建 chunk 字典，主进程按文件顺序依次写入 MetadataStorage
+    workers = min(PARSE_WORKERS, len(json_files))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for json_file, parsed in zip(json_files, pool.map(_parse_chunk_report_safe, json_files)):
+                total_loaded += load_chunks_from_json(json_file, metadata_storage, parsed)
+    else:
+        for json_file in json_files:
+            total_loaded += load_chunks_from_json(json_file, metadata_storage)
     
     logger.info("=" * 80)
     logger.info(f"完成！")
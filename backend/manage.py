@@ -1,7 +1,7 @@
-import asyncio
 import click
 import os
 from app.services.pipeline import RAGPipeline
+from app.utils.async_utils import run
 
 @click.group()
 def cli():
@@ -13,14 +13,14 @@ def cli():
 def ingest(dir):
     """批量入库文档"""
     pipeline = RAGPipeline()
-    asyncio.run(pipeline.ingest_directory(dir))
+    run(pipeline.ingest_directory(dir))
 
 @cli.command()
 @click.argument('query')
 def query(query):
     """测试单次问答"""
     pipeline = RAGPipeline()
-    result = asyncio.run(pipeline.answer(query))
+    result = run(pipeline.answer(query))
     print(f"\n思考过程:\n{result['thoughts']}")
     print(f"\n最终答案:\n{result['answer']}")
     print(f"\n引用页码: {result['citations']}")